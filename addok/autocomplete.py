@@ -1,14 +1,28 @@
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from functools import partial
+from operator import itemgetter
+
 import redis
 
 from addok.config import config
 from addok.db import DB
 from addok.helpers import keys as dbkeys
-from addok.helpers import magenta, parallelize, white, scripts
-from addok.helpers.index import token_key_frequency
+from addok.helpers import magenta, offline, parallelize, white, scripts
+from addok.helpers.index import IMPORT_GENERATION_KEY, token_key_frequency
 from addok.helpers.search import preprocess_query
 from addok.helpers.text import compute_edge_ngrams
 from addok.pairs import pair_key
 
+# Parts of the keyspace scanned in parallel by `addok ngrams` (a power of 2).
+SCAN_PARTITIONS = 64
+SCAN_COUNT = 10000
+# Tokens whose ngrams are written at once.
+NGRAMS_CHUNK_SIZE = 10000
+
 
 def edge_ngram_key(s):
     return "n|{}".format(s)
@@ -19,25 +33,82 @@ def index_edge_ngrams(pipe, token):
         pipe.sadd(edge_ngram_key(ngram), token)
 
 
-def deindex_edge_ngrams(token):
+def index_top_documents(pipe, scores):
+    """Add documents to the best ones of the edge ngrams of their tokens.
+
+    `scores` maps each document key to the scores of its tokens."""
+    tops = {}  # Ngram => document key => score.
+    for key, tokens in scores.items():
+        for token, score in tokens.items():
+            for ngram in compute_edge_ngrams(token):
+                top = tops.setdefault(ngram, {})
+                if top.get(key, 0) < score:
+                    top[key] = score
+    size = config.AUTOCOMPLETE_TOP_K
+    for ngram, top in tops.items():
+        if len(top) > size:
+            top = dict(heapq.nlargest(size, top.items(), key=itemgetter(1)))
+        pipe.zadd(dbkeys.top_key(ngram), mapping=top)
+        pipe.ztrim(dbkeys.top_key(ngram), size)
+
+
+def deindex_top_documents(pipe, key, removed, tokens):
+    """Remove a document from the best ones of the edge ngrams it does not
+    have anymore."""
+    kept = {
+        ngram
+        for token in set(tokens) - set(removed)
+        for ngram in compute_edge_ngrams(token)
+    }
+    for token in removed:
+        for ngram in compute_edge_ngrams(token):
+            if ngram not in kept:
+                pipe.zrem(dbkeys.top_key(ngram), key)
+
+
+def deindex_edge_ngrams(token, db=None):
+    db = DB if db is None else db
     for ngram in compute_edge_ngrams(token):
-        DB.srem(edge_ngram_key(ngram), token)
+        db.srem(edge_ngram_key(ngram), token)
 
 
 class EdgeNgramIndexer:
     @staticmethod
     def index(pipe, key, doc, tokens, **kwargs):
-        if config.INDEX_EDGE_NGRAMS:  # Allow to disable for mass indexing.
+        if not config.INDEX_EDGE_NGRAMS:  # Allow to disable for mass indexing.
+            return
+        if not config.PREFIX_INDEX:
             for token in tokens.keys():
                 index_edge_ngrams(pipe, token)
+        if config.AUTOCOMPLETE_TOP_K:
+            index_top_documents(pipe, {key: tokens})
 
     @staticmethod
     def deindex(db, key, doc, tokens, **kwargs):
-        if config.INDEX_EDGE_NGRAMS:
-            for token in tokens:
-                tkey = dbkeys.token_key(token)
-                if not DB.exists(tkey):
-                    deindex_edge_ngrams(token)
+        EdgeNgramIndexer.deindex_tokens(db, [(key, tokens, tokens)])
+
+    @staticmethod
+    def deindex_tokens(db, changes, **kwargs):
+        if not config.INDEX_EDGE_NGRAMS:
+            return
+        if config.AUTOCOMPLETE_TOP_K:
+            pipe = db.pipeline(transaction=False)
+            for key, removed, tokens in changes:
+                deindex_top_documents(pipe, key, removed, tokens)
+            pipe.execute()
+        tokens = list({token for _, removed, _ in changes for token in removed})
+        if not tokens or config.PREFIX_INDEX:
+            return
+        # Only the ngrams of the tokens no document has anymore are removed.
+        pipe = db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.exists(dbkeys.token_key(token))
+        exists = pipe.execute()
+        pipe = db.pipeline(transaction=False)
+        for token, exist in zip(tokens, exists):
+            if not exist:
+                deindex_edge_ngrams(token, pipe)
+        pipe.execute()
 
 
 def only_commons_but_geohash_try_autocomplete_collector(helper):
@@ -79,19 +150,44 @@ def autocomplete_meaningful_collector(helper):
 def autocomplete(helper, tokens, skip_commons=False, use_geohash=False):
     helper.debug("Autocompleting %s", helper.last_token)
     keys = [t.db_key for t in tokens if not t.is_last]
-    pair_keys = [pair_key(t) for t in tokens if not t.is_last]
-    key = edge_ngram_key(helper.last_token)
-    autocomplete_tokens = DB.sinter(pair_keys + [key])
-    if not autocomplete_tokens:
-        helper.debug("No candidates. Aborting.")
+    if (
+        config.AUTOCOMPLETE_TOP_K
+        and not keys
+        and not skip_commons
+        and config.MIN_EDGE_NGRAMS <= len(helper.last_token) <= config.MAX_EDGE_NGRAMS
+    ):
+        # One word: its best documents are indexed by edge ngram.
+        if not helper.bucket_overflow or helper.last_token in helper.not_found:
+            helper.debug("Trying to extend bucket. Top of %s", helper.last_token)
+            extra_keys = [dbkeys.top_key(helper.last_token)]
+            if use_geohash and helper.geohash_key:
+                extra_keys.append(helper.geohash_key)
+            helper.add_to_bucket(extra_keys)
         return
-    token_keys = [dbkeys.token_key(t.decode()) for t in autocomplete_tokens]
-    if len(tokens) == 1:
-        helper.debug("Ordering candidates by max score")
-        autocomplete_tokens = scripts.order_by_max_score(keys=token_keys)
+    pair_keys = [pair_key(t) for t in tokens if not t.is_last]
+    index = prefix_index() if config.PREFIX_INDEX else None
+    if index is not None:
+        autocomplete_tokens = index.complete(
+            helper.last_token, pair_keys, by_score=len(tokens) == 1
+        )
+        if not autocomplete_tokens:
+            helper.debug("No candidates. Aborting.")
+            return
     else:
-        helper.debug("Ordering candidates by frequency")
-        autocomplete_tokens = scripts.order_by_frequency(keys=token_keys)
+        if config.PREFIX_INDEX:
+            helper.debug("Prefix index not loaded yet. Using edge ngrams.")
+        key = edge_ngram_key(helper.last_token)
+        autocomplete_tokens = DB.sinter(pair_keys + [key])
+        if not autocomplete_tokens:
+            helper.debug("No candidates. Aborting.")
+            return
+        token_keys = [dbkeys.token_key(t.decode()) for t in autocomplete_tokens]
+        if len(tokens) == 1:
+            helper.debug("Ordering candidates by max score")
+            autocomplete_tokens = scripts.order_by_max_score(keys=token_keys)
+        else:
+            helper.debug("Ordering candidates by frequency")
+            autocomplete_tokens = scripts.order_by_frequency(keys=token_keys)
     helper.debug(
         "Found tokens to autocomplete [%s, …]", b", ".join(autocomplete_tokens[:10])
     )
@@ -108,15 +204,158 @@ def autocomplete(helper, tokens, skip_commons=False, use_geohash=False):
             helper.add_to_bucket(keys + extra_keys)
 
 
-def index_ngram_keys(*keys):
-    pipe = DB.pipeline(transaction=False)
+class PrefixIndex:
+    """Sorted tokens of a Redis index, with their frequency and max score, to
+    find and order the autocomplete candidates in memory (see PREFIX_INDEX)."""
+
+    def __init__(self, generation, entries):
+        entries = sorted(entries)
+        self.generation = generation
+        self.checked = time.monotonic()
+        self.tokens = [token for token, _, _ in entries]
+        self.frequencies = array("Q", (frequency for _, frequency, _ in entries))
+        self.scores = array("d", (score for _, _, score in entries))
+
+    @classmethod
+    def load(cls, db):
+        generation = db.get(IMPORT_GENERATION_KEY)
+        pattern = "{}*".format(dbkeys.TOKEN_PREFIX)
+        entries = []
+        chunk = []
+        for key in db.scan_iter(match=pattern, count=SCAN_COUNT):
+            chunk.append(key)
+            if len(chunk) >= NGRAMS_CHUNK_SIZE:
+                entries.extend(token_stats(db, chunk))
+                chunk = []
+        entries.extend(token_stats(db, chunk))
+        return cls(generation, entries)
+
+    def candidates(self, prefix):
+        """Return the positions of the tokens `prefix` is an edge ngram of."""
+        if not config.MIN_EDGE_NGRAMS <= len(prefix) <= config.MAX_EDGE_NGRAMS:
+            return []
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + chr(0x10FFFF), lo=start)
+        return [i for i in range(start, end) if len(self.tokens[i]) > len(prefix)]
+
+    def complete(self, prefix, pair_keys, by_score=False):
+        """Return the keys of the tokens completing `prefix` and paired with
+        all `pair_keys`, by decreasing max score or frequency."""
+        candidates = self.candidates(prefix)
+        if pair_keys and candidates:
+            # One round-trip, instead of SINTER then ordering script.
+            members = [self.tokens[i] for i in candidates]
+            pipe = DB.pipeline(transaction=False)
+            for key in pair_keys:
+                pipe.smismember(key, members)
+            paired = [all(flags) for flags in zip(*pipe.execute())]
+            candidates = [i for i, keep in zip(candidates, paired) if keep]
+        values = self.scores if by_score else self.frequencies
+        candidates.sort(key=values.__getitem__, reverse=True)
+        return [dbkeys.token_key(self.tokens[i]).encode() for i in candidates]
+
+    def check_due(self):
+        """Tell if the import generation has not been checked for more than
+        FREQUENCY_CACHE_CHECK_INTERVAL seconds."""
+        elapsed = time.monotonic() - self.checked
+        return elapsed >= config.FREQUENCY_CACHE_CHECK_INTERVAL
+
+
+def token_stats(db, keys):
+    """Yield the token, frequency and max score of each token key."""
+    pipe = db.pipeline(transaction=False)
+    for key in keys:
+        pipe.zcard(key)
+        pipe.zrevrange(key, 0, 0, withscores=True)
+    results = pipe.execute()
+    for key, frequency, top in zip(keys, results[::2], results[1::2]):
+        token = key.decode()[len(dbkeys.TOKEN_PREFIX) :]
+        if not token.isdigit():
+            yield token, frequency, top[0][1] if top else 0.0
+
+
+_PREFIX_INDEXES = {}  # Primary or shard client id => PrefixIndex.
+_PREFIX_LOADS = {}  # Primary or shard client id => thread loading its index.
+_PREFIX_INDEXES_LOCK = threading.Lock()
+
+
+def prefix_index(wait=False):
+    """Return the prefix index of the current Redis index, or None while it is
+    loaded for the first time (see `warm_prefix_indexes`), unless `wait`.
+
+    Once an import has ended (see `bump_import_generation`), it is reloaded in
+    a background thread, the previous one being used meanwhile. Replicas share
+    the index of their primary."""
+    client = DB.instance if DB.current in DB.replicas else DB.current
+    index = _PREFIX_INDEXES.get(id(client))
+    if index is None:
+        loading = _load_prefix_index(client)
+        if not wait:
+            return None
+        loading.join()
+        return _PREFIX_INDEXES.get(id(client))
+    if index.check_due():
+        index.checked = time.monotonic()
+        if DB.get(IMPORT_GENERATION_KEY) != index.generation:
+            _load_prefix_index(client)
+    return index
+
+
+def _load_prefix_index(client):
+    """Start loading the index of `client` in a background thread, unless it
+    is already being loaded, and return this thread."""
+    db = DB.current  # Maybe a replica of `client`.
+
+    def load():
+        try:
+            index = PrefixIndex.load(db)
+            with _PREFIX_INDEXES_LOCK:
+                _PREFIX_INDEXES[id(client)] = index
+        finally:
+            with _PREFIX_INDEXES_LOCK:
+                del _PREFIX_LOADS[id(client)]
+
+    with _PREFIX_INDEXES_LOCK:
+        if id(client) not in _PREFIX_LOADS:
+            thread = threading.Thread(target=load, daemon=True)
+            _PREFIX_LOADS[id(client)] = thread
+            thread.start()
+        return _PREFIX_LOADS[id(client)]
+
+
+def warm_prefix_indexes():
+    """Load the prefix index of each shard, so no search has to wait for it."""
+    for shard in DB.shards or [DB.instance]:
+        with DB.using(shard):
+            prefix_index(wait=True)
+
+
+def flush_prefix_indexes():
+    with _PREFIX_INDEXES_LOCK:
+        loading = list(_PREFIX_LOADS.values())
+    for thread in loading:
+        thread.join()
+    with _PREFIX_INDEXES_LOCK:
+        _PREFIX_INDEXES.clear()
+
+
+def index_ngram_keys(*keys, shard=None):
+    # Ngrams are stored on the shard of their tokens.
+    db = DB if shard is None else DB.shards[shard]
+    # Tokens are aggregated by ngram, written by one variadic SADD each.
+    pipe = offline.Postings(shard, client=db)
+    tokens = []
     for key in keys:
         key = key.decode()
         _, token = key.split("|")
         if token.isdigit():
             continue
-        index_edge_ngrams(pipe, token)
+        tokens.append(token)
+        if not config.PREFIX_INDEX:
+            index_edge_ngrams(pipe, token)
     try:
+        if config.AUTOCOMPLETE_TOP_K:
+            index_top_documents(pipe, top_documents(db, tokens))
         pipe.execute()
     except redis.RedisError as e:
         msg = "Error while generating ngrams:\n{}".format(str(e))
@@ -124,11 +363,70 @@ def index_ngram_keys(*keys):
     return keys
 
 
-def create_edge_ngrams(*args):
+def top_documents(db, tokens):
+    """Return the scores of the best documents of each token, by document."""
+    scores = {}
+    pipe = db.pipeline(transaction=False)
+    for token in tokens:
+        pipe.zrevrange(
+            dbkeys.token_key(token), 0, config.AUTOCOMPLETE_TOP_K - 1, withscores=True
+        )
+    for token, top in zip(tokens, pipe.execute()):
+        for key, score in top:
+            scores.setdefault(key.decode(), {})[token] = score
+    return scores
+
+
+def scan_partition(db, partition, match=None):
+    """Iterate over the keys of a `partition` of `db` (among SCAN_PARTITIONS).
+
+    SCAN walks the buckets in the order of their reversed cursor bits, so the
+    cursors of a contiguous range of buckets share their lowest bits: each
+    partition starts at its own cursor and ends when those bits change. Keys
+    may be returned twice (like with SCAN), never missed."""
+    bits = SCAN_PARTITIONS.bit_length() - 1
+    mask = SCAN_PARTITIONS - 1
+    start = int(format(partition, "0{}b".format(bits))[::-1], 2) if bits else 0
+    cursor = start
+    while True:
+        cursor, keys = db.scan(cursor=cursor, match=match, count=SCAN_COUNT)
+        yield from keys
+        if not cursor or cursor & mask != start:
+            return
+
+
+def index_ngram_partitions(*partitions, shard=None):
+    """Index the ngrams of the tokens of each SCAN partition: each worker
+    scans its own part of the keyspace."""
+    db = DB if shard is None else DB.shards[shard]
     pattern = "{}*".format(dbkeys.TOKEN_PREFIX)
-    parallelize(
-        index_ngram_keys, DB.scan_iter(match=pattern), chunk_size=10000, throttle=1000
-    )
+    count = 0
+    for partition in partitions:
+        chunk = []
+        for key in scan_partition(db, partition, match=pattern):
+            chunk.append(key)
+            if len(chunk) >= NGRAMS_CHUNK_SIZE:
+                count += len(index_ngram_keys(*chunk, shard=shard))
+                chunk = []
+        count += len(index_ngram_keys(*chunk, shard=shard))
+    return count
+
+
+def create_edge_ngrams(*args):
+    if config.PREFIX_INDEX and not config.AUTOCOMPLETE_TOP_K:
+        print("Edge ngrams are not needed with PREFIX_INDEX.")
+        return
+    if not DB.shards:
+        parallelize(
+            index_ngram_partitions, range(SCAN_PARTITIONS), chunk_size=1, throttle=1000
+        )
+    for index, shard in enumerate(DB.shards):
+        parallelize(
+            partial(index_ngram_partitions, shard=index),
+            range(SCAN_PARTITIONS),
+            chunk_size=1,
+            throttle=1000,
+        )
 
 
 def register_command(subparsers):
@@ -139,10 +437,21 @@ def register_command(subparsers):
 def do_AUTOCOMPLETE(cmd, s):
     """Shows autocomplete results for a given token."""
     s = list(preprocess_query(s))[0]
-    keys = [k.decode() for k in DB.smembers(edge_ngram_key(s))]
+    index = prefix_index(wait=True) if config.PREFIX_INDEX else None
+    if index is not None:
+        keys = [index.tokens[i] for i in index.candidates(s)]
+    else:
+        keys = [k.decode() for k in DB.smembers(edge_ngram_key(s))]
     print(white(keys))
     print(magenta("({} elements)".format(len(keys))))
 
 
+def register_http_endpoint(api):
+    if config.PREFIX_INDEX:
+        warm_prefix_indexes()
+
+
 def register_shell_command(cmd):
     cmd.register_command(do_AUTOCOMPLETE)
+    if config.PREFIX_INDEX:
+        warm_prefix_indexes()
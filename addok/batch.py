@@ -1,25 +1,51 @@
-import json
 import os.path
+import shutil
 import sys
+import tempfile
 from datetime import timedelta
+from itertools import islice
 
 from addok.config import config
 from addok.db import DB
 from addok.ds import DS
-from addok.helpers import iter_pipe, parallelize, yielder
+from addok.helpers import (
+    fastjson,
+    file_ranges,
+    import_by_path,
+    iter_pipe,
+    offline,
+    parallelize,
+    yielder,
+)
+from addok.helpers.index import bump_import_generation
 
 
 def run(args):
-    if args.filepath:
-        for path in args.filepath:
-            process_file(path)
-    elif not sys.stdin.isatty():  # Any better way to check for stdin?
-        process_stdin(sys.stdin)
+    if args.resp:
+        # Runs are written next to the output, which should have room.
+        config.OFFLINE_INDEX_DIR = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(args.resp))
+        )
+    try:
+        if args.filepath:
+            for path in args.filepath:
+                process_file(path)
+        elif not sys.stdin.isatty():  # Any better way to check for stdin?
+            process_stdin(sys.stdin)
+        bump_import_generation()
+        if args.resp:
+            count = offline.write_resp(args.resp, shards=len(DB.shards) or 1)
+            print("Wrote {} commands to {}".format(count, args.resp))
+    finally:
+        if args.resp:
+            shutil.rmtree(config.OFFLINE_INDEX_DIR)
+            config.OFFLINE_INDEX_DIR = None
 
 
 def reset(args):
     if args.force or input('Type "yes" to delete ALL data: ') == "yes":
-        DB.flushdb()
+        for _ in DB.each_shard():
+            DB.flushdb()
         DS.flushdb()
         print("All data has been deleted.")
     else:
@@ -29,10 +55,50 @@ def reset(args):
 def register_command(subparsers):
     parser = subparsers.add_parser("batch", help="Batch import documents")
     parser.add_argument("filepath", nargs="*", help="Path to file to process")
+    parser.add_argument(
+        "--resp",
+        metavar="PATH",
+        help="Write the indexes to PATH as Redis commands, to be loaded with "
+        "`redis-cli --pipe`, instead of writing them to Redis",
+    )
     parser.set_defaults(func=run)
     parser = subparsers.add_parser("reset", help="Delete ALL indexes and documents")
     parser.add_argument("--force", help="Do not ask for confirm", action="store_true")
     parser.set_defaults(func=reset)
+    parser = subparsers.add_parser(
+        "reencode", help="Store again documents with current serializer"
+    )
+    parser.add_argument(
+        "--source",
+        help="Python path of the serializer documents are currently stored "
+        "with (default: DOCUMENT_SERIALIZER)",
+    )
+    parser.set_defaults(func=reencode)
+
+
+def reencode(args):
+    if not hasattr(DS, "scan"):
+        sys.stderr.write("Document store does not allow to iterate documents.\n")
+        sys.exit(1)
+    source = import_by_path(args.source) if args.source else config.DOCUMENT_SERIALIZER
+    serializer = config.DOCUMENT_SERIALIZER
+    keys = DS.scan()
+    chunk = list(islice(keys, config.BATCH_CHUNK_SIZE))
+    if hasattr(serializer, "train") and chunk:
+        # Documents are the corpus to train with.
+        if not serializer.train([source.loads(b) for _, b in DS.fetch(*chunk)]):
+            print("Not enough documents to train the serializer.")
+    count = 0
+    while chunk:
+        DS.upsert(
+            *(
+                (key, serializer.dumps(source.loads(blob)))
+                for key, blob in DS.fetch(*chunk)
+            )
+        )
+        count += len(chunk)
+        chunk = list(islice(keys, config.BATCH_CHUNK_SIZE))
+    print("Reencoded {} documents.".format(count))
 
 
 def process_file(filepath):
@@ -42,7 +108,17 @@ def process_file(filepath):
         sys.stderr.write("File not found: {}".format(filepath))
         sys.exit(1)
     config.INDEX_EDGE_NGRAMS = False  # Run command "ngrams" instead.
-    batch(config.BATCH_FILE_LOADER(filepath))
+    if config.BATCH_FILE_RANGE_SIZE:
+        # Each worker reads its own part of the file.
+        ranges = getattr(config.BATCH_FILE_LOADER, "file_ranges", file_ranges)
+        parallelize(
+            process_ranges,
+            ranges(filepath, config.BATCH_FILE_RANGE_SIZE),
+            chunk_size=1,
+            throttle=timedelta(seconds=1),
+        )
+    else:
+        batch(config.BATCH_FILE_LOADER(filepath))
 
 
 def process_stdin(stdin):
@@ -53,7 +129,7 @@ def process_stdin(stdin):
 @yielder
 def to_json(row):
     try:
-        return json.loads(row)
+        return fastjson.loads(row)
     except ValueError:
         return None
 
@@ -62,6 +138,19 @@ def process_documents(*docs):
     return list(iter_pipe(docs, config.BATCH_PROCESSORS))
 
 
+def process_ranges(*ranges):
+    """Load and process the given `(filepath, start, end)` byte ranges, by
+    chunks. Return the number of processed documents."""
+    count = 0
+    for filepath, start, end in ranges:
+        rows = config.BATCH_FILE_LOADER(filepath, start, end)
+        chunk = list(islice(rows, config.BATCH_CHUNK_SIZE))
+        while chunk:
+            count += len(process_documents(*chunk))
+            chunk = list(islice(rows, config.BATCH_CHUNK_SIZE))
+    return count
+
+
 def batch(iterable):
     parallelize(
         process_documents,
@@ -0,0 +1,123 @@
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from addok.config import config
+from addok.db import DB, RedisProxy
+from addok.helpers.index import GENERATION_KEY
+
+
+class MemoryCache:
+    """In-process LRU cache, one per worker."""
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expire, blob = self._data[key]
+            except KeyError:
+                return None
+            if expire < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return blob
+
+    def set(self, key, blob, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, blob)
+            self._data.move_to_end(key)
+            while len(self._data) > config.RESULTS_CACHE_SIZE:
+                self._data.popitem(last=False)
+
+
+class RedisCache:
+    """Cache shared by all the workers, in a Redis database."""
+
+    def get(self, key):
+        return _DB.get(key)
+
+    def set(self, key, blob, ttl):
+        _DB.set(key, blob, ex=ttl)
+
+
+class CacheProxy:
+    instance = None
+    hits = 0
+    misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __bool__(self):
+        return self.instance is not None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_DB = RedisProxy()
+CACHE = CacheProxy()
+
+
+@config.on_load
+def on_load():
+    CACHE.instance = config.RESULTS_CACHE() if config.RESULTS_CACHE else None
+    # Do not create connection if not using this cache class.
+    if config.RESULTS_CACHE == RedisCache:
+        params = config.REDIS.copy()
+        params.update(config.REDIS.get("indexes", {}))
+        params.update(config.REDIS.get("cache", {}))
+        _DB.connect(
+            host=params.get("host"),
+            port=params.get("port"),
+            db=params.get("db"),
+            password=params.get("password"),
+            unix_socket_path=params.get("unix_socket_path"),
+        )
+
+
+def round_coordinate(value):
+    if value is None:
+        return None
+    return round(float(value), config.RESULTS_CACHE_COORDINATES_PRECISION)
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def normalize_filters(filters):
+    normalized = []
+    for name, values in sorted(filters.items()):
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        values = sorted(set(str(v).strip() for v in values if str(v).strip()))
+        if values:
+            normalized.append((name, tuple(values)))
+    return tuple(normalized)
+
+
+def make_key(*args):
+    # The index generation is part of the key, so any import invalidates
+    # the whole cache.
+    generation = DB.get(GENERATION_KEY)
+    digest = hashlib.sha1(repr((generation,) + args).encode()).hexdigest()
+    return "c|{}".format(digest)
+
+
+def cached(key, compute):
+    """Return cached results for `key`, or compute and cache them."""
+    blob = CACHE.get(key)
+    if blob is not None:
+        CACHE.hits += 1
+        return pickle.loads(blob)
+    CACHE.misses += 1
+    results = compute()
+    CACHE.set(key, pickle.dumps(results), config.RESULTS_CACHE_TTL)
+    return results
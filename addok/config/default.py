@@ -29,6 +29,12 @@ MAX_FILTER_VALUES = 10
 # Above this threshold, terms are considered commons.
 COMMON_THRESHOLD = 10000
 
+# Max number of token frequencies cached by each worker (0 to disable).
+FREQUENCY_CACHE_SIZE = 50000
+# Max seconds between two checks of the index generation, when all the
+# frequencies of a search are cached.
+FREQUENCY_CACHE_CHECK_INTERVAL = 1
+
 # Above this threshold, we avoid intersecting sets.
 INTERSECT_LIMIT = 100000
 
@@ -40,6 +46,9 @@ MIN_SCORE = 0.1
 
 QUERY_MAX_LENGTH = 200
 
+# Max number of queries accepted by the /search/batch endpoint.
+SEARCH_BATCH_MAX_SIZE = 1000
+
 GEOHASH_PRECISION = 7
 
 MIN_EDGE_NGRAMS = 3
@@ -67,11 +76,21 @@ SEARCH_PREPROCESSORS_PYPATHS = [
 BATCH_PROCESSORS_PYPATHS = [
     "addok.batch.to_json",
     "addok.helpers.index.prepare_housenumbers",
+    "addok.helpers.index.skip_unchanged",
     "addok.ds.store_documents",
     "addok.helpers.index.index_documents",
 ]
 BATCH_FILE_LOADER_PYPATH = "addok.helpers.load_file"
+# Split imported files in byte ranges of this size, read by the workers
+# themselves instead of the main process (None to disable).
+BATCH_FILE_RANGE_SIZE = None
 BATCH_CHUNK_SIZE = 1000
+# Skip imported documents that have not changed since their last import, and
+# only write the index differences of the changed ones.
+BATCH_DIFF = False
+# Set by `addok batch --resp`: directory of the sorted runs written by the
+# workers instead of writing to Redis (see `addok.helpers.offline`).
+OFFLINE_INDEX_DIR = None
 # During imports, workers are consuming RAM;
 # let one process free for Redis by default.
 BATCH_WORKERS = max(os.cpu_count() - 1, 1)
@@ -114,13 +133,34 @@ INDEXERS_PYPATHS = [
     "addok.pairs.PairsIndexer",
     # Edge ngram indexer must be after `FieldsIndexer`.
     "addok.autocomplete.EdgeNgramIndexer",
+    # Deletes indexer must be after `FieldsIndexer`.
+    "addok.fuzzy.DeletesIndexer",
     "addok.helpers.index.FiltersIndexer",
     "addok.helpers.index.GeohashIndexer",
 ]
+# Cache of search and reverse results, None to disable. Available backends
+# are `addok.cache.MemoryCache` (per worker) and `addok.cache.RedisCache`.
+RESULTS_CACHE_PYPATH = None
+RESULTS_CACHE_TTL = 60  # In seconds.
+RESULTS_CACHE_SIZE = 10000  # Max entries per worker for MemoryCache.
+# Coordinates are rounded before searching, so close centers share results.
+RESULTS_CACHE_COORDINATES_PRECISION = 4
+
 # Any object like instance having `loads` and `dumps` methods.
 DOCUMENT_SERIALIZER_PYPATH = "addok.helpers.serializers.ZlibSerializer"
+# Settings of `addok.helpers.serializers.MsgpackZstdSerializer`.
+ZSTD_LEVEL = 3
+ZSTD_DICTIONARY_SIZE = 112640  # In bytes.
+ZSTD_DICTIONARY_SAMPLES = 2000  # Documents used to train the dictionary.
 
 DOCUMENT_STORE_PYPATH = "addok.ds.RedisStore"
+# Directory of the files of `addok.ds.MmapStore` and `addok.ds.LMDBStore`.
+DOCUMENTS_DIR = os.environ.get(
+    "ADDOK_DOCUMENTS_DIR", Path(__file__).parent.parent.parent / "documents"
+)
+# Max size of the `addok.ds.LMDBStore` database (disk space is only used when
+# needed).
+LMDB_MAP_SIZE = 2**36  # In bytes.
 
 # Fields to be indexed
 # If you want a housenumbers field but need to name it differently, just add
@@ -140,6 +180,9 @@ ID_FIELD = "_id"
 
 # Sometimes you only want to add some fields keeping the default ones.
 EXTRA_FIELDS = []
+# Store housenumbers in the indexes database, apart from their street document,
+# so only the searched ones are loaded. Needs a reimport when changed.
+SPLIT_HOUSENUMBERS = False
 
 # Weight of a document own importance:
 IMPORTANCE_WEIGHT = 0.1
@@ -168,6 +211,14 @@ LOG_NOT_FOUND = False
 SLOW_QUERIES = False  # False or time in ms to consider query as slow
 
 INDEX_EDGE_NGRAMS = True
+# Find autocomplete candidates in each worker memory instead of edge ngrams.
+PREFIX_INDEX = False
+# Index the tokens by their deletes, to find fuzzy neighbours without trying
+# all of them.
+FUZZY_DELETES_INDEX = False
+# Number of best documents kept by edge ngram, for one word autocomplete (0 to
+# disable).
+AUTOCOMPLETE_TOP_K = 0
 
 # surrounding letters on a standard keyboard (default french azerty)
 FUZZY_KEY_MAP = {
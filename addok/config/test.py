@@ -1,2 +1,4 @@
 # Just to test that keys from a local file are loaded.
 COMMON_THRESHOLD = 1000
+# Tests change the index between searches.
+FREQUENCY_CACHE_CHECK_INTERVAL = 0
@@ -1,14 +1,28 @@
-import hashlib
 import re
 import uuid
 import time
 
 import geohash
 
+from .cache import (
+    CACHE,
+    cached,
+    make_key,
+    normalize_filters,
+    normalize_query,
+    round_coordinate,
+)
 from .config import config
-from .db import DB
-from .ds import get_document, get_documents
+from .db import DB, reading
+from .ds import DS, decode_documents, get_document, get_documents
 from .helpers import keys as dbkeys, scripts
+from .helpers.index import token_key_frequencies
+from .helpers.results import (
+    housenumber_token,
+    load_housenumbers,
+    load_housenumbers_around,
+)
+from .helpers.search import preprocess_query
 from .helpers.text import ascii
 
 REDIS_UNIQUE_ID = str(uuid.uuid4())  # Really unique id for tmp values in redis.
@@ -19,16 +33,19 @@ def compute_geohash_key(geoh, with_neighbors=True):
         neighbors = geohash.expand(geoh)
         neighbors = [dbkeys.geohash_key(n) for n in neighbors]
     else:
-        neighbors = [geoh]
-    key = "gx|{}".format(geoh)
-    total = DB.sunionstore(key, neighbors)
-    if not total:
-        # No need to keep it.
-        DB.delete(key)
-        key = False
-    else:
-        DB.expire(key, 10)
-    return key
+        neighbors = [dbkeys.geohash_key(geoh)]
+    if not DB.exists(*neighbors):
+        return False
+    return dbkeys.UnionKey("gx|{}".format(geoh), neighbors)
+
+
+def intersect_keys(keys, limit=0):
+    """Return the members of the intersection of `keys` (which may be
+    `UnionKey`s), by decreasing score, `limit` at most (0 for all).
+
+    Nothing is written, so it can run on read-only replicas."""
+    keys, args = dbkeys.flatten(keys)
+    return scripts.zinter(keys=keys, args=[REDIS_UNIQUE_ID, limit, *args])
 
 
 class Result:
@@ -49,6 +66,9 @@ class Result:
         self._doc = doc
 
     def __getattr__(self, key):
+        if key.startswith("__"):
+            # Python internals (eg. pickle protocol), not a document field.
+            raise AttributeError(key)
         if key == "_id":
             # result._id should load the id whatever the real field used.
             key = config.ID_FIELD
@@ -175,10 +195,11 @@ class BaseHelper:
         return sorted(unique_values[:config.MAX_FILTER_VALUES])
 
     def _compute_multifilter(self, filter_name, values):
-        """Create temporary Redis key for OR filter using SUNIONSTORE.
+        """Return the union key for an OR filter.
 
         Example: type=["street", "city"] matches documents where type is "street" OR "city".
-        Result is cached (10s) or persisted if large (>100k items).
+        The union is not stored, but checked by the scripts reading it (see
+        `UnionKey`).
 
         Args:
             filter_name: Filter field name (e.g., "type")
@@ -190,20 +211,10 @@ class BaseHelper:
         # Create a stable key based on sorted values (use | as internal separator)
         normalized_value = '|'.join(values)
         key = dbkeys.filter_key(filter_name, normalized_value)
-
-        if not DB.exists(key):
-            self.debug(f'MultiFilter created: {filter_name}={normalized_value}')
-            keys = [dbkeys.filter_key(filter_name, v) for v in values]
-            DB.sunionstore(key, keys)
-
-        # Persist large filters, expire small ones
-        if DB.scard(key) > 100000:
-            DB.persist(key)
-            self.debug(f'MultiFilter persistent: {filter_name}={normalized_value}')
-        else:
-            DB.expire(key, 10)
-
-        return key
+        self.debug(f'MultiFilter: {filter_name}={normalized_value}')
+        return dbkeys.UnionKey(
+            key, [dbkeys.filter_key(filter_name, v) for v in values]
+        )
 
     def _build_filters(self, filters):
         """Build filter keys from list-based filter parameters.
@@ -241,46 +252,31 @@ class BaseHelper:
                 filter_key = self._compute_multifilter(k, normalized_values)
                 filter_keys.append(filter_key)
 
-        # Combine with AND logic if multiple filters
-        if len(filter_keys) > 1:
-            return self._combine_filters_with_keys(filter_keys)
-
+        # Multiple filters are combined with AND logic by the intersections.
         return filter_keys
 
-    def _combine_filters_with_keys(self, filter_keys):
-        """Combine filter keys with AND logic using Redis SINTERSTORE.
-
-        Args:
-            filter_keys: List of filter keys to combine
-
-        Returns:
-            List containing a single combined filter key
-        """
-        # Use a stable hash instead of repr() for the cache key
-        filter_string = '|'.join(sorted(filter_keys))
-        key_hash = hashlib.md5(filter_string.encode()).hexdigest()
-        key = f"combined:{key_hash}"
-
-        if not DB.exists(key):
-            self.debug(f'Combined filter: {filter_string}')
-            DB.sinterstore(key, filter_keys)
-
-        DB.expire(key, 10)
-        return [key]
-
 
 class Search(BaseHelper):
 
     MAX_MEANINGFUL = 10
 
-    def __init__(self, fuzzy=1, limit=10, autocomplete=True, verbose=False):
+    def __init__(
+        self, fuzzy=1, limit=10, autocomplete=True, verbose=False, frequencies=None
+    ):
         super().__init__(verbose=verbose)
         self.fuzzy = fuzzy
         self.wanted = limit
         self.autocomplete = autocomplete
         self.pid = REDIS_UNIQUE_ID
+        # Token frequencies already known by the caller (see `search_many`).
+        self.frequencies = frequencies or {}
 
     def __call__(self, query, lat=None, lon=None, **filters):
+        self.setup(query, lat=lat, lon=lon, **filters)
+        self.collect()
+        return list(self.render())
+
+    def setup(self, query, lat=None, lon=None, **filters):
         self.lat = lat
         self.lon = lon
         self._geohash_key = None
@@ -307,11 +303,11 @@ class Search(BaseHelper):
 
         self.debug('Filters: %s', [f'{k}={v}' for k, v in filters.items()])
 
+    def collect(self):
         for collector in config.RESULTS_COLLECTORS:
             self.debug("** %s **", collector.__name__.upper())
             if collector(self):
                 break
-        return list(self.render())
 
     @property
     def geohash_key(self):
@@ -324,8 +320,8 @@ class Search(BaseHelper):
                 self.debug("Empty geohash key, deleting %s", self._geohash_key)
         return self._geohash_key
 
-    def render(self):
-        self.convert()
+    def render(self, blobs=None):
+        self.convert(blobs)
         self._sorted_bucket = list(self.results.values())
         self._sorted_bucket.sort(key=lambda r: r.score, reverse=True)
         for result in self._sorted_bucket[: self.wanted]:
@@ -343,17 +339,21 @@ class Search(BaseHelper):
                 keys.extend(self.filters)
             if len(keys) == 1:
                 key = keys[0]
-                if key.startswith(dbkeys.TOKEN_PREFIX):
+                if isinstance(key, dbkeys.UnionKey):
+                    ids = DB.sunion(key.keys)
+                elif key.startswith((dbkeys.TOKEN_PREFIX, dbkeys.TOP_PREFIX)):
                     ids = DB.zrevrange(key, 0, limit - 1)
                 else:
                     ids = DB.smembers(key)
             else:
-                ids = scripts.zinter(keys=set(keys), args=[self.pid, limit])
+                ids = intersect_keys(set(keys), limit)
         return set(ids)
 
     def add_to_bucket(self, keys, limit=None):
         self.debug("Adding to bucket with keys %s", keys)
-        self.matched_keys.update([k for k in keys if k.startswith(dbkeys.TOKEN_PREFIX)])
+        self.matched_keys.update(
+            [k for k in keys if k.startswith((dbkeys.TOKEN_PREFIX, dbkeys.TOP_PREFIX))]
+        )
         limit = limit or (config.BUCKET_MAX - len(self.bucket))
         self.bucket.update(self.intersect(keys, limit))
         self.debug("%s ids in bucket so far", len(self.bucket))
@@ -364,14 +364,21 @@ class Search(BaseHelper):
         self.bucket = self.intersect(keys, limit)
         self.debug("%s ids in bucket so far", len(self.bucket))
 
-    def convert(self):
+    def convert(self, blobs=None):
         self.debug("Computing results")
         ids = [i for i in self.bucket if i not in self.results]
         if ids:
-            documents = get_documents(*ids)
+            if blobs is None:
+                documents = get_documents(*ids)
+            else:
+                documents = decode_documents(blobs, *ids)
             self.debug("Done getting results data")
-            for _id, doc in documents:
-                result = Result(doc)
+            documents = [(_id, Result(doc)) for _id, doc in documents]
+            if config.SPLIT_HOUSENUMBERS and self.check_housenumber:
+                token = housenumber_token(self)
+                if token:
+                    load_housenumbers([r for _, r in documents], [token])
+            for _id, result in documents:
                 for processor in config.SEARCH_RESULT_PROCESSORS:
                     valid = processor(self, result)
                     if valid is False:
@@ -466,14 +473,16 @@ class Reverse(BaseHelper):
 
     def intersect(self, key):
         if self.filters:
-            keys = DB.sinter([key] + self.filters)
+            keys = intersect_keys([key] + self.filters)
         else:
             keys = DB.smembers(key)
         self.keys.update(keys)
 
     def convert(self):
-        for _id in self.keys:
-            result = Result(_id)
+        results = [Result(_id) for _id in self.keys]
+        if config.SPLIT_HOUSENUMBERS and self.check_housenumber:
+            load_housenumbers_around(results, self.fetched)
+        for result in results:
             for processor in config.REVERSE_RESULT_PROCESSORS:
                 valid = processor(self, result)
                 if valid is False:
@@ -486,6 +495,37 @@ class Reverse(BaseHelper):
         return self.results[: self.wanted]
 
 
+def merge_results(shards_results, limit):
+    """Merge the results lists computed on each shard."""
+    if len(shards_results) == 1:
+        return shards_results[0]
+    results = [result for results in shards_results for result in results]
+    results.sort(key=lambda r: r.score, reverse=True)
+    return results[:limit]
+
+
+def center_shards(lat, lon):
+    """Return the shards covering the area around a center, or None for all
+    of them."""
+    if lat is None or lon is None or not DB.geo_sharded:
+        return None
+    geoh = geohash.encode(float(lat), float(lon), config.GEOHASH_PRECISION)
+    return DB.covering(geohash.expand(geoh))
+
+
+def gather(run, limit, lat=None, lon=None):
+    """Run `run` on the shards covering the center (if any), or on the other
+    ones if they found nothing, and merge their results."""
+    shards = center_shards(lat, lon)
+    results = merge_results(DB.scatter(run, shards), limit)
+    if not results and shards is not None:
+        others = [shard for shard in DB.shards if shard not in shards]
+        if others:
+            results = merge_results(DB.scatter(run, others), limit)
+    return results
+
+
+@reading()
 def search(
     query,
     fuzzy=1,
@@ -496,15 +536,125 @@ def search(
     verbose=False,
     **filters
 ):
-    helper = Search(
-        fuzzy=fuzzy,
-        limit=limit,
-        verbose=verbose,
-        autocomplete=autocomplete,
-    )
-    return helper(query, lat=lat, lon=lon, **filters)
+    if CACHE and not verbose:
+        lat, lon = round_coordinate(lat), round_coordinate(lon)
+
+    def compute():
+        def run():
+            helper = Search(
+                fuzzy=fuzzy,
+                limit=limit,
+                verbose=verbose,
+                autocomplete=autocomplete,
+            )
+            return helper(query, lat=lat, lon=lon, **filters)
+
+        return gather(run, limit, lat, lon)
+
+    if CACHE and not verbose:
+        key = make_key(
+            "search",
+            normalize_query(query),
+            fuzzy,
+            limit,
+            bool(autocomplete),
+            lat,
+            lon,
+            normalize_filters(filters),
+        )
+        return cached(key, compute)
+    return compute()
+
+
+@reading()
+def search_many(queries, fuzzy=1, limit=10, autocomplete=False, verbose=False):
+    """Run many searches, sharing Redis round-trips between them.
+
+    Each query is either a string or a dict of `search` keyword arguments
+    (with at least a `query` key). Returns a list of results lists, in the
+    same order as the queries.
+    """
+    queries = [{"query": q} if isinstance(q, str) else dict(q) for q in queries]
+
+    def run(targets):
+        # Only the queries whose center is covered by the current shard.
+        indexes = [
+            i
+            for i, shards in enumerate(targets)
+            if shards is None or DB.current in shards
+        ]
+        if not indexes:
+            return {}
+        # Resolve the tokens of the whole batch at once.
+        tokens = set()
+        for i in indexes:
+            tokens.update(preprocess_query(ascii(queries[i]["query"].strip())))
+        tokens = list(tokens)
+        keys = [dbkeys.token_key(t) for t in tokens]
+        frequencies = dict(zip(tokens, token_key_frequencies(keys, sync=True)))
+        helpers = []
+        for i in indexes:
+            params = dict(queries[i])
+            helper = Search(
+                fuzzy=params.pop("fuzzy", fuzzy),
+                limit=params.pop("limit", limit),
+                autocomplete=params.pop("autocomplete", autocomplete),
+                verbose=verbose,
+                frequencies=frequencies,
+            )
+            helpers.append((helper, params))
+        for helper, params in helpers:
+            helper.setup(**params)
+            helper.collect()
+        # Fetch the documents of all the buckets at once.
+        ids = set()
+        for helper, _ in helpers:
+            ids.update(i for i in helper.bucket if i not in helper.results)
+        blobs = dict(DS.fetch(*ids)) if ids else {}
+        return {
+            i: list(helper.render(blobs)) for i, (helper, _) in zip(indexes, helpers)
+        }
+
+    def collect(targets):
+        shards_results = DB.scatter(lambda: run(targets))
+        return [
+            merge_results(
+                [results[i] for results in shards_results if i in results],
+                params.get("limit", limit),
+            )
+            for i, params in enumerate(queries)
+        ]
+
+    targets = [center_shards(q.get("lat"), q.get("lon")) for q in queries]
+    results = collect(targets)
+    # Like `gather`, retry on the other shards the centered queries that found
+    # nothing.
+    retry = [
+        None if found or shards is None else [s for s in DB.shards if s not in shards]
+        for found, shards in zip(results, targets)
+    ]
+    if any(retry):
+        retried = collect([shards or [] for shards in retry])
+        results = [
+            new if shards else old
+            for old, new, shards in zip(results, retried, retry)
+        ]
+    return results
+
+
+@reading()
+def reverse(lat, lon, limit=1, verbose=False, **filters):
+    if CACHE and not verbose:
+        lat, lon = round_coordinate(lat), round_coordinate(lon)
 
+    def compute():
+        def run():
+            helper = Reverse(verbose=verbose)
+            return helper(lat, lon, limit, **filters)
 
-def reverse(lat, lon, limit=1, verbose=False, **filters):
-    helper = Reverse(verbose=verbose)
-    return helper(lat, lon, limit, **filters)
+        return gather(run, limit, lat, lon)
+
+    if CACHE and not verbose:
+        key = make_key("reverse", lat, lon, limit, normalize_filters(filters))
+        return cached(key, compute)
+    return compute()
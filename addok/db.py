@@ -1,3 +1,9 @@
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar, copy_context
+
 import redis
 from hashids import Hashids
 
@@ -9,22 +15,165 @@ hashids = Hashids()
 
 class RedisProxy:
     instance = None
+    replicas = ()
+    shards = ()
+    # For each shard, the geohash prefixes it holds (empty for any).
+    shards_geohashes = ()
     Error = redis.RedisError
 
-    def connect(self, *args, **kwargs):
-        self.instance = redis.Redis(*args, **kwargs)
+    def __init__(self):
+        # Client used in the current context (thread, coroutine), if not the
+        # primary one.
+        self._current = ContextVar("redis_client_{}".format(id(self)))
+        self._replicas_cycle = itertools.count()
+        PROXIES.append(self)
+
+    def connect(self, *args, replicas=None, shards=None, **kwargs):
+        self.replicas = [redis.Redis(**params) for params in replicas or []]
+        shards = [dict(params) for params in shards or []]
+        self.shards_geohashes = [
+            tuple(params.pop("geohashes", None) or ()) for params in shards
+        ]
+        self.shards = [redis.Redis(**params) for params in shards]
+        if self.shards:
+            # The first shard also holds the non sharded keys (ids sequence,
+            # results cache…).
+            self.instance = self.shards[0]
+        else:
+            self.instance = redis.Redis(*args, **kwargs)
+        self._executor = None
+
+    @property
+    def current(self):
+        return self._current.get(None) or self.instance
 
     def __getattr__(self, name):
-        return getattr(self.instance, name)
+        return getattr(self.current, name)
+
+    @contextmanager
+    def using(self, client):
+        """Send the calls made in this context to `client`."""
+        token = self._current.set(client)
+        try:
+            yield client
+        finally:
+            self._current.reset(token)
+
+    @contextmanager
+    def reading(self):
+        """Send the calls made in this context to a replica, if any, in a
+        round-robin way. Writes must not happen in this context."""
+        if not self.replicas:
+            yield self.instance
+            return
+        index = next(self._replicas_cycle) % len(self.replicas)
+        with self.using(self.replicas[index]) as client:
+            yield client
+
+    @property
+    def geo_sharded(self):
+        return any(self.shards_geohashes)
+
+    def shard(self, key, geohash=None):
+        """Return the shard client owning `key` (a document key), or the
+        primary one if not sharded.
+
+        If shards declare geohash prefixes, the shard with the longest prefix
+        of `geohash` is used. Otherwise, uses rendezvous hashing among the
+        shards without prefixes (or all of them), so adding a shard at the end
+        of the list only moves the documents going to that new shard."""
+        if not self.shards:
+            return self.instance
+        candidates = range(len(self.shards))
+        if self.geo_sharded:
+            matching = [
+                (len(prefix), index)
+                for index, prefixes in enumerate(self.shards_geohashes)
+                for prefix in prefixes
+                if geohash and geohash.startswith(prefix)
+            ]
+            if matching:
+                return self.shards[max(matching)[1]]
+            candidates = [
+                index
+                for index, prefixes in enumerate(self.shards_geohashes)
+                if not prefixes
+            ] or candidates
+        if isinstance(key, str):
+            key = key.encode()
+        weights = [
+            (hashlib.md5(b"%d|%s" % (index, key)).digest(), index)
+            for index in candidates
+        ]
+        return self.shards[max(weights)[1]]
+
+    def covering(self, geohashes):
+        """Return the shards that may hold documents in the given geohashes
+        cells, or None if shards are not geographic."""
+        if not self.geo_sharded:
+            return None
+        return [
+            shard
+            for shard, prefixes in zip(self.shards, self.shards_geohashes)
+            if not prefixes
+            or any(
+                prefix.startswith(cell) or cell.startswith(prefix)
+                for prefix in prefixes
+                for cell in geohashes
+            )
+        ]
+
+    def each_shard(self):
+        """Iterate over shards, sending the calls made by the caller to the
+        current one."""
+        for shard in self.shards or [self.instance]:
+            with self.using(shard):
+                yield shard
+
+    def scatter(self, func, shards=None):
+        """Run `func` on each shard (or on given `shards`), in parallel, and
+        return the list of its results."""
+        if shards is None:
+            shards = self.shards
+        if not self.shards:
+            return [func()]
+        if len(shards) == 1:
+            with self.using(shards[0]):
+                return [func()]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(len(self.shards))
+
+        def run(shard):
+            with self.using(shard):
+                return func()
+
+        # Each thread gets a copy of the context, so `reading` and `using`
+        # contexts of the other proxies are kept.
+        futures = [
+            self._executor.submit(copy_context().run, run, shard)
+            for shard in shards
+        ]
+        return [future.result() for future in futures]
 
     def next_id(self):
-        next_id = self.incr("_id_sequence")
+        # Always on the primary, even in a `reading` context.
+        next_id = self.instance.incr("_id_sequence")
         return hashids.encode(next_id)
 
 
+PROXIES = []
 DB = RedisProxy()
 
 
+@contextmanager
+def reading():
+    """Send the reads of all Redis connections to their replicas."""
+    with ExitStack() as stack:
+        for proxy in PROXIES:
+            stack.enter_context(proxy.reading())
+        yield
+
+
 def _extract_redis_config(config_section):
     """Extract Redis connection parameters from a config section.
 
@@ -34,13 +183,28 @@ def _extract_redis_config(config_section):
     Returns:
         Dict with connection parameters
     """
-    return {
+    params = {
         "host": config_section.get("host"),
         "port": config_section.get("port"),
         "db": config_section.get("db"),
         "password": config_section.get("password"),
         "unix_socket_path": config_section.get("unix_socket_path"),
     }
+    base = {
+        k: v for k, v in config_section.items() if k not in ("replicas", "shards")
+    }
+    for name in ("replicas", "shards"):
+        nodes = config_section.get(name)
+        if nodes:
+            # Replicas and shards inherit the parameters of their section, so
+            # usually only host and port have to be given.
+            params[name] = [_extract_redis_config({**base, **node}) for node in nodes]
+    for node, node_params in zip(
+        config_section.get("shards") or [], params.get("shards", [])
+    ):
+        if node.get("geohashes"):
+            node_params["geohashes"] = list(node["geohashes"])
+    return params
 
 
 def get_redis_params():
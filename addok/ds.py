@@ -1,5 +1,20 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from hashlib import blake2b
+from itertools import islice
+from pathlib import Path
+
+try:
+    import lmdb
+except ImportError:  # We don't want to make it a required dependency.
+    lmdb = None
+
 from addok.config import config
-from addok.db import DB, RedisProxy
+from addok.db import DB, RedisProxy, _extract_redis_config
 from addok.helpers import keys
 
 
@@ -27,6 +42,301 @@ class RedisStore:
     def flushdb(self):
         _DB.flushdb()
 
+    def scan(self):
+        """Iterate over all the documents keys."""
+        return _DB.scan_iter(match=keys.document_key("*"), count=1000)
+
+
+# Data record header: length of the blob (-1 for a removal) and length of the
+# key that follows, before the blob itself.
+RECORD = struct.Struct("<iH")
+# Index file header (number of used slots), padded to keep slots aligned.
+HEADER = struct.Struct("<Q8x")
+# Index slot: hash of the key (0 for an empty slot) and offset of its record.
+SLOT = struct.Struct("<QQ")
+
+
+class MmapStore:
+    """Store documents in local files, shared by all the workers of a host
+    through the page cache: records are appended to a data file, and their
+    offsets are stored in an open addressing hash table (the index file),
+    both read with `mmap`, so workers do not keep any copy of the index.
+
+    Keys are checked against the records, so hash collisions are harmless.
+    The data file is only appended to, so updated and removed documents still
+    use disk space until the next `flushdb` (eg. `addok reset`)."""
+
+    DATA = "documents.data"
+    INDEX = "documents.index"
+    LOCK = "documents.lock"
+    MIN_SLOTS = 1024
+    MAX_LOAD = 0.5
+
+    def __init__(self):
+        self.path = Path(config.DOCUMENTS_DIR)
+        self.lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lockfile = open(self.path / self.LOCK, "ab")
+        self._data = open(self.path / self.DATA, "a+b")
+        self._map = None
+        self._open_index()
+        self._pid = os.getpid()
+
+    def _open_index(self):
+        self._index = open(self.path / self.INDEX, "a+b")
+        fd = self._index.fileno()
+        size = os.fstat(fd).st_size
+        self._table = mmap.mmap(fd, size) if size else None
+        self._slots = (size - HEADER.size) // SLOT.size if size else 0
+
+    def _check(self):
+        # Forked processes (eg. batch workers) need their own files, and all
+        # processes must follow files replaced by `flushdb` or `_grow`.
+        if self._pid != os.getpid():
+            return self._open()
+        try:
+            inode = os.stat(self.path / self.INDEX).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode != os.fstat(self._index.fileno()).st_ino:
+            self._open()
+
+    @contextmanager
+    def _writing(self):
+        with self.lock:
+            self._check()
+            lockfile = self._lockfile
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                self._check()  # Files may have been replaced meanwhile.
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _mapped(self, end):
+        """Return the data file mapping, remapping it if shorter than `end`."""
+        if self._map is None or len(self._map) < end:
+            fd = self._data.fileno()
+            if os.fstat(fd).st_size:
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _record(self, offset):
+        """Return the key and blob (None if removed) of the record at
+        `offset`."""
+        data = self._mapped(offset + RECORD.size)
+        if data is None or offset + RECORD.size > len(data):
+            return None, None  # Being written.
+        length, size = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        data = self._mapped(start + size + max(length, 0))
+        if start + size + max(length, 0) > len(data):
+            return None, None
+        key = data[start : start + size]
+        if length < 0:
+            return key, None
+        return key, data[start + size : start + size + length]
+
+    def _lookup(self, key, hashed):
+        """Return the slot of `key`, or the empty slot where to insert it,
+        and the offset of its record (None if not found)."""
+        slot = hashed % self._slots
+        while True:
+            position = HEADER.size + slot * SLOT.size
+            stored, offset = SLOT.unpack_from(self._table, position)
+            if not stored:
+                return position, None
+            if stored == hashed and self._record(offset)[0] == key:
+                return position, offset
+            slot = (slot + 1) % self._slots
+
+    def _grow(self, needed):
+        """Rebuild the index file with room for `needed` slots, dropping the
+        removed documents."""
+        slots = self.MIN_SLOTS
+        while slots * self.MAX_LOAD < needed:
+            slots *= 2
+        table = bytearray(HEADER.size + slots * SLOT.size)
+        used = 0
+        for hashed, offset in self._entries():
+            if self._record(offset)[1] is None:
+                continue
+            slot = hashed % slots
+            while SLOT.unpack_from(table, HEADER.size + slot * SLOT.size)[0]:
+                slot = (slot + 1) % slots
+            SLOT.pack_into(table, HEADER.size + slot * SLOT.size, hashed, offset)
+            used += 1
+        HEADER.pack_into(table, 0, used)
+        tmp = self.path / (self.INDEX + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(table)
+        os.replace(tmp, self.path / self.INDEX)
+        self._open_index()
+
+    def _entries(self):
+        """Iterate over the hash and record offset of the used slots."""
+        for slot in range(self._slots):
+            hashed, offset = SLOT.unpack_from(
+                self._table, HEADER.size + slot * SLOT.size
+            )
+            if hashed:
+                yield hashed, offset
+
+    def _used(self):
+        return HEADER.unpack_from(self._table)[0] if self._table else 0
+
+    def fetch(self, *keys):
+        with self.lock:
+            self._check()
+            blobs = []
+            if self._table is not None:
+                for key in keys:
+                    name = _key(key).encode()
+                    _, offset = self._lookup(name, _hash(name))
+                    if offset is not None:
+                        blobs.append((key, self._record(offset)[1]))
+        for key, blob in blobs:
+            if blob is not None:
+                yield key, blob
+
+    def _write(self, records):
+        """Append `records` (key and blob or None) to the data file, then
+        point the index to them."""
+        needed = self._used() + len(records)
+        if needed > self._slots * self.MAX_LOAD:
+            self._grow(needed)
+        offset = os.fstat(self._data.fileno()).st_size
+        entries, chunks = [], []
+        for key, blob in records:
+            key = _key(key).encode()
+            length = -1 if blob is None else len(blob)
+            chunks.extend((RECORD.pack(length, len(key)), key, blob or b""))
+            entries.append((key, offset))
+            offset += RECORD.size + len(key) + max(length, 0)
+        # Records must be written before their offsets are visible.
+        self._data.write(b"".join(chunks))
+        self._data.flush()
+        used = self._used()
+        for key, offset in entries:
+            hashed = _hash(key)
+            position, previous = self._lookup(key, hashed)
+            # Write the offset before the hash, which makes the slot used.
+            self._table[position + 8 : position + 16] = offset.to_bytes(8, "little")
+            if previous is None:
+                self._table[position : position + 8] = hashed.to_bytes(8, "little")
+                used += 1
+        HEADER.pack_into(self._table, 0, used)
+        self._table.flush()
+
+    def upsert(self, *docs):
+        with self._writing():
+            self._write(docs)
+
+    def remove(self, *keys):
+        with self._writing():
+            self._write([(key, None) for key in keys])
+
+    def flushdb(self):
+        # Replace the files instead of truncating them, so mappings of the
+        # other workers remain valid until they notice it.
+        with self._writing():
+            for name in (self.DATA, self.INDEX):
+                tmp = self.path / (name + ".tmp")
+                open(tmp, "wb").close()
+                os.replace(tmp, self.path / name)
+
+    def scan(self):
+        """Iterate over all the documents keys."""
+        with self.lock:
+            self._check()
+            keys = []
+            for _, offset in self._entries():
+                key, blob = self._record(offset)
+                if blob is not None:
+                    keys.append(key.decode())
+        # Not yielded under the lock, as documents may be upserted meanwhile.
+        yield from keys
+
+
+# Keys read by transaction by `LMDBStore.scan`.
+SCAN_COUNT = 1000
+
+
+class LMDBStore:
+    """Store documents in a LMDB database (in `DOCUMENTS_DIR`), read through
+    the page cache. Needs `lmdb` package.
+
+    Each `upsert` (ie. each batch chunk) is written in a single transaction."""
+
+    def __init__(self):
+        self._pid = None
+
+    @property
+    def env(self):
+        # LMDB environments must not be used across a fork (eg. batch workers).
+        if self._pid != os.getpid():
+            path = Path(config.DOCUMENTS_DIR)
+            path.mkdir(parents=True, exist_ok=True)
+            self._env = lmdb.open(
+                str(path), map_size=config.LMDB_MAP_SIZE, readahead=False
+            )
+            self._pid = os.getpid()
+        return self._env
+
+    def fetch(self, *keys):
+        with self.env.begin(buffers=False) as txn:
+            docs = [(key, txn.get(_key(key).encode())) for key in keys]
+        for key, doc in docs:
+            if doc is not None:
+                yield key, doc
+
+    def upsert(self, *docs):
+        with self.env.begin(write=True) as txn:
+            txn.cursor().putmulti(
+                ((_key(key).encode(), blob) for key, blob in docs), overwrite=True
+            )
+
+    def remove(self, *keys):
+        with self.env.begin(write=True) as txn:
+            for key in keys:
+                txn.delete(_key(key).encode())
+
+    def flushdb(self):
+        with self.env.begin(write=True) as txn:
+            txn.drop(self.env.open_db(), delete=False)
+
+    def scan(self):
+        """Iterate over all the documents keys."""
+        # By chunks, each in a short read transaction, so documents can be
+        # upserted meanwhile (eg. by `reencode`).
+        last = b""
+        while True:
+            with self.env.begin() as txn:
+                cursor = txn.cursor()
+                if not cursor.set_range(last):
+                    return
+                keys = [
+                    key
+                    for key in islice(cursor.iternext(values=False), SCAN_COUNT + 1)
+                    if key != last
+                ][:SCAN_COUNT]
+            if not keys:
+                return
+            yield from (key.decode() for key in keys)
+            last = keys[-1]
+
+
+def _key(key):
+    return key.decode() if isinstance(key, bytes) else key
+
+
+def _hash(key):
+    # Stable across processes, unlike `hash`; 0 marks the empty slots.
+    return int.from_bytes(blake2b(key, digest_size=8).digest(), "little") or 1
+
 
 class DSProxy:
     instance = None
@@ -46,31 +356,38 @@ def on_load():
     if config.DOCUMENT_STORE == RedisStore:
         params = config.REDIS.copy()
         params.update(config.REDIS.get("documents", {}))
-        _DB.connect(
-            host=params.get("host"),
-            port=params.get("port"),
-            db=params.get("db"),
-            password=params.get("password"),
-            unix_socket_path=params.get("unix_socket_path"),
-        )
+        _DB.connect(**_extract_redis_config(params))
 
 
 def store_documents(docs):
+    docs = [doc for doc in docs if doc]
     to_upsert = []
     to_remove = []
     for doc in docs:
-        if not doc:
-            continue
         if config.ID_FIELD not in doc:
             doc[config.ID_FIELD] = DB.next_id()
         key = keys.document_key(doc[config.ID_FIELD])
         if doc.get("_action") in ["delete", "update"]:
-            to_remove.append(key)
+            to_remove.append((key, doc))
         if doc.get("_action") in ["index", "update", None]:
-            to_upsert.append((key, config.DOCUMENT_SERIALIZER.dumps(doc)))
-        yield doc
+            data = doc
+            # Housenumbers are stored in the index (see HousenumbersIndexer),
+            # and content hashes too (see BATCH_DIFF).
+            skipped = {"_hash"}
+            if config.SPLIT_HOUSENUMBERS:
+                skipped.update(("housenumbers", config.HOUSENUMBERS_FIELD))
+            if skipped.intersection(doc):
+                data = {k: v for k, v in doc.items() if k not in skipped}
+            to_upsert.append((key, config.DOCUMENT_SERIALIZER.dumps(data)))
     if to_remove:
-        DS.remove(*to_remove)
+        # Known versions are needed to deindex them (see `index_documents`),
+        # fetched at once before being replaced.
+        known = dict(DS.fetch(*(key for key, _ in to_remove)))
+        for key, doc in to_remove:
+            doc["_known"] = known.get(key)
+    yield from docs
+    if to_remove:
+        DS.remove(*(key for key, _ in to_remove))
     if to_upsert:
         DS.upsert(*to_upsert)
 
@@ -87,3 +404,10 @@ def get_document(key):
 def get_documents(*keys):
     for id_, blob in DS.fetch(*keys):
         yield id_, config.DOCUMENT_SERIALIZER.loads(blob)
+
+
+def decode_documents(blobs, *keys):
+    """Like `get_documents`, but from already fetched `{key: blob}` data."""
+    for key in keys:
+        if key in blobs:
+            yield key, config.DOCUMENT_SERIALIZER.loads(blobs[key])
@@ -3,6 +3,7 @@ import string
 from addok.db import DB
 from addok.helpers import keys as dbkeys
 from addok.helpers import blue, white
+from addok.helpers.index import token_key_frequencies
 from addok.helpers.search import preprocess_query
 from addok.helpers.text import Token
 from addok.pairs import pair_key
@@ -56,6 +57,78 @@ def make_fuzzy(word, max=1):
     return neighbors
 
 
+def deletes_key(s):
+    return "x|{}".format(s)
+
+
+def make_deletes(word):
+    """Return `word` and its variants with one letter removed."""
+    deletes = [word]
+    deletes.extend(word[:i] + word[i + 1 :] for i in range(len(word)))
+    return list(dict.fromkeys(deletes))
+
+
+class DeletesIndexer:
+    """Index each token under its deletes (see FUZZY_DELETES_INDEX): the
+    tokens at one edit of a word share at least one of its deletes."""
+
+    @staticmethod
+    def index(pipe, key, doc, tokens, **kwargs):
+        if config.FUZZY_DELETES_INDEX:
+            for token in tokens.keys():
+                if not token.isdigit():
+                    for delete in make_deletes(token):
+                        pipe.sadd(deletes_key(delete), token)
+
+    @staticmethod
+    def deindex(db, key, doc, tokens, **kwargs):
+        DeletesIndexer.deindex_tokens(db, [(key, tokens, tokens)])
+
+    @staticmethod
+    def deindex_tokens(db, changes, **kwargs):
+        if not config.FUZZY_DELETES_INDEX:
+            return
+        tokens = list({token for _, removed, _ in changes for token in removed})
+        if not tokens:
+            return
+        # Only the tokens no document has anymore are removed.
+        pipe = db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.exists(dbkeys.token_key(token))
+        exists = pipe.execute()
+        pipe = db.pipeline(transaction=False)
+        for token, exist in zip(tokens, exists):
+            if not exist:
+                for delete in make_deletes(token):
+                    pipe.srem(deletes_key(delete), token)
+        pipe.execute()
+
+
+def indexed_neighbors(word, neighbors, pair_keys=None):
+    """Return the `neighbors` of `word` found in the deletes index, and seen
+    with the tokens of all `pair_keys`, in two round-trips at most."""
+    pipe = DB.pipeline(transaction=False)
+    for delete in make_deletes(word):
+        pipe.smembers(deletes_key(delete))
+    found = set().union(*pipe.execute())
+    # Deletes are shared with tokens at more than one edit.
+    wanted = set(neighbors)
+    candidates = [n for n in (t.decode() for t in found) if n in wanted]
+    return paired_neighbors(candidates, pair_keys)
+
+
+def paired_neighbors(neighbors, pair_keys):
+    """Return the `neighbors` seen in the index with the tokens of all
+    `pair_keys`, in their order."""
+    if not pair_keys or not neighbors:
+        return neighbors
+    pipe = DB.pipeline(transaction=False)
+    for key in pair_keys:
+        pipe.smismember(key, neighbors)
+    paired = [all(flags) for flags in zip(*pipe.execute())]
+    return [n for n, keep in zip(neighbors, paired) if keep]
+
+
 def fuzzy_collector(helper):
     if helper.fuzzy and not helper.has_cream():
         if helper.not_found:
@@ -86,26 +159,27 @@ def try_fuzzy(helper, tokens, include_common=True):
             continue
         helper.debug("Going fuzzy with %s and %s", try_one, keys)
         neighbors = make_fuzzy(try_one, max=helper.fuzzy)
-        if len(keys):
-            # Only retain tokens that have been seen in the index at least
-            # once with the other tokens.
-            DB.sadd(helper.pid, *neighbors)
-            interkeys = [pair_key(k[2:]) for k in keys]
-            interkeys.append(helper.pid)
-            fuzzy_words = DB.sinter(interkeys)
-            DB.delete(helper.pid)
-            # Keep the priority we gave in building fuzzy terms (inversion
-            # first, then substitution, etc.).
-            fuzzy_words = [w.decode() for w in fuzzy_words]
+        if config.FUZZY_DELETES_INDEX:
+            fuzzy_words = indexed_neighbors(
+                try_one, neighbors, [pair_key(k[2:]) for k in keys]
+            )
             fuzzy_words.sort(key=lambda x: neighbors.index(x))
+        elif len(keys):
+            # Only retain tokens that have been seen in the index at least
+            # once with the other tokens, keeping the priority we gave in
+            # building fuzzy terms (inversion first, then substitution, etc.).
+            # No temporary key, so concurrent searches do not share it.
+            fuzzy_words = paired_neighbors(
+                neighbors, [pair_key(k[2:]) for k in keys]
+            )
         else:
-            # The token we are considering is alone.
-            fuzzy_words = []
-            for neighbor in neighbors:
-                key = dbkeys.token_key(neighbor)
-                count = DB.zcard(key)
-                if count:
-                    fuzzy_words.append(neighbor)
+            # The token we are considering is alone: check all its neighbours
+            # in one round-trip at most.
+            frequencies = token_key_frequencies(
+                [dbkeys.token_key(neighbor) for neighbor in neighbors],
+                cache_missing=False,
+            )
+            fuzzy_words = [n for n, count in zip(neighbors, frequencies) if count]
         if fuzzy_words:
             helper.debug("Found fuzzy candidates %s", fuzzy_words)
             fuzzy_keys = [dbkeys.token_key(w) for w in fuzzy_words]
@@ -129,7 +203,10 @@ def do_fuzzyindex(self, word):
     word = list(preprocess_query(word))[0]
     token = Token(word)
     neighbors = make_fuzzy(token)
-    neighbors = [(n, DB.zcard(dbkeys.token_key(n))) for n in neighbors]
+    frequencies = token_key_frequencies(
+        [dbkeys.token_key(n) for n in neighbors], cache_missing=False
+    )
+    neighbors = list(zip(neighbors, frequencies))
     neighbors.sort(key=lambda n: n[1], reverse=True)
     for token, freq in neighbors:
         if freq == 0:
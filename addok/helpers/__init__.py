@@ -16,26 +16,91 @@ from addok.config import config
 PYTHON_VERSION = sys.version_info
 
 
-def load_file(filepath):
-    with open(filepath) as f:
-        for line in f:
-            yield line
-
-
-def load_msgpack_file(filepath):
+def read_lines(f, start=0, end=None):
+    """Yield the lines of binary file `f` starting in the `[start, end)` byte
+    range, so contiguous ranges cover each line once."""
+    position = start
+    if start:
+        f.seek(start - 1)
+        # End of the line started before the range (or its newline only).
+        position += len(f.readline()) - 1
+    while end is None or position < end:
+        line = f.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+
+def file_ranges(filepath, size):
+    """Split `filepath` in byte ranges of `size` bytes, for the loaders."""
+    total = os.path.getsize(filepath)
+    return [
+        (filepath, start, min(start + size, total)) for start in range(0, total, size)
+    ]
+
+
+def load_file(filepath, start=0, end=None):
+    with open(filepath, "rb") as f:
+        for line in read_lines(f, start, end):
+            yield line.decode()
+
+
+def load_msgpack_file(filepath, start=0, end=None):
+    """Yield the objects of msgpack file `filepath` starting in the
+    `[start, end)` byte range, where `start` must be the start of an object
+    (see `msgpack_file_ranges`)."""
     import msgpack  # We don't want to make it a required dependency.
 
     with open(filepath, mode="rb") as f:
-        for line in msgpack.Unpacker(f, encoding="utf-8"):
-            yield line
-
-
-def load_csv_file(filepath):
+        f.seek(start)
+        unpacker = msgpack.Unpacker(f, raw=False)
+        while end is None or start + unpacker.tell() < end:
+            try:
+                yield unpacker.unpack()
+            except msgpack.OutOfData:
+                break
+
+
+def msgpack_file_ranges(filepath, size):
+    """Split msgpack `filepath` in byte ranges of at least `size` bytes,
+    starting on objects boundaries, for `load_msgpack_file`."""
+    import msgpack
+
+    ranges = []
+    start = position = 0
+    with open(filepath, mode="rb") as f:
+        unpacker = msgpack.Unpacker(f)
+        while True:
+            try:
+                unpacker.skip()
+            except msgpack.OutOfData:
+                break
+            position = unpacker.tell()
+            if position - start >= size:
+                ranges.append((filepath, start, position))
+                start = position
+    if position > start:
+        ranges.append((filepath, start, position))
+    return ranges
+
+
+# Objects can't be found from any offset, so ranges are computed once by the
+# main process.
+load_msgpack_file.file_ranges = msgpack_file_ranges
+
+
+def load_csv_file(filepath, start=0, end=None):
     with open(filepath, newline="") as csvfile:
         dialect = csv.Sniffer().sniff(csvfile.read(1024))
-        csvfile.seek(0)
-        reader = csv.DictReader(csvfile, dialect=dialect)
-        yield from reader
+    with open(filepath, "rb") as f:
+        header = f.readline()
+        fieldnames = next(csv.reader([header.decode()], dialect=dialect))
+        # Multiline values are not supported with ranges.
+        lines = read_lines(f, max(start, len(header)), end)
+        yield from csv.DictReader(
+            (line.decode() for line in lines), fieldnames=fieldnames, dialect=dialect
+        )
 
 
 def iter_pipe(pipe, processors):
@@ -285,5 +350,10 @@ def parallelize(func, iterable, chunk_size, **bar_kwargs):
         context=context
     ) as pool:
         for chunk in pool.imap_unordered(func, iterable, chunk_size):
-            bar(step=len(chunk))
+            # Workers may return the number of processed items only.
+            bar(step=chunk if isinstance(chunk, int) else len(chunk))
         bar.finish()
+        # Let workers exit by themselves, so they run their finalizers (see
+        # `addok.helpers.offline`).
+        pool.close()
+        pool.join()
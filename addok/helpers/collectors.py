@@ -3,10 +3,18 @@ from itertools import product
 
 from addok.config import config
 from addok.db import DB
+from addok.helpers import keys as dbkeys
 from addok.helpers import scripts
 from addok.pairs import pair_key
 
 
+def filter_size(key):
+    if isinstance(key, dbkeys.UnionKey):
+        # Upper bound, values of a filter are usually exclusive.
+        return sum(DB.scard(k) for k in key.keys)
+    return DB.scard(key)
+
+
 def no_tokens_but_housenumbers_and_geohash(helper):
     if not helper.tokens and helper.housenumbers and helper.geohash_key:
         helper.new_bucket([helper.geohash_key], config.BUCKET_MIN)
@@ -39,7 +47,7 @@ def only_commons(helper):
             elif helper.filters:
                 # Case 2: Token is large BUT we have filters to consider
                 all_keys = keys + helper.filters
-                min_filter_size = min(DB.scard(k) for k in helper.filters)
+                min_filter_size = min(filter_size(k) for k in helper.filters)
                 
                 if min_filter_size < first.frequency:
                     # Filter is more selective than token → use Redis intersect
@@ -54,7 +62,10 @@ def only_commons(helper):
                         "Token (%s) and filter (%s) both large, manual scan",
                         first.frequency, min_filter_size
                     )
-                    ids = scripts.manual_scan(keys=all_keys, args=[helper.wanted])
+                    all_keys, args = dbkeys.flatten(all_keys)
+                    ids = scripts.manual_scan(
+                        keys=all_keys, args=[helper.wanted, *args]
+                    )
                     helper.bucket.update(ids)
                     helper.debug("%s results after scan", len(helper.bucket))
             else:
@@ -0,0 +1,44 @@
+"""JSON encoding and decoding, with orjson when installed (see `addok[perf]`)
+and the standard library otherwise.
+
+Both output compact JSON, as UTF-8 bytes for `dumpb`."""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # We don't want to make it a required dependency.
+    orjson = None
+
+
+def _default(obj):
+    # Subclasses are passed through, so dict subclasses which override their
+    # accessors (eg. `LazyDocument`) are serialized from their items.
+    for base in (dict, list, str, int, float):
+        if isinstance(obj, base):
+            return base(obj.items()) if base is dict else base(obj)
+    raise TypeError("Type is not JSON serializable: {}".format(type(obj).__name__))
+
+
+if orjson is not None:
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_SUBCLASS
+
+    loads = orjson.loads
+
+    def dumpb(data, sort_keys=False):
+        options = OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else OPTIONS
+        return orjson.dumps(data, default=_default, option=options)
+
+    def dumps(data, sort_keys=False):
+        return dumpb(data, sort_keys).decode()
+
+else:
+    loads = json.loads
+
+    def dumps(data, sort_keys=False):
+        return json.dumps(
+            data, separators=(",", ":"), ensure_ascii=False, sort_keys=sort_keys
+        )
+
+    def dumpb(data, sort_keys=False):
+        return dumps(data, sort_keys).encode()
@@ -1,13 +1,26 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 import geohash
 import redis
 
 from addok.config import config
 from addok.db import DB
-from addok.ds import get_document
+from addok.ds import get_documents
 
-from . import iter_pipe, keys, yielder
+from . import fastjson, iter_pipe, keys, offline, yielder
 
 VALUE_SEPARATOR = "|~|"
+# Changed each time the index is written, to invalidate workers caches.
+GENERATION_KEY = "_index_generation"
+# Changed at the end of each import, to reload the workers in-memory indexes
+# (see PREFIX_INDEX).
+IMPORT_GENERATION_KEY = "_import_generation"
+# Prefix of the hashes storing documents content hashes (see BATCH_DIFF).
+HASHES_KEY = "_hashes"
 
 
 def preprocess(s):
@@ -17,16 +30,143 @@ def preprocess(s):
 
 
 _CACHE = {}
+_GENERATIONS = {}  # Redis client id => index generation of its cache.
+_CHECKS = {}  # Redis client id => time of the last generation check.
+_FREQUENCIES = {}  # Redis client id => LRU of token key => frequency.
+# The ASGI app runs searches in threads.
+_FREQUENCIES_LOCK = threading.Lock()
+
+
+def _frequencies():
+    # Each Redis index (shard) has its own frequencies.
+    client = id(DB.current)
+    try:
+        return client, _FREQUENCIES[client]
+    except KeyError:
+        return client, _FREQUENCIES.setdefault(client, OrderedDict())
+
+
+def cache_frequency(key, frequency):
+    if not config.FREQUENCY_CACHE_SIZE:
+        return
+    _, frequencies = _frequencies()
+    with _FREQUENCIES_LOCK:
+        frequencies[key] = frequency
+        while len(frequencies) > config.FREQUENCY_CACHE_SIZE:
+            frequencies.popitem(last=False)
+
+
+def cached_frequency(key):
+    _, frequencies = _frequencies()
+    with _FREQUENCIES_LOCK:
+        frequency = frequencies.get(key)
+        if frequency is not None:
+            frequencies.move_to_end(key)
+    return frequency
+
+
+def flush_frequencies(generation=None):
+    """Flush the frequency cache of the current Redis index, or of all of
+    them if no `generation` is given."""
+    with _FREQUENCIES_LOCK:
+        if generation is None:
+            _FREQUENCIES.clear()
+            _GENERATIONS.clear()
+            _CHECKS.clear()
+            return
+        client, frequencies = _frequencies()
+        frequencies.clear()
+        _GENERATIONS[client] = generation
+
+
+def check_generation(generation):
+    """Flush the frequency cache if the index has changed since it was filled.
+
+    Return True if it has been flushed."""
+    _CHECKS[id(DB.current)] = time.monotonic()
+    if generation == _GENERATIONS.get(id(DB.current)):
+        return False
+    flush_frequencies(generation)
+    return True
+
+
+def generation_check_due():
+    """Tell if the index generation has not been checked for more than
+    FREQUENCY_CACHE_CHECK_INTERVAL seconds."""
+    checked = _CHECKS.get(id(DB.current))
+    return (
+        checked is None
+        or time.monotonic() - checked >= config.FREQUENCY_CACHE_CHECK_INTERVAL
+    )
+
+
+def bump_generation(pipe):
+    pipe.set(GENERATION_KEY, uuid.uuid4().hex)
+
+
+def bump_import_generation():
+    """Mark the end of an import on every shard (or in the offline index)."""
+    generation = uuid.uuid4().hex
+    for index, shard in enumerate(DB.shards or [DB.instance]):
+        if config.OFFLINE_INDEX_DIR:
+            pipe = offline.postings(index)
+        else:
+            pipe = offline.Postings(index, client=shard)
+        pipe.set(IMPORT_GENERATION_KEY, generation)
+        pipe.execute()
 
 
 def token_key_frequency(key):
-    return DB.zcard(key)
+    frequency = cached_frequency(key)
+    if frequency is None:
+        frequency = DB.zcard(key)
+        cache_frequency(key, frequency)
+    return frequency
 
 
 def token_frequency(token):
     return token_key_frequency(keys.token_key(token))
 
 
+def token_key_frequencies(keys, sync=False, cache_missing=True):
+    """Return the frequencies of many token keys, in one round-trip at most.
+
+    With `sync`, also check in the same round-trip that the index has not
+    changed since the cached frequencies have been read: always when some
+    frequencies are not cached, else at most once per
+    FREQUENCY_CACHE_CHECK_INTERVAL.
+
+    Without `cache_missing`, keys not in the index are not cached, so looking
+    up many candidates (eg. fuzzy neighbours) does not evict useful ones."""
+    frequencies = {}
+    missing = []
+    for key in keys:
+        frequency = cached_frequency(key)
+        if frequency is None:
+            missing.append(key)
+        else:
+            frequencies[key] = frequency
+    sync = sync and (bool(missing) or generation_check_due())
+    if missing or sync:
+        pipe = DB.pipeline(transaction=False)
+        if sync:
+            pipe.get(GENERATION_KEY)
+        for key in missing:
+            pipe.zcard(key)
+        results = pipe.execute()
+        if sync and check_generation(results.pop(0)) and frequencies:
+            # Frequencies taken from the cache were outdated.
+            missing.extend(frequencies.keys())
+            results.extend(
+                token_key_frequencies(list(frequencies), cache_missing=cache_missing)
+            )
+        for key, frequency in zip(missing, results):
+            frequencies[key] = frequency
+            if frequency or cache_missing:
+                cache_frequency(key, frequency)
+    return [frequencies[key] for key in keys]
+
+
 def extract_tokens(tokens, string, boost):
     els = list(preprocess(string))
     if not els:
@@ -42,36 +182,198 @@ def index_tokens(pipe, tokens, key, **kwargs):
         pipe.zadd(keys.token_key(token), mapping={key: boost})
 
 
-def deindex_field(key, string):
+def deindex_field(key, string, db=None):
     els = list(preprocess(string))
     for s in els:
-        deindex_token(key, s)
+        deindex_token(key, s, db)
     return els
 
 
-def deindex_token(key, token):
+def deindex_token(key, token, db=None):
+    db = DB if db is None else db
     tkey = keys.token_key(token)
-    DB.zrem(tkey, key)
+    db.zrem(tkey, key)
 
 
 def index_documents(docs):
-    pipe = DB.pipeline(transaction=False)
+    shards = DB.shards or [DB.instance]
+    if config.OFFLINE_INDEX_DIR:
+        pipes = {id(shard): offline.postings(i) for i, shard in enumerate(shards)}
+    else:
+        # Writes are aggregated by key, and sent once for the whole chunk.
+        pipes = {
+            id(shard): offline.Postings(i, client=shard)
+            for i, shard in enumerate(shards)
+        }
+    docs = [doc for doc in docs if doc]
+    known = known_documents(docs)
+    # Shard id => (shard, known documents to deindex, (known, doc) to diff).
+    deindexed = {}
     for doc in docs:
-        if not doc:
-            continue
+        if config.BATCH_DIFF and config.ID_FIELD in doc:
+            store_hash(pipes[id(DB.instance)], doc)
         if doc.get("_action") in ["delete", "update"]:
-            key = keys.document_key(doc[config.ID_FIELD]).encode()
-            known_doc = get_document(key)
+            known_doc = known.get(keys.document_key(doc[config.ID_FIELD]))
             if known_doc:
-                deindex_document(known_doc)
+                # The shard of the known document, its position may have
+                # changed.
+                shard = document_shard(known_doc)
+                pending = deindexed.setdefault(id(shard), (shard, [], []))
+                if (
+                    config.BATCH_DIFF
+                    and doc["_action"] == "update"
+                    and shard is document_shard(doc)
+                ):
+                    pending[2].append((known_doc, doc))
+                    continue
+                pending[1].append(known_doc)
         if doc.get("_action") in ["index", "update", None]:
-            index_document(pipe, doc)
-        yield doc
+            index_document(pipes[id(document_shard(doc))], doc)
     try:
-        pipe.execute()
+        for shard, known_docs, updates in deindexed.values():
+            with DB.using(shard):
+                deindex_documents(
+                    known_docs, updates=updates, postings=pipes[id(shard)]
+                )
+        for pipe in pipes.values():
+            bump_generation(pipe)
+            pipe.execute()
     except redis.RedisError as e:
-        msg = "Error while importing document:\n{}\n{}".format(doc, str(e))
+        last = docs[-1] if docs else None
+        msg = "Error while importing document:\n{}\n{}".format(last, str(e))
         raise ValueError(msg)
+    yield from docs
+
+
+def known_documents(docs):
+    """Return the stored versions of the documents to delete or update, by
+    key, fetched at once.
+
+    They are attached to the documents by `store_documents`, which stores the
+    new versions before they are indexed."""
+    known = {}
+    missing = []
+    for doc in docs:
+        if doc.get("_action") not in ["delete", "update"]:
+            continue
+        key = keys.document_key(doc[config.ID_FIELD])
+        if "_known" in doc:
+            blob = doc.pop("_known")
+            if blob is not None:
+                known[key] = config.DOCUMENT_SERIALIZER.loads(blob)
+        else:
+            missing.append(key)
+    if missing:
+        known.update(get_documents(*missing))
+    return known
+
+
+def content_hash(doc):
+    data = {k: v for k, v in doc.items() if k not in ("_action", "_hash")}
+    return hashlib.blake2b(
+        fastjson.dumpb(data, sort_keys=True), digest_size=16
+    ).hexdigest()
+
+
+def hashes_key(_id):
+    # Hashes are spread in buckets, small enough to be compactly encoded.
+    bucket = hashlib.md5(str(_id).encode()).hexdigest()[:4]
+    return "{}|{}".format(HASHES_KEY, bucket)
+
+
+def store_hash(pipe, doc):
+    _id = str(doc[config.ID_FIELD])
+    if doc.get("_action") == "delete":
+        pipe.hdel(hashes_key(_id), _id)
+    elif "_hash" in doc:
+        pipe.hset(hashes_key(_id), mapping={_id: doc["_hash"]})
+
+
+def skip_unchanged(docs):
+    """With BATCH_DIFF, drop the documents that have not changed since their
+    last import, and turn the other known ones into updates."""
+    if not config.BATCH_DIFF:
+        yield from docs
+        return
+    docs = list(docs)
+    # New documents without id are not compared.
+    compared = [
+        doc
+        for doc in docs
+        if doc and config.ID_FIELD in doc and doc.get("_action") != "delete"
+    ]
+    pipe = DB.instance.pipeline(transaction=False)
+    for doc in compared:
+        doc["_hash"] = content_hash(doc)
+        _id = str(doc[config.ID_FIELD])
+        pipe.hget(hashes_key(_id), _id)
+    known = {id(doc): value for doc, value in zip(compared, pipe.execute())}
+    for doc in docs:
+        value = known.get(id(doc))
+        if value is not None:
+            if value.decode() == doc["_hash"]:
+                continue  # Unchanged.
+            if doc.get("_action") in ["index", None]:
+                doc["_action"] = "update"
+        yield doc
+
+
+def document_shard(doc):
+    """Return the Redis shard where to index `doc`."""
+    key = keys.document_key(doc[config.ID_FIELD])
+    geoh = None
+    if DB.geo_sharded and doc.get("lat") is not None and doc.get("lon") is not None:
+        geoh = geohash.encode(float(doc["lat"]), float(doc["lon"]), 12)
+    return DB.shard(key, geoh)
+
+
+def diff_document(pipe, known, doc, removals):
+    """Update the index of the `known` version of a document to `doc`, only
+    removing and adding the entries that differ between both.
+
+    Removals are queued on the `removals` pipeline, and additions on `pipe`.
+    Return the `(key, removed, tokens)` change of the entries shared with
+    other documents (see `deindex_tokens`), or None."""
+    key = keys.document_key(doc[config.ID_FIELD])
+    old, new = offline.Postings(None), offline.Postings(None)
+    index_document(old, known)
+    index_document(new, doc)
+    removed = []  # Tokens the document does not have anymore.
+    for name, (kind, value) in old.keys.items():
+        kept = new.keys.get(name, (kind, ()))[1]
+        if kind == "hash":
+            fields = [field for field in value if field not in kept]
+            if fields:
+                removals.hdel(name, *fields)
+        elif kind in ("zset", "set") and key in value and key not in kept:
+            if kind == "zset":
+                removals.zrem(name, key)
+                if name.startswith(keys.TOKEN_PREFIX):
+                    removed.append(name[len(keys.TOKEN_PREFIX) :])
+            else:
+                removals.srem(name, key)
+    for name, (kind, value) in new.keys.items():
+        previous = old.keys.get(name, (kind, {}))[1]
+        if kind in ("zset", "hash"):
+            mapping = {k: v for k, v in value.items() if previous.get(k) != v}
+            if mapping and kind == "zset":
+                pipe.zadd(name, mapping=mapping)
+            elif mapping:
+                pipe.hset(name, mapping=mapping)
+        elif kind == "set":
+            members = [member for member in value if member not in previous]
+            if members:
+                pipe.sadd(name, *members)
+    for name, size in new.trims.items():
+        pipe.ztrim(name, size)
+    if removed:
+        # Entries shared with other documents (pairs, edge ngrams…).
+        tokens = [
+            name[len(keys.TOKEN_PREFIX) :]
+            for name in old.keys
+            if name.startswith(keys.TOKEN_PREFIX)
+        ]
+        return key, removed, tokens
 
 
 def index_document(pipe, doc, **kwargs):
@@ -86,10 +388,56 @@ def index_document(pipe, doc, **kwargs):
 
 
 def deindex_document(doc, **kwargs):
-    key = keys.document_key(doc[config.ID_FIELD])
-    tokens = []
+    deindex_documents([doc], **kwargs)
+
+
+def deindex_documents(docs, updates=(), postings=None, **kwargs):
+    """Deindex `docs` from the current shard: the entries owned by each
+    document are removed in one pipeline, then the entries shared between
+    documents (see `deindex_tokens`) for all of them at once.
+
+    With BATCH_DIFF, `updates` are `(known, doc)` pairs only losing the
+    entries that differ, in the same pipeline, their new entries being added
+    to `postings` (see `diff_document`)."""
+    loaded = load_housenumbers([known for known, _ in updates] + list(docs))
+    docs = loaded[len(updates) :]
+    pipe = DB.pipeline(transaction=False)
+    changes = []
+    for known, (_, doc) in zip(loaded, updates):
+        change = diff_document(postings, known, doc, pipe)
+        if change:
+            changes.append(change)
+    for doc in docs:
+        key = keys.document_key(doc[config.ID_FIELD])
+        tokens = []
+        for indexer in config.INDEXERS:
+            if not hasattr(indexer, "deindex_tokens"):
+                indexer.deindex(pipe, key, doc, tokens, **kwargs)
+        changes.append((key, tokens, tokens))
+    pipe.execute()
     for indexer in config.INDEXERS:
-        indexer.deindex(DB, key, doc, tokens, **kwargs)
+        if hasattr(indexer, "deindex_tokens"):
+            indexer.deindex_tokens(DB, changes, **kwargs)
+
+
+def load_housenumbers(docs):
+    """With SPLIT_HOUSENUMBERS, return copies of the known `docs` with their
+    housenumbers, stored apart in the current shard and fetched at once."""
+    if not config.SPLIT_HOUSENUMBERS or not docs:
+        return docs
+    pipe = DB.pipeline(transaction=False)
+    for doc in docs:
+        pipe.hgetall(keys.housenumbers_key(doc[config.ID_FIELD]))
+    loaded = []
+    for doc, stored in zip(docs, pipe.execute()):
+        doc = dict(doc)
+        doc["housenumbers"] = {
+            token.decode(): fastjson.loads(data)
+            for token, data in stored.items()
+            if not token.startswith(b"g|")
+        }
+        loaded.append(doc)
+    return loaded
 
 
 def index_geohash(pipe, key, lat, lon):
@@ -100,12 +448,13 @@ def index_geohash(pipe, key, lat, lon):
     pipe.sadd(geok, key)
 
 
-def deindex_geohash(key, lat, lon):
+def deindex_geohash(key, lat, lon, db=None):
+    db = DB if db is None else db
     lat = float(lat)
     lon = float(lon)
     geoh = geohash.encode(lat, lon, config.GEOHASH_PRECISION)
     geok = keys.geohash_key(geoh)
-    DB.srem(geok, key)
+    db.srem(geok, key)
 
 
 def check_type_and_transform_to_array(name, values):
@@ -150,7 +499,7 @@ class FieldsIndexer:
             if values:
                 values = check_type_and_transform_to_array(name, values)
                 for value in values:
-                    tokens.extend(deindex_field(key, value))
+                    tokens.extend(deindex_field(key, value, db))
 
 
 class GeohashIndexer:
@@ -160,7 +509,7 @@ class GeohashIndexer:
 
     @staticmethod
     def deindex(db, key, doc, tokens, **kwargs):
-        deindex_geohash(key, doc["lat"], doc["lon"])
+        deindex_geohash(key, doc["lat"], doc["lon"], db)
 
 
 class HousenumbersIndexer:
@@ -169,12 +518,38 @@ class HousenumbersIndexer:
         housenumbers = doc.get("housenumbers", {})
         for number, data in housenumbers.items():
             index_geohash(pipe, key, data["lat"], data["lon"])
+        if config.SPLIT_HOUSENUMBERS and housenumbers:
+            pipe.hset(
+                keys.housenumbers_key(doc[config.ID_FIELD]),
+                mapping=split_housenumbers(housenumbers),
+            )
 
     @staticmethod
     def deindex(db, key, doc, tokens, **kwargs):
-        housenumbers = doc.get("housenumbers", {})
-        for token, data in housenumbers.items():
-            deindex_geohash(key, data["lat"], data["lon"])
+        # With SPLIT_HOUSENUMBERS, housenumbers are loaded by
+        # `load_housenumbers`.
+        for token, data in doc.get("housenumbers", {}).items():
+            deindex_geohash(key, data["lat"], data["lon"], db)
+        if config.SPLIT_HOUSENUMBERS:
+            db.delete(keys.housenumbers_key(doc[config.ID_FIELD]))
+
+
+def split_housenumbers(housenumbers):
+    """Return the hash storing `housenumbers` apart from their document.
+
+    Each housenumber is stored under its token, and each geohash cell (as
+    "g|<geohash>") lists the tokens of the housenumbers it contains, to load
+    only the ones around a point."""
+    mapping = {}
+    cells = {}
+    for token, data in housenumbers.items():
+        mapping[token] = fastjson.dumps(data)
+        geoh = geohash.encode(
+            float(data["lat"]), float(data["lon"]), config.GEOHASH_PRECISION
+        )
+        cells.setdefault(keys.geohash_key(geoh), []).append(token)
+    mapping.update((cell, fastjson.dumps(tokens)) for cell, tokens in cells.items())
+    return mapping
 
 
 class FiltersIndexer:
@@ -1,10 +1,16 @@
 TOKEN_PREFIX = "w|"
+# Best documents of each edge ngram (see AUTOCOMPLETE_TOP_K).
+TOP_PREFIX = "t|"
 
 
 def token_key(s):
     return "{}{}".format(TOKEN_PREFIX, s)
 
 
+def top_key(s):
+    return "{}{}".format(TOP_PREFIX, s)
+
+
 def document_key(s):
     return "d|{}".format(s)
 
@@ -15,3 +21,28 @@ def geohash_key(s):
 
 def filter_key(k, v):
     return "f|{}|{}".format(k, v)
+
+
+def housenumbers_key(s):
+    return "h|{}".format(s)
+
+
+class UnionKey(str):
+    """Union of the sets `keys`, named like a key but never stored: scripts
+    check its members on the fly (see `flatten`), so searches do not write
+    and can run on read-only replicas."""
+
+    def __new__(cls, name, keys):
+        key = super().__new__(cls, name)
+        key.keys = list(keys)
+        return key
+
+
+def flatten(keys):
+    """Return the keys of the sets of `keys` for a script (first the plain
+    ones, then the sets of each `UnionKey`), and the arguments describing
+    them: the number of plain keys, then the size of each union."""
+    plain = [key for key in keys if not isinstance(key, UnionKey)]
+    unions = [key for key in keys if isinstance(key, UnionKey)]
+    flat = plain + [k for union in unions for k in union.keys]
+    return flat, [len(plain)] + [len(union.keys) for union in unions]
@@ -0,0 +1,29 @@
+-- Tell, for each pair of sorted sets, whether they have a common member,
+-- without storing their intersection like ZINTERSTORE would.
+-- KEYS are the pairs of sets: KEYS[1] with KEYS[2], KEYS[3] with KEYS[4]…
+-- Returns a list with 1 for each pair having a common member, 0 otherwise.
+local results = {}
+for i = 1, #KEYS, 2 do
+    local small, big = KEYS[i], KEYS[i + 1]
+    if redis.call('ZCARD', small) > redis.call('ZCARD', big) then
+        small, big = big, small
+    end
+    local found = 0
+    local start = 0
+    -- Walk the smallest set by slices, until a common member is found.
+    while found == 0 do
+        local members = redis.call('ZRANGE', small, start, start + 999)
+        if #members == 0 then
+            break
+        end
+        for j, member in ipairs(members) do
+            if redis.call('ZSCORE', big, member) then
+                found = 1
+                break
+            end
+        end
+        start = start + 1000
+    end
+    results[#results + 1] = found
+end
+return results
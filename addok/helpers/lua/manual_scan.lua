@@ -4,29 +4,45 @@
 -- in this case is big (millions of entries).
 -- KEYS are the various words of the search (in they key form: w|xxxx)
 -- ARGS[1] one is the number of candidates we want to retrieve
+-- ARGS[2] is the number of KEYS to check (all of them if not given), then
+-- ARGS[3]… are the sizes of the groups of the other KEYS: candidates must also
+-- be in one of the sets of each group (see `keys.UnionKey`).
 local candidates = {}
+local plain = tonumber(ARGV[2] or #KEYS)
+local unions = {}
+local position = plain
+for i = 3, #ARGV do
+    local size = tonumber(ARGV[i])
+    unions[#unions + 1] = {unpack(KEYS, position + 1, position + size)}
+    position = position + size
+end
 -- Take the first 500 documents of the first set
 local ids = redis.call('ZREVRANGE', KEYS[1], 0, 500)
 for i,id in ipairs(ids) do
     local count = 0;
     -- Check if this ids is available in other sets
-    for j,key in ipairs(KEYS) do
-        if j > 1 then
-            -- we used the first key to get the ids, skip it
-            -- slice anyone?
-            if redis.call('TYPE', key)['ok'] == 'zset' then
-                local rank = redis.call('ZRANK', key, id);
-                if type(rank) == 'number' then
-                    count = count + 1;
-                end
-            elseif redis.call('SISMEMBER', key, id) == 1 then
-                -- Happens with filters which are sets and not zsets
+    for j = 2, plain do
+        local key = KEYS[j]
+        if redis.call('TYPE', key)['ok'] == 'zset' then
+            local rank = redis.call('ZRANK', key, id);
+            if type(rank) == 'number' then
+                count = count + 1;
+            end
+        elseif redis.call('SISMEMBER', key, id) == 1 then
+            -- Happens with filters which are sets and not zsets
+            count = count + 1;
+        end
+    end
+    for _, union in ipairs(unions) do
+        for _, key in ipairs(union) do
+            if redis.call('SISMEMBER', key, id) == 1 then
                 count = count + 1;
+                break
             end
         end
     end
     -- Yay, this id is on all sets, that's a candidate
-    if count == (#KEYS - 1) then
+    if count == (plain - 1 + #unions) then
         candidates[#candidates + 1] = id;
     end
     -- we have enough candidates
@@ -0,0 +1,29 @@
+-- Store the union or the intersection of sets, and set its expiration, in
+-- one round-trip instead of EXISTS, SUNIONSTORE/SINTERSTORE, SCARD and
+-- EXPIRE/PERSIST.
+-- KEYS[1] is the destination key, other KEYS are the sets to combine.
+-- Args are:
+-- - "union" or "inter"
+-- - the ttl of the destination key, in seconds
+-- - the cardinality above which the destination key is persisted instead
+--   (0 for never)
+-- - "1" to reuse the destination key if it already exists
+-- Returns the cardinality of the destination key, and 1 if it has been
+-- computed (0 if reused).
+local computed = 0
+local total
+if ARGV[4] == '1' and redis.call('EXISTS', KEYS[1]) == 1 then
+    total = redis.call('SCARD', KEYS[1])
+else
+    local command = ARGV[1] == 'inter' and 'SINTERSTORE' or 'SUNIONSTORE'
+    -- Redis deletes the destination key when the result is empty.
+    total = redis.call(command, KEYS[1], unpack(KEYS, 2))
+    computed = 1
+end
+local persist = tonumber(ARGV[3])
+if persist > 0 and total > persist then
+    redis.call('PERSIST', KEYS[1])
+elseif total > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return {total, computed}
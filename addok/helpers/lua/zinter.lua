@@ -1,11 +1,65 @@
 -- Like a sinter, but on sorted set.
 -- Args are:
--- - unique name to be used for tmp key (we don't pass it has key
---   to make the API simpler, and because it's tmp, so no cluster issue)
--- - the number of items to retrieve
-redis.call('ZINTERSTORE', ARGV[1], #KEYS, unpack(KEYS))
--- `stop` is inclusive, so we do minus one to keep the signature human ready
--- i.e. if I want two elements, I just pass "2", not "1".
-local ids = redis.call('ZREVRANGE', ARGV[1], 0, tonumber(ARGV[2]) - 1)
-redis.call('DEL', ARGV[1])
-return ids
+-- - unused, was the name of a tmp key, kept for backward compatibility
+-- - the number of items to retrieve (0 for all)
+-- - the number of KEYS to intersect with ZINTER (all of them if not given)
+-- - then the sizes of the groups of the other KEYS: members must also be in
+--   one of the sets of each group (see `keys.UnionKey`)
+-- ZINTER (Redis >= 6.2) does not write anything, and unions are checked on
+-- the fly instead of being stored, so this script can be run on read-only
+-- replicas.
+-- It returns members by ascending score, ties in lexicographic order, so
+-- walking it backward gives the same order as a ZREVRANGE.
+local wanted = tonumber(ARGV[2])
+local plain = tonumber(ARGV[3] or #KEYS)
+local unions = {}
+local position = plain
+for i = 4, #ARGV do
+    local size = tonumber(ARGV[i])
+    unions[#unions + 1] = {unpack(KEYS, position + 1, position + size)}
+    position = position + size
+end
+local function in_union(id, union)
+    for _, key in ipairs(union) do
+        if redis.call('SISMEMBER', key, id) == 1 then
+            return true
+        end
+    end
+    return false
+end
+-- Tell if `id` is in all the unions, but the `skipped` one (walked).
+local function in_unions(id, skipped)
+    for i, union in ipairs(unions) do
+        if i ~= skipped and not in_union(id, union) then
+            return false
+        end
+    end
+    return true
+end
+local ids, skipped
+if plain > 0 then
+    ids = redis.call('ZINTER', plain, unpack(KEYS, 1, plain))
+else
+    -- Walk the smallest union, and check the others.
+    local smallest
+    for i, union in ipairs(unions) do
+        local size = 0
+        for _, key in ipairs(union) do
+            size = size + redis.call('SCARD', key)
+        end
+        if not smallest or size < smallest then
+            smallest, skipped = size, i
+        end
+    end
+    ids = redis.call('SUNION', unpack(unions[skipped]))
+end
+local results = {}
+for i = #ids, 1, -1 do
+    if wanted > 0 and #results == wanted then
+        break
+    end
+    if in_unions(ids[i], skipped) then
+        results[#results + 1] = ids[i]
+    end
+end
+return results
@@ -0,0 +1,248 @@
+"""Aggregation of the index writes, and offline index builder (see `addok
+batch --resp`).
+
+The indexers write to in-memory postings, so each key of a chunk of
+documents is written by one command instead of one per document.
+
+Offline, instead of being sent to a live Redis, postings are spilled by each
+worker to sorted runs on disk. At the end of the import, runs are merged, so
+each key is written once, in a stream of Redis commands to be loaded with
+`redis-cli --pipe`."""
+
+import heapq
+import marshal
+import os
+import uuid
+from itertools import groupby
+from multiprocessing.util import Finalize
+from operator import itemgetter
+from pathlib import Path
+
+from addok.config import config
+
+# Postings kept in memory by each worker before being spilled to disk.
+SPILL_SIZE = 1000000
+# Max members sent by command of the stream.
+COMMAND_SIZE = 10000
+COMMANDS = {"zset": "ZADD", "set": "SADD", "hash": "HSET", "string": "SET"}
+
+
+class Postings:
+    """Pipeline-like object aggregating the writes of the indexers for a
+    shard, sent to its Redis `client` on `execute`, or spilled to disk if
+    offline.
+
+    With a `client`, the other commands (`srem`, `expire`…) are queued on a
+    real pipeline, sent before the aggregated writes."""
+
+    def __init__(self, shard, client=None):
+        self.shard = shard
+        self.client = client
+        self.keys = {}  # Key => (kind, value).
+        self.trims = {}  # Sorted set key => max size.
+        self.deletes = {}  # Hash key => fields to remove.
+        self.size = 0
+        self.pipe = None
+
+    def __getattr__(self, name):
+        if name.startswith("_") or self.__dict__.get("client") is None:
+            raise AttributeError(
+                "{} is not available when indexing offline".format(name)
+            )
+        if self.pipe is None:
+            self.pipe = self.client.pipeline(transaction=False)
+        return getattr(self.pipe, name)
+
+    def _value(self, key, kind, factory):
+        if key not in self.keys:
+            self.keys[key] = (kind, factory())
+        elif self.keys[key][0] != kind:
+            raise ValueError("Key {} is not a {}".format(key, kind))
+        return self.keys[key][1]
+
+    def zadd(self, key, mapping):
+        self._value(key, "zset", dict).update(
+            (_plain(member), score) for member, score in mapping.items()
+        )
+        self.size += len(mapping)
+
+    def sadd(self, key, *values):
+        self._value(key, "set", set).update(_plain(value) for value in values)
+        self.size += len(values)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        mapping = dict(mapping or {})
+        if key is not None:
+            mapping[key] = value
+        self._value(name, "hash", dict).update(
+            (_plain(field), _plain(value)) for field, value in mapping.items()
+        )
+        self.size += len(mapping)
+
+    def hdel(self, key, *fields):
+        """Remove `fields` of hash `key`, before the other writes are sent.
+
+        Offline, the index is built from scratch, so only the pending fields
+        are removed."""
+        fields = [_plain(field) for field in fields]
+        if key in self.keys and self.keys[key][0] == "hash":
+            for field in fields:
+                self.keys[key][1].pop(field, None)
+        if self.client is not None:
+            self.deletes.setdefault(key, set()).update(fields)
+
+    def ztrim(self, key, size):
+        """Only keep the `size` highest scored members of `key`, once sent to
+        Redis."""
+        self.trims[key] = size
+
+    def set(self, key, value):
+        self._value(key, "string", str)
+        self.keys[key] = ("string", _plain(value))
+
+    def execute(self):
+        if self.client is None:
+            if self.size >= SPILL_SIZE:
+                self.spill()
+            return []
+        pipe = self.pipe or self.client.pipeline(transaction=False)
+        self.pipe = None
+        for key, fields in self.deletes.items():
+            pipe.hdel(key, *fields)
+        for key, (kind, value) in self.keys.items():
+            for args in arguments(kind, value):
+                pipe.execute_command(COMMANDS[kind], key, *args)
+        for key, size in self.trims.items():
+            pipe.zremrangebyrank(key, 0, -size - 1)
+        self.keys = {}
+        self.trims = {}
+        self.deletes = {}
+        self.size = 0
+        return pipe.execute()
+
+    def spill(self):
+        """Write the postings to a new run, sorted by key."""
+        if not self.keys or not config.OFFLINE_INDEX_DIR:
+            return
+        path = Path(config.OFFLINE_INDEX_DIR) / "{}.{}".format(
+            uuid.uuid4().hex, self.shard
+        )
+        with path.open("wb") as f:
+            for key in sorted(self.keys):
+                kind, value = self.keys[key]
+                marshal.dump((key, kind, value, self.trims.get(key)), f)
+        self.keys = {}
+        self.trims = {}
+        self.deletes = {}
+        self.size = 0
+
+
+def _plain(value):
+    # marshal only knows builtin types (tokens are `str` subclasses).
+    return value if isinstance(value, (bytes, float, int)) else str(value)
+
+
+_POSTINGS = {}  # Shard index => Postings of the current process.
+_PID = None
+
+
+def postings(shard):
+    """Return the postings of `shard` for the current process."""
+    global _PID
+    if _PID != os.getpid():
+        _POSTINGS.clear()
+        _PID = os.getpid()
+        # Run when a batch worker exits (see `parallelize`).
+        Finalize(None, flush, exitpriority=10)
+    if shard not in _POSTINGS:
+        _POSTINGS[shard] = Postings(shard)
+    return _POSTINGS[shard]
+
+
+def flush():
+    """Spill the postings of the current process."""
+    for shard_postings in _POSTINGS.values():
+        shard_postings.spill()
+    _POSTINGS.clear()
+
+
+def read_run(path):
+    with path.open("rb") as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+
+def merge_runs(paths):
+    """Merge the sorted runs, yielding each key once with its whole value.
+
+    Trimmed sorted sets (see `Postings.ztrim`) only keep their highest scored
+    members."""
+    runs = [read_run(path) for path in paths]
+    for key, items in groupby(heapq.merge(*runs, key=itemgetter(0)), itemgetter(0)):
+        kind, value, size = next(items)[1:]
+        for _, other, more, trim in items:
+            if other != kind:
+                raise ValueError("Key {} is both a {} and a {}".format(key, kind, other))
+            if kind == "string":
+                value = more
+            else:
+                value.update(more)
+            if trim is not None:
+                size = trim if size is None else min(size, trim)
+        if size is not None and len(value) > size:
+            value = dict(heapq.nlargest(size, value.items(), key=itemgetter(1)))
+        yield key, kind, value
+
+
+def resp(*args):
+    """Encode a command with the Redis protocol."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = (repr(arg) if isinstance(arg, float) else str(arg)).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def arguments(kind, value):
+    """Yield the arguments of the commands writing `value`, by chunks of
+    COMMAND_SIZE members."""
+    if kind == "string":
+        yield [value]
+        return
+    if kind == "zset":
+        args = [arg for member, score in value.items() for arg in (score, member)]
+    elif kind == "hash":
+        args = [arg for item in value.items() for arg in item]
+    else:
+        args = list(value)
+    step = COMMAND_SIZE * (1 if kind == "set" else 2)
+    for start in range(0, len(args), step):
+        yield args[start : start + step]
+
+
+def commands(key, kind, value):
+    for args in arguments(kind, value):
+        yield resp(COMMANDS[kind], key, *args)
+
+
+def write_resp(path, shards=1):
+    """Merge the runs of `OFFLINE_INDEX_DIR` into a stream of commands per
+    shard: in `path`, or in `path.<shard index>` if there are many shards.
+
+    Return the number of commands written."""
+    flush()
+    directory = Path(config.OFFLINE_INDEX_DIR)
+    count = 0
+    for shard in range(shards):
+        runs = sorted(directory.glob("*.{}".format(shard)))
+        target = path if shards == 1 else "{}.{}".format(path, shard)
+        with open(target, "wb") as f:
+            for key, kind, value in merge_runs(runs):
+                for command in commands(key, kind, value):
+                    f.write(command)
+                    count += 1
+    return count
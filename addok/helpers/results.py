@@ -1,5 +1,6 @@
 from addok.config import config
-from addok.helpers import haversine_distance, km_to_score
+from addok.db import DB
+from addok.helpers import fastjson, haversine_distance, keys, km_to_score
 from addok.helpers.text import (
     ascii,
     compare_ngrams,
@@ -29,13 +30,54 @@ def make_labels(helper, result):
         result.labels[0] = label
 
 
-def match_housenumber(helper, result):
-    if not helper.check_housenumber:
-        return
+def housenumber_token(helper):
     # Housenumber may have multiple tokens (eg. "dix huit"), we join
     # those to match the way they have been processed by
     # addok.helpers.index.prepare_housenumbers.
-    raw = "".join(sorted(helper.housenumbers, key=lambda t: t.position))
+    return "".join(sorted(helper.housenumbers, key=lambda t: t.position))
+
+
+def load_housenumbers(results, tokens):
+    """Load the given housenumbers `tokens` of `results`, when they are stored
+    apart from documents (see SPLIT_HOUSENUMBERS)."""
+    pipe = DB.pipeline(transaction=False)
+    for result in results:
+        pipe.hmget(keys.housenumbers_key(result._id), tokens)
+    for result, values in zip(results, pipe.execute()):
+        result._cache["housenumbers"] = {
+            token: fastjson.loads(value)
+            for token, value in zip(tokens, values)
+            if value is not None
+        }
+
+
+def load_housenumbers_around(results, geohashes):
+    """Like `load_housenumbers`, for the housenumbers of the given geohash
+    cells."""
+    fields = [keys.geohash_key(geoh) for geoh in geohashes]
+    pipe = DB.pipeline(transaction=False)
+    for result in results:
+        pipe.hmget(keys.housenumbers_key(result._id), fields)
+    found = []
+    for result, values in zip(results, pipe.execute()):
+        tokens = [t for value in values if value is not None for t in fastjson.loads(value)]
+        found.append(tokens)
+        if tokens:
+            pipe.hmget(keys.housenumbers_key(result._id), tokens)
+    fetched = iter(pipe.execute())
+    for result, tokens in zip(results, found):
+        values = next(fetched) if tokens else []
+        result._cache["housenumbers"] = {
+            token: fastjson.loads(value)
+            for token, value in zip(tokens, values)
+            if value is not None
+        }
+
+
+def match_housenumber(helper, result):
+    if not helper.check_housenumber:
+        return
+    raw = housenumber_token(helper)
     if raw and raw in result.housenumbers:
         data = result.housenumbers[str(raw)]
         result.housenumber = data.pop("raw")
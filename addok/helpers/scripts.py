@@ -1,5 +1,7 @@
 from pathlib import Path
 
+from redis.commands.core import Script
+
 from addok.config import config
 from addok.db import DB
 
@@ -10,4 +12,6 @@ def load_scripts():
     for path in root.glob("*.lua"):
         with path.open() as f:
             name = path.name[:-4]
-            globals()[name] = DB.register_script(f.read())
+            # Bound to the proxy, not to its current client, so scripts are
+            # run on replicas when reading.
+            globals()[name] = Script(DB, f.read())
@@ -2,6 +2,7 @@ from math import ceil
 
 from addok.config import config
 from addok.helpers import iter_pipe
+from addok.helpers.index import token_key_frequencies
 
 
 def preprocess_query(s):
@@ -17,8 +18,15 @@ def tokenize(helper):
 
 
 def search_tokens(helper):
+    # ZCARD tells both if the token exists and its frequency, so resolve all
+    # the unknown tokens in one round-trip.
+    frequencies = dict(getattr(helper, "frequencies", {}))
+    unknown = [t for t in helper.tokens if t not in frequencies]
+    if unknown:
+        found = token_key_frequencies([t.key for t in unknown], sync=True)
+        frequencies.update(zip(unknown, found))
     for token in helper.tokens:
-        token.search()
+        token.resolve(frequencies[token])
 
 
 def set_should_match_threshold(helper):
@@ -1,12 +1,261 @@
-import json
+import threading
 import zlib
 
+try:
+    import msgpack
+    import zstandard
+except ImportError:  # We don't want to make them required dependencies.
+    msgpack = zstandard = None
+
+from addok.config import config
+from addok.db import DB
+from addok.helpers import fastjson
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Id of the current dictionary, and prefix of the dictionaries keys.
+ZSTD_DICTIONARY_KEY = "_zstd_dictionary"
+
 
 class ZlibSerializer:
     @classmethod
     def dumps(cls, data):
-        return zlib.compress(json.dumps(data).encode())
+        return zlib.compress(fastjson.dumpb(data))
+
+    @classmethod
+    def loads(cls, data):
+        return fastjson.loads(zlib.decompress(data))
+
+
+class LazyDocument(dict):
+    """Document whose payload is only decoded when one of its keys is
+    needed."""
+
+    __slots__ = ("_payload", "_loads", "_fields")
+
+    def __init__(self, eager, payload, loads, fields):
+        super().__init__(eager)
+        self._payload = payload
+        self._loads = loads
+        # Eager fields missing from the document are not in the payload.
+        self._fields = fields
+
+    def _needs(self, key):
+        return (
+            self._payload is not None
+            and key not in self._fields
+            and not dict.__contains__(self, key)
+        )
+
+    def _load(self):
+        if self._payload is not None:
+            payload, self._payload = self._payload, None
+            dict.update(self, self._loads(payload))
+
+    def __missing__(self, key):
+        if not self._needs(key):
+            raise KeyError(key)
+        self._load()
+        return self[key]
+
+    def get(self, key, default=None):
+        if self._needs(key):
+            self._load()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if self._needs(key):
+            self._load()
+        return dict.__contains__(self, key)
+
+    def __bool__(self):
+        # Without decoding, a payload is never empty (see `dumps`).
+        return self._payload is not None or dict.__len__(self) > 0
+
+    def __reduce__(self):
+        self._load()
+        return dict, (dict(self.items()),)
+
+
+def _loading(method):
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+for name in (
+    "__eq__",
+    "__ne__",
+    "__iter__",
+    "__len__",
+    "__repr__",
+    "copy",
+    "items",
+    "keys",
+    "pop",
+    "popitem",
+    "setdefault",
+    "update",
+    "values",
+):
+    setattr(LazyDocument, name, _loading(getattr(dict, name)))
+
+
+def eager_fields():
+    """Fields needed to score a document, decoded for every candidate."""
+    # `_score` may be forced by the document, see `Result.score`.
+    fields = {config.ID_FIELD, "id", "type", "importance", "lat", "lon", "_score"}
+    fields.update(config.FILTERS)
+    fields.update(
+        field["key"]
+        for field in config.FIELDS
+        if field["key"] != config.HOUSENUMBERS_FIELD
+    )
+    return fields
+
+
+EAGER_FIELDS = frozenset()
+
+
+@config.on_load
+def load_eager_fields():
+    global EAGER_FIELDS
+    EAGER_FIELDS = frozenset(eager_fields())
+
+
+class ZstdDictionaries:
+    """Zstd dictionaries, stored in the indexes database.
+
+    Each document frame references the id of the dictionary it has been
+    compressed with, so older dictionaries are kept to decode older
+    documents."""
+
+    def __init__(self):
+        self.data = {}  # Dictionary id => ZstdCompressionDict.
+        self.samples = []
+        self.current = None
+        self.local = threading.local()  # Zstd objects are not thread safe.
+        self.lock = threading.Lock()
+
+    def get(self, dict_id):
+        if dict_id not in self.data:
+            raw = DB.instance.get("{}|{}".format(ZSTD_DICTIONARY_KEY, dict_id))
+            if raw is None:
+                raise ValueError("Unknown zstd dictionary {}".format(dict_id))
+            self.data[dict_id] = zstandard.ZstdCompressionDict(raw)
+        return self.data[dict_id]
+
+    def store(self, dictionary, force=False):
+        """Store `dictionary` in Redis and make it the current one, unless
+        another one has already been stored meanwhile (and not `force`)."""
+        dict_id = dictionary.dict_id()
+        self.data[dict_id] = dictionary
+        DB.instance.set(
+            "{}|{}".format(ZSTD_DICTIONARY_KEY, dict_id), dictionary.as_bytes()
+        )
+        if force:
+            DB.instance.set(ZSTD_DICTIONARY_KEY, dict_id)
+        elif not DB.instance.setnx(ZSTD_DICTIONARY_KEY, dict_id):
+            # Another worker was faster, use its dictionary.
+            dict_id = int(DB.instance.get(ZSTD_DICTIONARY_KEY))
+        self.set_current(dict_id)
+
+    def set_current(self, dict_id):
+        self.current = dict_id
+        self.samples = []
+        self.local = threading.local()
+
+    def train(self, samples, force=False):
+        """Return False if there was not enough data to train a dictionary."""
+        try:
+            dictionary = zstandard.train_dictionary(
+                config.ZSTD_DICTIONARY_SIZE, samples
+            )
+        except zstandard.ZstdError:
+            return False
+        self.store(dictionary, force=force)
+        return True
+
+    def compressor(self, sample):
+        if self.current is None:
+            with self.lock:
+                self.check_current(sample)
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            dictionary = self.get(self.current) if self.current else None
+            compressor = zstandard.ZstdCompressor(
+                level=config.ZSTD_LEVEL, dict_data=dictionary
+            )
+            self.local.compressor = compressor
+        return compressor
+
+    def check_current(self, sample):
+        # Look for an existing dictionary at start, and before training.
+        if not self.samples or len(self.samples) >= config.ZSTD_DICTIONARY_SAMPLES:
+            dict_id = DB.instance.get(ZSTD_DICTIONARY_KEY)
+            if dict_id is not None:
+                return self.set_current(int(dict_id))
+        # Train the dictionary on the first documents, the ones before are
+        # compressed without dictionary (see `reencode` command).
+        self.samples.append(sample)
+        if len(self.samples) > config.ZSTD_DICTIONARY_SAMPLES:
+            if not self.train(self.samples):
+                # Not enough data, keep going without dictionary.
+                self.set_current(0)
+
+    def decompressor(self, dict_id):
+        decompressors = getattr(self.local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+        if dict_id not in decompressors:
+            dictionary = self.get(dict_id) if dict_id else None
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressors[dict_id]
+
+
+class MsgpackZstdSerializer:
+    """msgpack + zstd, with a dictionary trained on the first imported
+    documents. Needs `msgpack` and `zstandard` packages.
+
+    Fields not needed for scoring (housenumbers…) are packed apart, and only
+    decoded when accessed (see `LazyDocument`).
+    Documents stored by `ZlibSerializer` can still be read."""
+
+    dictionaries = ZstdDictionaries()
+
+    @classmethod
+    def dumps(cls, data):
+        eager, payload = {}, {}
+        for key, value in data.items():
+            (eager if key in EAGER_FIELDS else payload)[key] = value
+        payload = msgpack.packb(payload, use_bin_type=True) if payload else None
+        packed = msgpack.packb([eager, payload], use_bin_type=True)
+        return cls.dictionaries.compressor(packed).compress(packed)
 
     @classmethod
     def loads(cls, data):
-        return json.loads(zlib.decompress(data).decode())
+        if not data.startswith(ZSTD_MAGIC):
+            return ZlibSerializer.loads(data)
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        packed = cls.dictionaries.decompressor(dict_id).decompress(data)
+        doc = msgpack.unpackb(packed, raw=False)
+        if isinstance(doc, dict):  # Not split.
+            return doc
+        eager, payload = doc
+        if payload is None:
+            return eager
+        return LazyDocument(eager, payload, cls._unpack, EAGER_FIELDS)
+
+    @staticmethod
+    def _unpack(payload):
+        return msgpack.unpackb(payload, raw=False)
+
+    @classmethod
+    def train(cls, docs):
+        """Train and store a new dictionary from a sample of `docs`.
+
+        Return False if there was not enough data."""
+        samples = [msgpack.packb(doc, use_bin_type=True) for doc in docs]
+        return cls.dictionaries.train(samples, force=True)
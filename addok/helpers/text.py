@@ -62,6 +62,13 @@ class Token(str):
         if DB.exists(self.key):
             self.db_key = self.key
 
+    def resolve(self, frequency):
+        """Set token state from an already known frequency (0 means unknown
+        from the index)."""
+        self._frequency = frequency
+        if frequency:
+            self.db_key = self.key
+
     @property
     def is_common(self):
         return self.frequency > config.COMMON_THRESHOLD
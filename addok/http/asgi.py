@@ -0,0 +1,86 @@
+import io
+
+import falcon
+import falcon.asgi
+from falcon.util.sync import wrap_sync_to_async
+
+from addok.config import config, hooks
+
+from .base import CorsMiddleware
+
+
+class BufferedRequest:
+    """ASGI request with an already read body, usable by sync code."""
+
+    def __init__(self, req, body):
+        self._req = req
+        self._media = None
+        self.stream = self.bounded_stream = io.BytesIO(body)
+
+    def get_media(self):
+        if self._media is None:
+            handlers = self.options.media_handlers
+            media_type = (self.content_type or "").split(";")[0].strip()
+            handler = handlers.get(media_type) or handlers.get(
+                self.options.default_media_type
+            )
+            if handler is None:
+                raise falcon.HTTPUnsupportedMediaType()
+            self._media = handler.deserialize(
+                self.bounded_stream, self.content_type, self.content_length
+            )
+        return self._media
+
+    media = property(get_media)
+
+    def __getattr__(self, name):
+        return getattr(self._req, name)
+
+
+class ThreadedResource:
+    """Expose the responders of a sync resource as coroutines.
+
+    Responders are run in the loop default thread pool, so one worker can
+    serve many requests while they are waiting for Redis.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def __getattr__(self, name):
+        attr = getattr(self.resource, name)
+        if not name.startswith("on_") or not callable(attr):
+            return attr
+        responder = wrap_sync_to_async(attr, threadsafe=True)
+
+        async def wrapper(req, resp, **kwargs):
+            # Sync code cannot await the body, so read it beforehand, even
+            # without Content-Length (eg. chunked requests).
+            req = BufferedRequest(req, await req.bounded_stream.read())
+            await responder(req, resp, **kwargs)
+
+        return wrapper
+
+
+class ThreadedRoutes:
+    """Proxy given to `register_http_endpoint` hooks, so plugins resources
+    written for the WSGI app can be used as is."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def add_route(self, uri_template, resource, **kwargs):
+        self.app.add_route(uri_template, ThreadedResource(resource), **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+
+config.load()
+middlewares = [CorsMiddleware()]
+hooks.register_http_middleware(middlewares)
+application = api = falcon.asgi.App(middleware=middlewares)
+# Do not let Falcon split query string on commas.
+application.req_options.auto_parse_qs_csv = False
+application.req_options.strip_url_path_trailing_slash = True
+hooks.register_http_endpoint(ThreadedRoutes(api))
@@ -1,4 +1,3 @@
-import json
 import logging
 import logging.handlers
 from pathlib import Path
@@ -6,9 +5,11 @@ import time
 
 import falcon
 
+from addok.cache import CACHE
 from addok.config import config
-from addok.core import reverse, search
+from addok.core import reverse, search, search_many
 from addok.db import DB
+from addok.helpers import fastjson
 from addok.helpers.text import EntityTooLarge
 
 notfound_logger = None
@@ -80,6 +81,9 @@ class CorsMiddleware:
         resp.set_header("Access-Control-Allow-Origin", "*")
         resp.set_header("Access-Control-Allow-Headers", "X-Requested-With")
 
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
 
 class View:
 
@@ -96,34 +100,47 @@ class View:
             (e.g., {"type": ["street", "city"]})
         """
         filters = {}
-        separator = config.FILTERS_MULTI_VALUE_SEPARATOR
-        
+
         for name in config.FILTERS:
             # Get all values for this parameter (e.g., ?type=street&type=city)
             values = req.get_param_as_list(name)
-            
+
             if not values:
                 continue
-            
-            # If separator is configured, also split individual values
-            # (e.g., ?type=street city → ["street", "city"])
-            if separator:
-                expanded_values = []
-                for value in values:
-                    if separator in value:
-                        expanded_values.extend(v.strip() for v in value.split(separator) if v.strip())
-                    else:
-                        expanded_values.append(value.strip())
-                filters[name] = expanded_values
-            else:
-                # No separator: keep all values from multi-parameters, strip whitespace
-                filters[name] = [v.strip() for v in values if v.strip()]
-        
+
+            filters[name] = self.split_filter_values(values)
+
         return filters
 
+    def split_filter_values(self, values):
+        """Clean a list of raw filter values.
+
+        If FILTERS_MULTI_VALUE_SEPARATOR is set, also splits individual values
+        (e.g., "street city" → ["street", "city"]).
+        """
+        separator = config.FILTERS_MULTI_VALUE_SEPARATOR
+        if separator:
+            expanded_values = []
+            for value in values:
+                if separator in value:
+                    expanded_values.extend(v.strip() for v in value.split(separator) if v.strip())
+                else:
+                    expanded_values.append(value.strip())
+            return expanded_values
+        # No separator: keep all values from multi-parameters, strip whitespace
+        return [v.strip() for v in values if v.strip()]
+
     def render(
         self, req, resp, results, query=None, filters=None, center=None, limit=None
     ):
+        results = self.collection(
+            results, query=query, filters=filters, center=center, limit=limit
+        )
+        self.json(req, resp, results)
+
+    to_geojson = render  # retrocompat.
+
+    def collection(self, results, query=None, filters=None, center=None, limit=None):
         results = {
             "type": "FeatureCollection",
             "version": "draft",
@@ -139,12 +156,10 @@ class View:
             results["center"] = center
         if limit:
             results["limit"] = limit
-        self.json(req, resp, results)
-
-    to_geojson = render  # retrocompat.
+        return results
 
     def json(self, req, resp, content):
-        resp.text = json.dumps(content)
+        resp.data = fastjson.dumpb(content)
         resp.content_type = "application/json; charset=utf-8"
 
     def parse_float(sel, req, *keys):
@@ -160,7 +175,9 @@ class View:
     def parse_lon_lat(self, req):
         lat = self.parse_float(req, "lat", "latitude")
         lon = self.parse_float(req, "lon", "lng", "long", "longitude")
+        return self.check_lon_lat(lon, lat)
 
+    def check_lon_lat(self, lon, lat):
         if lon and (lon > 180 or lon < -180):
             raise falcon.HTTPInvalidParam("out of range", "lon")
         elif lat and (lat > 90 or lat < -90):
@@ -209,6 +226,88 @@ class Search(View):
         )
 
 
+class SearchBatch(View):
+    def on_post(self, req, resp, **kwargs):
+        payload = req.get_media()
+        items = payload.get("queries") if isinstance(payload, dict) else None
+        if not isinstance(items, list):
+            raise falcon.HTTPMissingParam("queries")
+        if len(items) > config.SEARCH_BATCH_MAX_SIZE:
+            raise falcon.HTTPInvalidParam(
+                "too many queries (max {})".format(config.SEARCH_BATCH_MAX_SIZE),
+                "queries",
+            )
+        queries = [self.parse_query(item) for item in items]
+        try:
+            batch = search_many(queries)
+        except EntityTooLarge as e:
+            raise falcon.HTTPContentTooLarge(title=str(e))
+        collections = []
+        for params, results in zip(queries, batch):
+            query = params["query"]
+            if not results:
+                log_notfound(query)
+            log_query(query, results)
+            center = None
+            if params["lon"] and params["lat"]:
+                center = (params["lon"], params["lat"])
+            filters = {k: v for k, v in params.items() if k in config.FILTERS}
+            collections.append(
+                self.collection(
+                    results,
+                    query=query,
+                    filters=filters,
+                    center=center,
+                    limit=params["limit"],
+                )
+            )
+        self.json(req, resp, collections)
+
+    def parse_query(self, item):
+        """Validate one query of the batch, same parameters as /search."""
+        if not isinstance(item, dict):
+            raise falcon.HTTPInvalidParam("must be an object", "queries")
+        query = item.get("q")
+        if not query or not isinstance(query, str):
+            raise falcon.HTTPMissingParam("q")
+        limit = item.get("limit") or 5
+        if not isinstance(limit, int) or limit < 1 or limit > 100:
+            raise falcon.HTTPInvalidParam("out of range (1..100)", "limit")
+        autocomplete = item.get("autocomplete")
+        if autocomplete is None:
+            autocomplete = True
+        lat = self.parse_body_float(item, "lat", "latitude")
+        lon = self.parse_body_float(item, "lon", "lng", "long", "longitude")
+        lon, lat = self.check_lon_lat(lon, lat)
+        params = {
+            "query": query,
+            "limit": limit,
+            "autocomplete": bool(autocomplete),
+            "lat": lat,
+            "lon": lon,
+        }
+        for name in config.FILTERS:
+            values = item.get(name)
+            if not values:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            values = self.split_filter_values([str(v) for v in values])
+            if values:
+                params[name] = values
+        return params
+
+    def parse_body_float(self, item, *keys):
+        for key in keys:
+            val = item.get(key)
+            if val is not None:
+                try:
+                    return float(val)
+                except (ValueError, TypeError):
+                    raise falcon.HTTPInvalidParam("invalid value", key)
+        return None
+
+
 class Reverse(View):
     def on_get(self, req, resp, **kwargs):
         lon, lat = self.parse_lon_lat(req)
@@ -224,15 +323,18 @@ class Reverse(View):
 
 class Health(View):
     def on_get(self, req, resp):
-        return self.json(
-            req,
-            resp,
-            {"status": "HEALTHY", "redis_version": DB.info().get("redis_version")},
-        )
+        status = {
+            "status": "HEALTHY",
+            "redis_version": DB.info().get("redis_version"),
+        }
+        if CACHE:
+            status["results_cache"] = CACHE.stats()
+        return self.json(req, resp, status)
 
 
 def register_http_endpoint(api):
     api.add_route("/search", Search())
+    api.add_route("/search/batch", SearchBatch())
     api.add_route("/reverse", Reverse())
     api.add_route("/health", Health())
 
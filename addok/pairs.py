@@ -1,7 +1,10 @@
 from addok.db import DB
-from addok.helpers import keys, magenta, white
+from addok.helpers import keys, magenta, scripts, white
 from addok.helpers.search import preprocess_query
 
+# Pairs checked by each script call, so Redis is not blocked for too long.
+PAIRS_BY_SCRIPT = 1000
+
 
 def pair_key(s):
     return "p|{}".format(s)
@@ -17,19 +20,38 @@ class PairsIndexer:
 
     @staticmethod
     def deindex(db, key, doc, tokens, **kwargs):
-        tokens = list(set(tokens))  # Unique values.
-        for i, token in enumerate(tokens):
-            for token2 in tokens[i:]:
-                if token != token2:
-                    tmp_key = "|".join(["didx", token, token2])
-                    # Do we have other documents that share token and token2?
-                    commons = db.zinterstore(
-                        tmp_key, [keys.token_key(token), keys.token_key(token2)]
-                    )
-                    db.delete(tmp_key)
-                    if not commons:
-                        db.srem(pair_key(token), token2)
-                        db.srem(pair_key(token2), token)
+        PairsIndexer.deindex_tokens(db, [(key, tokens, tokens)])
+
+    @staticmethod
+    def deindex_tokens(db, changes, **kwargs):
+        # Only the pairs of the removed tokens may be orphans.
+        pairs = set()
+        for key, removed, tokens in changes:
+            for token in set(removed):
+                for token2 in set(tokens):
+                    if token != token2:
+                        pairs.add(tuple(sorted((token, token2))))
+        deindex_pairs(db, pairs)
+
+
+def deindex_pairs(db, pairs):
+    """Remove the pairs no document has anymore."""
+    pairs = list(pairs)
+    orphans = []
+    for start in range(0, len(pairs), PAIRS_BY_SCRIPT):
+        chunk = pairs[start : start + PAIRS_BY_SCRIPT]
+        # Do we have other documents that share token and token2?
+        commons = scripts.have_commons(
+            keys=[keys.token_key(token) for pair in chunk for token in pair],
+            client=db,
+        )
+        orphans.extend(pair for pair, common in zip(chunk, commons) if not common)
+    if orphans:
+        pipe = db.pipeline(transaction=False)
+        for token, token2 in orphans:
+            pipe.srem(pair_key(token), token2)
+            pipe.srem(pair_key(token2), token)
+        pipe.execute()
 
 
 def pair(cmd, word):
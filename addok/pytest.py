@@ -44,9 +44,13 @@ def pytest_runtest_setup(item):
 def pytest_runtest_teardown(item, nextitem):
     from addok import db, ds
     from addok.config import config as addok_config
+    from addok.autocomplete import flush_prefix_indexes
+    from addok.helpers.index import flush_frequencies
 
     assert db.DB.connection_pool.connection_kwargs["db"] == 14
     db.DB.flushdb()
+    flush_frequencies()
+    flush_prefix_indexes()
     if addok_config.DOCUMENT_STORE == ds.RedisStore:
         assert ds._DB.connection_pool.connection_kwargs["db"] == 15
         ds._DB.flushdb()
@@ -83,8 +87,10 @@ class DummyDoc(dict):
 
     def index(self):
         from addok.batch import process_documents
+        from addok.helpers.index import bump_import_generation
 
         process_documents(json.dumps(self.copy()))
+        bump_import_generation()
 
 
 @pytest.fixture
@@ -414,7 +414,7 @@ class Cmd(cmd.Cmd):
         geoh, with_neighbors = self._match_option("NEIGHBORS", geoh)
         key = compute_geohash_key(geoh, with_neighbors != "0")
         if key:
-            for id_ in DB.smembers(key):
+            for id_ in DB.sunion(key.keys):
                 r = Result(id_)
                 print("{} {}".format(white(r), blue(r._id)))
 
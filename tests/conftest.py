@@ -1,4 +1,96 @@
+import shutil
+import socket
+import subprocess
+import time
+
+import pytest
+
+
 def pytest_configure():
     from addok.config import config as addok_config
 
     addok_config.SYNONYMS_PATHS = ["tests/synonyms.txt"]
+
+
+@pytest.fixture
+def round_trips(monkeypatch):
+    """Record the commands sent to the indexes database, by round-trip."""
+    from addok.db import DB
+
+    trips = []
+    pipeline = DB.instance.pipeline
+    execute_command = DB.instance.execute_command
+
+    def pipeline_spy(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def _execute(*args, **kwargs):
+            trips.append([command for command, _ in pipe.command_stack])
+            return execute(*args, **kwargs)
+
+        pipe.execute = _execute
+        return pipe
+
+    def command_spy(*args, **kwargs):
+        trips.append([args])
+        return execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(DB.instance, "pipeline", pipeline_spy)
+    monkeypatch.setattr(DB.instance, "execute_command", command_spy)
+    return trips
+
+
+@pytest.fixture(scope="session")
+def replica_port(tmp_path_factory):
+    """Start a read-only Redis replica of the test server (needs
+    `redis-server`)."""
+    import redis
+
+    from addok.db import DB
+
+    executable = shutil.which("redis-server")
+    if not executable:
+        pytest.skip("redis-server is not installed")
+    kwargs = DB.instance.connection_pool.connection_kwargs
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            executable,
+            "--port", str(port),
+            "--replicaof", kwargs.get("host") or "localhost", str(kwargs.get("port")),
+            "--save", "",
+            "--dir", str(tmp_path_factory.mktemp("replica")),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        client = redis.Redis(port=port)
+        for _ in range(100):
+            try:
+                if client.info("replication").get("master_link_status") == "up":
+                    break
+            except redis.ConnectionError:
+                pass
+            time.sleep(0.1)
+        else:
+            pytest.skip("Redis replica could not sync")
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture
+def replica(replica_port, monkeypatch):
+    """Send the reads to a read-only replica."""
+    import redis
+
+    from addok.db import DB
+
+    kwargs = DB.instance.connection_pool.connection_kwargs
+    client = redis.Redis(port=replica_port, db=kwargs["db"])
+    monkeypatch.setattr(DB, "replicas", [client])
+    return client
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import pytest
+from falcon import testing
+
+
+@pytest.fixture
+def asgi_client():
+    from addok.http.asgi import application
+
+    return testing.TestClient(application)
+
+
+def test_search_should_return_geojson(asgi_client, factory):
+    factory(name="rue des avions")
+    resp = asgi_client.simulate_get("/search/", params={"q": "avions"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/json; charset=utf-8"
+    assert resp.headers["Access-Control-Allow-Origin"] == "*"
+    assert resp.json["features"][0]["properties"]["name"] == "rue des avions"
+
+
+def test_search_without_query_should_return_400(asgi_client):
+    resp = asgi_client.simulate_get("/search")
+    assert resp.status_code == 400
+
+
+def test_search_batch_should_read_body(asgi_client, factory):
+    factory(name="rue des avions")
+    resp = asgi_client.simulate_post(
+        "/search/batch", json={"queries": [{"q": "avions"}, {"q": "xyz"}]}
+    )
+    assert resp.status_code == 200
+    assert resp.json[0]["features"][0]["properties"]["name"] == "rue des avions"
+    assert resp.json[1]["features"] == []
+
+
+def test_search_batch_should_read_chunked_body(factory):
+    from addok.http.asgi import application
+
+    factory(name="rue des avions")
+    body = json.dumps({"queries": [{"q": "avions"}]}).encode()
+    # Falcon test client always sends a Content-Length.
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/search/batch",
+        "raw_path": b"/search/batch",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"content-type", b"application/json"),
+            (b"transfer-encoding", b"chunked"),
+        ],
+        "client": ("127.0.0.1", 1234),
+        "server": ("localhost", 80),
+    }
+    chunks = [body[:10], body[10:]]
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    assert sent[0]["status"] == 200
+    content = json.loads(b"".join(m.get("body", b"") for m in sent[1:]))
+    assert content[0]["features"][0]["properties"]["name"] == "rue des avions"
+
+
+def test_search_batch_should_reject_invalid_json(asgi_client):
+    resp = asgi_client.simulate_post(
+        "/search/batch", body="{invalid", content_type="application/json"
+    )
+    assert resp.status_code == 400
+
+
+def test_reverse_should_return_geojson(asgi_client, factory):
+    factory(name="rue des avions", lat=44, lon=4)
+    resp = asgi_client.simulate_get("/reverse/", params={"lat": "44", "lon": "4"})
+    assert resp.json["features"][0]["properties"]["name"] == "rue des avions"
+
+
+def test_health(asgi_client):
+    resp = asgi_client.simulate_get("/health")
+    assert resp.json["status"] == "HEALTHY"
@@ -1,6 +1,8 @@
 import json
 
-from addok.batch import process_documents, reset
+import pytest
+
+from addok.batch import process_documents, process_file, reset
 from addok.core import search
 from addok.db import DB
 
@@ -51,3 +53,126 @@ def test_force_reset(factory):
     assert DB.keys()
     reset(Args())
     assert not DB.keys()
+
+
+def test_process_file_by_ranges(config, tmp_path):
+    path = tmp_path / "docs.json"
+    docs = [
+        {"_id": str(i), "type": "city", "name": "Ville {}".format(i), "lat": 48.3, "lon": 2.2}
+        for i in range(20)
+    ]
+    path.write_text("\n".join(json.dumps(doc) for doc in docs))
+    config.BATCH_FILE_RANGE_SIZE = 100
+    config.BATCH_CHUNK_SIZE = 3
+    config.BATCH_WORKERS = 2
+    config.INDEX_EDGE_NGRAMS = True  # Changed by process_file, to be restored.
+    process_file(str(path))
+    assert len(DB.zrange("w|ville", 0, -1)) == 20
+
+
+def test_process_msgpack_file_by_ranges(config, tmp_path):
+    msgpack = pytest.importorskip("msgpack")
+    from addok.helpers import load_msgpack_file
+
+    path = tmp_path / "docs.msgpack"
+    docs = [
+        {"_id": str(i), "type": "city", "name": "Ville {}".format(i), "lat": 48.3, "lon": 2.2}
+        for i in range(20)
+    ]
+    path.write_bytes(b"".join(msgpack.packb(doc) for doc in docs))
+    config.BATCH_FILE_LOADER = load_msgpack_file
+    # Documents are already decoded.
+    config.BATCH_PROCESSORS = config.BATCH_PROCESSORS[1:]
+    config.BATCH_FILE_RANGE_SIZE = 100
+    config.BATCH_CHUNK_SIZE = 3
+    config.BATCH_WORKERS = 2
+    config.INDEX_EDGE_NGRAMS = True  # Changed by process_file, to be restored.
+    process_file(str(path))
+    assert len(DB.zrange("w|ville", 0, -1)) == 20
+
+
+def index_content():
+    """Return the content of the index, but the internal keys."""
+    content = {}
+    for key in DB.keys():
+        if key.startswith(b"_"):
+            continue
+        kind = DB.type(key)
+        if kind == b"zset":
+            content[key] = dict(DB.zrange(key, 0, -1, withscores=True))
+        elif kind == b"set":
+            content[key] = DB.smembers(key)
+        elif kind == b"hash":
+            content[key] = DB.hgetall(key)
+    return content
+
+
+DIFF_DOC = {
+    "_id": "lilas",
+    "type": "street",
+    "name": "rue des Lilas",
+    "city": "Andrésy",
+    "postcode": "78570",
+    "lat": "48.32545",
+    "lon": "2.2565",
+    "housenumbers": {"1": {"lat": "48.325451", "lon": "2.25651"}},
+}
+OTHER_DOC = dict(DIFF_DOC, _id="other", city="Paris", housenumbers={})
+
+
+def test_diff_should_skip_unchanged_documents(config, monkeypatch):
+    config.BATCH_DIFF = True
+    process_documents(json.dumps(DIFF_DOC))
+    content = index_content()
+    with monkeypatch.context() as m:
+        m.setattr("addok.ds.DS.instance.fetch", None)  # Not called.
+        process_documents(json.dumps(dict(DIFF_DOC, _action="update")))
+        process_documents(json.dumps(DIFF_DOC))
+    assert index_content() == content
+    assert search("rue des lilas")
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_diff_should_only_write_changes(config, split):
+    config.BATCH_DIFF = True
+    config.SPLIT_HOUSENUMBERS = split
+    changed = dict(
+        DIFF_DOC,
+        name="rue des Roses",
+        postcode="78571",
+        lat="48.4",
+        housenumbers={"2": {"lat": "48.325451", "lon": "2.25651"}},
+    )
+    process_documents(json.dumps(OTHER_DOC), json.dumps(changed))
+    expected = index_content()
+    DB.flushdb()
+    process_documents(json.dumps(OTHER_DOC), json.dumps(DIFF_DOC))
+    process_documents(json.dumps(changed))  # Known, so an update.
+    assert index_content() == expected
+    assert DB.smembers("p|lilas") == {b"rue", b"des", b"paris", b"78570"}
+    assert DB.zrange("w|lilas", 0, -1) == [b"d|other"]
+    assert search("2 rue des roses")[0].housenumber == "2"
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_diff_round_trips_do_not_depend_on_chunk_size(config, round_trips, split):
+    config.BATCH_DIFF = True
+    config.SPLIT_HOUSENUMBERS = split
+    ids = ["lilas{}".format(i) for i in range(20)]
+    process_documents(*(json.dumps(dict(DIFF_DOC, _id=_id)) for _id in ids))
+    round_trips.clear()
+    process_documents(
+        *(json.dumps(dict(DIFF_DOC, _id=_id, name="rue des Roses")) for _id in ids)
+    )
+    assert len(round_trips) < 10
+    assert len(search("rue des roses", limit=20)) == 20
+    assert not search("lilas")
+
+
+def test_diff_should_forget_deleted_documents(config):
+    config.BATCH_DIFF = True
+    process_documents(json.dumps(DIFF_DOC))
+    process_documents(json.dumps({"_id": "lilas", "_action": "delete"}))
+    assert not [key for key in DB.keys() if key.startswith(b"_hashes|") and DB.hlen(key)]
+    process_documents(json.dumps(DIFF_DOC))
+    assert search("rue des lilas")
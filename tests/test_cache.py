@@ -0,0 +1,70 @@
+import pickle
+
+import pytest
+
+from addok import cache
+from addok.core import reverse, search
+from addok.db import DB
+
+
+@pytest.fixture(params=[cache.MemoryCache, cache.RedisCache])
+def results_cache(request, monkeypatch):
+    monkeypatch.setattr(cache._DB, "instance", DB.instance)
+    monkeypatch.setattr(cache.CACHE, "instance", request.param())
+    monkeypatch.setattr(cache.CACHE, "hits", 0)
+    monkeypatch.setattr(cache.CACHE, "misses", 0)
+    return cache.CACHE
+
+
+def test_result_can_be_pickled(street):
+    result = search("ellington")[0]
+    loaded = pickle.loads(pickle.dumps(result))
+    assert loaded.id == result.id
+    assert loaded.score == result.score
+    assert str(loaded) == str(result)
+
+
+def test_search_results_are_cached(factory, results_cache):
+    street = factory(name="rue des Lilas")
+    results = search("rue des lilas")
+    assert results_cache.stats() == {"hits": 0, "misses": 1}
+    cached = search("Rue  des LILAS ")
+    assert results_cache.stats() == {"hits": 1, "misses": 1}
+    assert [r.id for r in cached] == [r.id for r in results] == [street["id"]]
+    assert cached[0].score == results[0].score
+
+
+def test_search_cache_key_includes_parameters(factory, results_cache):
+    factory(name="rue des Lilas", type="street")
+    search("lilas")
+    search("lilas", limit=1)
+    search("lilas", autocomplete=True)
+    search("lilas", type="city")
+    search("lilas", lat=48.1, lon=2.1)
+    assert results_cache.stats() == {"hits": 0, "misses": 5}
+    search("lilas", lat=48.100001, lon=2.100001)
+    search("lilas", type=["city"])
+    assert results_cache.stats() == {"hits": 2, "misses": 5}
+
+
+def test_search_cache_is_invalidated_by_import(factory, results_cache):
+    factory(name="rue des Lilas")
+    assert len(search("lilas")) == 1
+    factory(name="allée des Lilas")
+    assert len(search("lilas")) == 2
+    assert results_cache.stats() == {"hits": 0, "misses": 2}
+
+
+def test_reverse_results_are_cached(factory, results_cache):
+    street = factory(name="rue des Lilas", lat=48.234545, lon=5.235445)
+    results = reverse(lat=48.234545, lon=5.235445)
+    cached = reverse(lat=48.234545, lon=5.235445)
+    assert results_cache.stats() == {"hits": 1, "misses": 1}
+    assert cached[0].id == results[0].id == street["id"]
+
+
+def test_health_should_report_cache_stats(client, results_cache):
+    client.get("/search/", query_string={"q": "lilas"})
+    client.get("/search/", query_string={"q": "lilas"})
+    resp = client.get("/health")
+    assert resp.json["results_cache"] == {"hits": 1, "misses": 1}
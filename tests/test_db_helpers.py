@@ -91,3 +91,102 @@ def test_get_redis_params_detects_redis_document_store(config):
     # Should correctly identify if using Redis for documents
     expected = addok_config.DOCUMENT_STORE == ds.RedisStore
     assert result["use_redis_documents"] == expected
+
+
+def test_extract_redis_config_with_replicas():
+    """Test that replicas inherit the parameters of their section."""
+    config_section = {
+        "host": "primary",
+        "port": 6379,
+        "db": 3,
+        "password": "secret",
+        "replicas": [{"host": "replica1"}, {"host": "replica2", "port": 6380}],
+    }
+
+    result = _extract_redis_config(config_section)
+
+    assert result["host"] == "primary"
+    assert [r["host"] for r in result["replicas"]] == ["replica1", "replica2"]
+    assert [r["port"] for r in result["replicas"]] == [6379, 6380]
+    assert all(r["db"] == 3 for r in result["replicas"])
+    assert all(r["password"] == "secret" for r in result["replicas"])
+    assert "replicas" not in result["replicas"][0]
+
+
+def test_reading_should_route_to_replicas_in_turn(monkeypatch):
+    """Test that reads go to replicas, writes outside `reading` to primary."""
+    import redis
+
+    from addok.db import DB
+
+    kwargs = DB.connection_pool.connection_kwargs
+    # Fake replicas, on other databases of the same server.
+    replicas = [
+        redis.Redis(host=kwargs.get("host"), port=kwargs.get("port"), db=db)
+        for db in (12, 13)
+    ]
+    monkeypatch.setattr(DB, "replicas", replicas)
+    try:
+        replicas[0].set("where", "replica1")
+        replicas[1].set("where", "replica2")
+        DB.set("where", "primary")
+        seen = set()
+        for _ in range(2):
+            with DB.reading():
+                seen.add(DB.get("where"))
+                # Ids are always generated by the primary.
+                DB.next_id()
+        assert seen == {b"replica1", b"replica2"}
+        assert DB.get("where") == b"primary"
+        assert DB.get("_id_sequence") == b"2"
+        assert not replicas[0].exists("_id_sequence")
+    finally:
+        for replica in replicas:
+            replica.flushdb()
+
+
+def test_search_should_run_scripts_on_replica(monkeypatch, factory):
+    """Test that search, including Lua scripts, is run on the replica."""
+    from addok.core import search
+    from addok.db import DB
+
+    street = factory(name="rue des Lilas", city="Paris")
+    # The primary is the replica of itself, but only reachable through the
+    # proxy.
+    calls = []
+    replica = DB.instance
+
+    class Spy:
+        def __getattr__(self, name):
+            calls.append(name)
+            return getattr(replica, name)
+
+    monkeypatch.setattr(DB, "replicas", [Spy()])
+    results = search("rue des lilas paris")
+    assert results[0].id == street["id"]
+    assert "evalsha" in calls
+    assert "pipeline" in calls
+
+
+def test_search_and_reverse_should_not_write_on_replica(replica, factory):
+    """Test that searches with center and filters run on a read-only
+    replica."""
+    import pytest
+    import redis
+
+    from addok.core import reverse, search
+    from addok.db import DB
+
+    street = factory(name="rue des Lilas", postcode="75000", lat=48.32, lon=2.25)
+    factory(name="Lilas", type="city", lat=48.32, lon=2.25)
+    DB.instance.wait(1, 1000)  # Replicated.
+    with pytest.raises(redis.ReadOnlyError):
+        replica.set("foo", "bar")
+    results = search("rue des lilas", lat=48.32, lon=2.25, type="street")
+    assert [r.id for r in results] == [street["id"]]
+    results = search("lilas", lat=48.32, lon=2.25, type=["street", "city"])
+    assert len(results) == 2
+    results = search("lilas", type=["street", "city"], postcode="75000")
+    assert [r.id for r in results] == [street["id"]]
+    results = reverse(48.32, 2.25, limit=2, type=["street", "city"])
+    assert len(results) == 2
@@ -0,0 +1,142 @@
+import os
+
+import pytest
+
+from addok import ds
+from addok.core import search
+from addok.helpers.serializers import ZlibSerializer
+
+
+@pytest.fixture
+def store(config, tmp_path):
+    config.DOCUMENTS_DIR = tmp_path
+    return ds.MmapStore()
+
+
+def test_mmap_store_upsert_and_fetch(store):
+    store.upsert(("d|a", b"aaa"), ("d|b", b"bbbb"))
+    assert list(store.fetch("d|a", b"d|b", "d|c")) == [
+        ("d|a", b"aaa"),
+        (b"d|b", b"bbbb"),
+    ]
+
+
+def test_mmap_store_update(store):
+    store.upsert(("d|a", b"aaa"))
+    assert list(store.fetch("d|a")) == [("d|a", b"aaa")]
+    store.upsert(("d|a", b"updated"))
+    assert list(store.fetch("d|a")) == [("d|a", b"updated")]
+
+
+def test_mmap_store_remove(store):
+    store.upsert(("d|a", b"aaa"), ("d|b", b"bbb"))
+    store.remove("d|a")
+    assert list(store.fetch("d|a", "d|b")) == [("d|b", b"bbb")]
+    assert list(store.scan()) == ["d|b"]
+
+
+def test_mmap_store_index_grows(store):
+    store.upsert(*(("d|{}".format(i), str(i).encode()) for i in range(1500)))
+    store.remove("d|0")
+    store.upsert(*(("d|{}".format(i), str(i).encode()) for i in range(1500, 3000)))
+    assert store._slots > store.MIN_SLOTS
+    assert list(store.fetch("d|0", "d|1", "d|2999")) == [
+        ("d|1", b"1"),
+        ("d|2999", b"2999"),
+    ]
+    assert len(list(store.scan())) == 2999
+
+
+def test_mmap_store_handles_hash_collisions(store, monkeypatch):
+    monkeypatch.setattr(ds, "_hash", lambda key: 42)
+    store.upsert(("d|a", b"aaa"), ("d|b", b"bbb"))
+    store.remove("d|a")
+    assert list(store.fetch("d|a", "d|b")) == [("d|b", b"bbb")]
+
+
+def test_mmap_store_flushdb(store):
+    store.upsert(("d|a", b"aaa"))
+    other = ds.MmapStore()  # Another worker.
+    assert list(other.fetch("d|a")) == [("d|a", b"aaa")]
+    store.flushdb()
+    assert not list(store.fetch("d|a"))
+    assert not list(other.fetch("d|a"))
+    store.upsert(("d|b", b"bbb"))
+    assert list(other.fetch("d|b")) == [("d|b", b"bbb")]
+
+
+def test_mmap_store_is_shared_between_processes(store):
+    store.upsert(("d|a", b"aaa"))
+    assert list(store.fetch("d|a"))
+    pid = os.fork()
+    if not pid:  # Child, like a batch worker.
+        store.upsert(("d|b", b"bbb"))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert list(store.fetch("d|b")) == [("d|b", b"bbb")]
+
+
+def test_search_with_mmap_store(store, factory, monkeypatch):
+    monkeypatch.setattr(ds.DS, "instance", store)
+    doc = factory(name="rue des Lilas")
+    results = search("rue des lilas")
+    assert results[0].id == doc["id"]
+    assert list(store.scan()) == ["d|{}".format(doc["_id"])]
+
+
+@pytest.mark.parametrize("name", ["MmapStore", "LMDBStore"])
+def test_reencode_with_local_store(name, config, tmp_path, monkeypatch):
+    from addok.batch import reencode
+
+    class Args:
+        source = None
+
+    if name == "LMDBStore":
+        pytest.importorskip("lmdb")
+    config.DOCUMENTS_DIR = tmp_path
+    config.DOCUMENT_STORE = getattr(ds, name)
+    store = config.DOCUMENT_STORE()
+    config.BATCH_CHUNK_SIZE = 2
+    monkeypatch.setattr(ds, "SCAN_COUNT", 2)
+    monkeypatch.setattr(ds.DS, "instance", store)
+    store.upsert(*(("d|{}".format(i), ZlibSerializer.dumps({"i": i})) for i in range(5)))
+    upserted = []
+    upsert = store.upsert
+
+    def spy(*docs):
+        upserted.extend(key for key, _ in docs)
+        assert len(upserted) <= 5, "Documents reencoded many times"
+        upsert(*docs)
+
+    monkeypatch.setattr(store, "upsert", spy)
+    reencode(Args())
+    assert sorted(upserted) == ["d|{}".format(i) for i in range(5)]
+    assert ZlibSerializer.loads(dict(store.fetch("d|3"))["d|3"]) == {"i": 3}
+
+
+@pytest.fixture
+def lmdb_store(config, tmp_path):
+    pytest.importorskip("lmdb")
+    config.DOCUMENTS_DIR = tmp_path
+    return ds.LMDBStore()
+
+
+def test_lmdb_store_upsert_fetch_and_remove(lmdb_store):
+    lmdb_store.upsert(("d|a", b"aaa"), (b"d|b", b"bbbb"))
+    assert list(lmdb_store.fetch("d|a", b"d|b", "d|c")) == [
+        ("d|a", b"aaa"),
+        (b"d|b", b"bbbb"),
+    ]
+    lmdb_store.upsert(("d|a", b"updated"))
+    lmdb_store.remove("d|b")
+    assert list(lmdb_store.fetch("d|a", "d|b")) == [("d|a", b"updated")]
+    assert list(lmdb_store.scan()) == ["d|a"]
+    lmdb_store.flushdb()
+    assert not list(lmdb_store.fetch("d|a"))
+
+
+def test_search_with_lmdb_store(lmdb_store, factory, monkeypatch):
+    monkeypatch.setattr(ds.DS, "instance", lmdb_store)
+    doc = factory(name="rue des Lilas")
+    results = search("rue des lilas")
+    assert results[0].id == doc["id"]
@@ -77,6 +77,56 @@ def test_centered_search_should_return_center(client, factory):
     assert resp.json["center"] == [4, 44]
 
 
+def test_search_batch_should_return_one_collection_per_query(client, factory):
+    factory(name="rue des avions")
+    factory(name="Paris", type="city")
+    resp = client.simulate_post(
+        "/search/batch",
+        json={"queries": [{"q": "avions"}, {"q": "paris", "limit": 1}, {"q": "xyz"}]},
+    )
+    assert resp.status_code == 200
+    assert len(resp.json) == 3
+    assert resp.json[0]["type"] == "FeatureCollection"
+    assert resp.json[0]["query"] == "avions"
+    assert resp.json[0]["features"][0]["properties"]["name"] == "rue des avions"
+    assert resp.json[1]["limit"] == 1
+    assert resp.json[1]["features"][0]["properties"]["name"] == "Paris"
+    assert resp.json[2]["features"] == []
+
+
+def test_search_batch_can_be_filtered_and_centered(client, factory):
+    factory(name="rue de Paris", type="street")
+    factory(name="Paris", type="city")
+    resp = client.simulate_post(
+        "/search/batch",
+        json={"queries": [{"q": "paris", "type": "city", "lat": 44, "lon": 4}]},
+    )
+    assert resp.json[0]["filters"] == {"type": ["city"]}
+    assert resp.json[0]["center"] == [4, 44]
+    assert len(resp.json[0]["features"]) == 1
+    assert resp.json[0]["features"][0]["properties"]["type"] == "city"
+
+
+def test_search_batch_should_validate_queries(client, config):
+    resp = client.simulate_post("/search/batch", json={})
+    assert resp.status_code == 400
+    resp = client.simulate_post("/search/batch", json={"queries": [{"limit": 2}]})
+    assert resp.status_code == 400
+    resp = client.simulate_post(
+        "/search/batch", json={"queries": [{"q": "paris", "limit": 1000}]}
+    )
+    assert resp.status_code == 400
+    resp = client.simulate_post(
+        "/search/batch", json={"queries": [{"q": "paris", "lat": "foo"}]}
+    )
+    assert resp.status_code == 400
+    config.SEARCH_BATCH_MAX_SIZE = 1
+    resp = client.simulate_post(
+        "/search/batch", json={"queries": [{"q": "paris"}, {"q": "lille"}]}
+    )
+    assert resp.status_code == 400
+
+
 def test_reverse_should_return_geojson(client, factory):
     factory(name="rue des avions", lat=44, lon=4)
     resp = client.get("/reverse/", query_string={"lat": "44", "lon": "4"})
@@ -3,9 +3,11 @@ import sys
 import pytest
 
 from addok import ds
+from addok import autocomplete
 from addok.autocomplete import create_edge_ngrams, index_edge_ngrams
 from addok.batch import process_documents
 from addok.db import DB
+from addok.helpers.index import GENERATION_KEY
 
 
 def index_document(doc):
@@ -16,6 +18,11 @@ def deindex_document(_id):
     process_documents(json.dumps({"_id": _id, "_action": "delete"}))
 
 
+def index_keys():
+    """Return the keys of the test database, but the index generation."""
+    return [k for k in DB.keys() if k != GENERATION_KEY.encode()]
+
+
 def count_keys():
     """Helper method to return the number of keys in the test database."""
     try:
@@ -78,7 +85,7 @@ def test_index_document():
     assert b"d|yyyy" in DB.smembers("f|type|street")
     assert DB.exists("f|type|housenumber")
     assert b"d|yyyy" in DB.smembers("f|type|housenumber")
-    assert len(DB.keys()) == 17
+    assert len(index_keys()) == 17
     assert len(ds._DB.keys()) == 1
 
 
@@ -110,7 +117,29 @@ def test_deindex_document_should_deindex():
     assert not DB.exists("n|andre")
     assert not DB.exists("n|andres")
     assert not DB.exists("f|type|street")
-    assert len(DB.keys()) == 0
+    assert len(index_keys()) == 0
+    assert len(ds._DB.keys()) == 0
+
+
+def test_index_document_with_split_housenumbers(config):
+    config.SPLIT_HOUSENUMBERS = True
+    index_document(DOC.copy())
+    assert "housenumbers" not in ds.get_document("d|yyyy")
+    stored = {k: json.loads(v) for k, v in DB.hgetall("h|yyyy").items()}
+    assert stored == {
+        b"1": {"lat": "48.325451", "lon": "2.25651", "raw": "1"},
+        b"g|u09dgm7": ["1"],
+    }
+    assert b"d|yyyy" in DB.smembers("g|u09dgm7")
+
+
+def test_deindex_document_with_split_housenumbers(config):
+    config.SPLIT_HOUSENUMBERS = True
+    index_document(DOC.copy())
+    deindex_document(DOC["_id"])
+    assert not DB.exists("h|yyyy")
+    assert not DB.exists("g|u09dgm7")
+    assert len(index_keys()) == 0
     assert len(ds._DB.keys()) == 0
 
 
@@ -163,7 +192,7 @@ def test_deindex_document_should_not_affect_other_docs():
     assert b"d|yyyy2" in DB.smembers("f|type|street")
     assert DB.exists("f|type|housenumber")
     assert b"d|yyyy2" in DB.smembers("f|type|housenumber")
-    assert len(DB.keys()) == 16
+    assert len(index_keys()) == 16
     assert len(ds._DB.keys()) == 1
 
 
@@ -197,7 +226,7 @@ def test_deindex_document_should_deindex_list_values():
     assert not ds._DB.exists("d|yyyy")
     assert not DB.exists("w|vernou")
     assert not DB.exists("w|celle")
-    assert len(DB.keys()) == 0
+    assert len(index_keys()) == 0
 
 
 def test_deindex_document_should_not_fail_if_id_do_not_exist():
@@ -321,13 +350,144 @@ def test_create_edge_ngrams(config):
     assert DB.exists("n|pa")
     assert DB.exists("n|par")
     assert not DB.exists("n|28")
-    assert len(DB.keys()) == 13
+    assert len(index_keys()) == 13
     assert len(ds._DB.keys()) == 1
 
 
+def test_create_edge_ngrams_with_top_documents(config):
+    config.AUTOCOMPLETE_TOP_K = 1
+    config.INDEX_EDGE_NGRAMS = False
+    index_document(dict(DOC, _id="low", importance=0.1))
+    index_document(dict(DOC, _id="high", importance=0.9))
+    assert not DB.exists("t|lil")
+    create_edge_ngrams()
+    assert DB.zrange("t|lil", 0, -1) == [b"d|high"]
+    assert DB.zrange("t|and", 0, -1) == [b"d|high"]
+
+
+def test_scan_partitions_cover_all_keys(monkeypatch):
+    monkeypatch.setattr(autocomplete, "SCAN_COUNT", 10)
+    expected = {"w|token{}".format(i).encode() for i in range(1000)}
+    for key in expected:
+        DB.zadd(key, {"d|doc": 1})
+    DB.sadd("n|tok", "token1")
+    scanned = set()
+    for partition in range(autocomplete.SCAN_PARTITIONS):
+        scanned.update(autocomplete.scan_partition(DB, partition, match="w|*"))
+    assert scanned == expected
+
+
+def test_index_ngram_keys_sends_one_command_per_ngram(round_trips):
+    autocomplete.index_ngram_keys(b"w|lilas", b"w|lila", b"w|lilou")
+    sent = [args for trip in round_trips for args in trip]
+    commands = [args for args in sent if args[1] == "n|lil"]
+    assert len(commands) == 1
+    assert sorted(commands[0][2:]) == ["lila", "lilas", "lilou"]
+    assert DB.smembers("n|lila") == {b"lilas"}
+
+
+def test_prefix_index_complete():
+    index = autocomplete.PrefixIndex(
+        None,
+        [("lilas", 3, 1.0), ("lila", 1, 2.0), ("lion", 5, 0.5), ("lil", 9, 9.0)],
+    )
+    assert index.complete("lil", []) == [b"w|lilas", b"w|lila"]
+    assert index.complete("lil", [], by_score=True) == [b"w|lila", b"w|lilas"]
+    assert index.complete("li", []) == []  # Shorter than MIN_EDGE_NGRAMS.
+    DB.sadd("p|rue", "lila")
+    assert index.complete("lil", ["p|rue"]) == [b"w|lila"]
+
+
 def test_index_document_with_custom_id(config):
     config.ID_FIELD = "custom"
     doc = DOC.copy()
     doc["custom"] = "custom_id"
     index_document(doc)
     assert ds._DB.exists("d|custom_id")
+
+
+def test_indexing_should_change_generation():
+    index_document(DOC.copy())
+    generation = DB.get(GENERATION_KEY)
+    assert generation
+    deindex_document(DOC["_id"])
+    assert DB.get(GENERATION_KEY) != generation
+
+
+def test_token_frequencies_are_cached_until_index_changes(factory):
+    from addok.helpers.index import token_key_frequencies, token_key_frequency
+
+    factory(name="rue des lilas")
+    assert token_key_frequencies(["w|lilas", "w|rue"], sync=True) == [1, 1]
+    # Out of band write, the index generation has not changed.
+    DB.zadd("w|lilas", {"d|other": 1})
+    assert token_key_frequency("w|lilas") == 1
+    assert token_key_frequencies(["w|lilas"], sync=True) == [1]
+    factory(name="lilas")
+    assert token_key_frequencies(["w|lilas", "w|rue"], sync=True) == [3, 1]
+    assert token_key_frequency("w|lilas") == 3
+
+
+def test_token_frequencies_generation_is_checked_once_per_interval(factory, config):
+    from addok.helpers.index import token_key_frequencies
+
+    config.FREQUENCY_CACHE_CHECK_INTERVAL = 60
+    factory(name="rue des lilas")
+    assert token_key_frequencies(["w|lilas", "w|rue"], sync=True) == [1, 1]
+    factory(name="lilas")
+    # All cached, and checked less than 60 seconds ago: no round-trip.
+    assert token_key_frequencies(["w|lilas", "w|rue"], sync=True) == [1, 1]
+    # A missing frequency checks the generation in the same round-trip.
+    assert token_key_frequencies(["w|lilas", "w|des"], sync=True) == [2, 1]
+
+
+def test_token_frequencies_of_missing_keys_can_be_left_uncached(factory):
+    from addok.helpers.index import cached_frequency, token_key_frequencies
+
+    factory(name="rue des lilas")
+    keys = ["w|lilas", "w|lilaz"]
+    assert token_key_frequencies(keys, cache_missing=False) == [1, 0]
+    assert cached_frequency("w|lilas") == 1
+    assert cached_frequency("w|lilaz") is None
+
+
+def test_token_frequencies_cache_can_be_disabled(factory, config):
+    from addok.helpers.index import token_key_frequency
+
+    config.FREQUENCY_CACHE_SIZE = 0
+    factory(name="rue des lilas")
+    assert token_key_frequency("w|lilas") == 1
+    DB.zadd("w|lilas", {"d|other": 1})
+    assert token_key_frequency("w|lilas") == 2
+
+
+def test_index_documents_sends_one_command_per_key(round_trips):
+    process_documents(
+        *(
+            json.dumps(dict(DOC, _id=_id, housenumbers={}))
+            for _id in ("a", "b", "c")
+        )
+    )
+    sent = [args for trip in round_trips for args in trip]
+    filters = [args for args in sent if args[1] == "f|type|street"]
+    assert len(filters) == 1
+    assert sorted(filters[0][2:]) == ["d|a", "d|b", "d|c"]
+    assert len([args for args in sent if args[1] == "w|lilas"]) == 1
+    assert DB.zrange("w|lilas", 0, -1) == [b"d|a", b"d|b", b"d|c"]
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_deindex_documents_round_trips_do_not_depend_on_chunk_size(
+    config, round_trips, split
+):
+    config.INDEX_EDGE_NGRAMS = True
+    config.SPLIT_HOUSENUMBERS = split
+    ids = ["doc{}".format(i) for i in range(20)]
+    process_documents(*(json.dumps(dict(DOC, _id=_id)) for _id in ids))
+    round_trips.clear()
+    process_documents(
+        *(json.dumps({"_id": _id, "_action": "delete"}) for _id in ids)
+    )
+    assert len(round_trips) < 10
+    assert index_keys() == []
+    assert not ds._DB.keys()
@@ -0,0 +1,162 @@
+import json
+
+import pytest
+
+from addok.batch import process_documents, run
+from addok.db import DB
+from addok.helpers import offline
+from addok.helpers.index import GENERATION_KEY
+
+DOCS = [
+    {
+        "_id": "a",
+        "type": "street",
+        "name": "rue des Lilas",
+        "city": "Andrésy",
+        "postcode": "78570",
+        "lat": "48.32545",
+        "lon": "2.2565",
+        "housenumbers": {"1": {"lat": "48.325451", "lon": "2.25651"}},
+    },
+    {
+        "_id": "b",
+        "type": "city",
+        "name": "Andrésy",
+        "postcode": "78570",
+        "lat": "48.98",
+        "lon": "2.05",
+        "importance": 0.8,
+    },
+]
+
+
+def snapshot():
+    """Return the content of the index, but the generation."""
+    content = {}
+    for key in DB.keys():
+        if key == GENERATION_KEY.encode():
+            continue
+        kind = DB.type(key)
+        if kind == b"zset":
+            content[key] = dict(DB.zrange(key, 0, -1, withscores=True))
+        elif kind == b"set":
+            content[key] = DB.smembers(key)
+        elif kind == b"hash":
+            content[key] = DB.hgetall(key)
+        else:
+            content[key] = DB.get(key)
+    return content
+
+
+def load(path, count):
+    connection = DB.connection_pool.get_connection()
+    try:
+        with open(path, "rb") as f:
+            connection.send_packed_command([f.read()])
+        for _ in range(count):
+            connection.read_response()
+    finally:
+        DB.connection_pool.release(connection)
+
+
+@pytest.fixture
+def offline_dir(config, tmp_path):
+    config.OFFLINE_INDEX_DIR = tmp_path / "runs"
+    config.OFFLINE_INDEX_DIR.mkdir()
+    return config.OFFLINE_INDEX_DIR
+
+
+def test_resp_stream_is_the_same_as_live_index(config, offline_dir, tmp_path):
+    config.OFFLINE_INDEX_DIR = None
+    process_documents(*(json.dumps(doc) for doc in DOCS))
+    expected = snapshot()
+    DB.flushdb()
+    config.OFFLINE_INDEX_DIR = offline_dir
+    process_documents(json.dumps(DOCS[0]))
+    offline.flush()  # Two runs to merge.
+    process_documents(json.dumps(DOCS[1]))
+    assert not snapshot()
+    count = offline.write_resp(tmp_path / "dump.resp")
+    load(tmp_path / "dump.resp", count)
+    assert snapshot() == expected
+    assert DB.exists(GENERATION_KEY)
+
+
+def test_spilled_sorted_sets_are_trimmed(offline_dir):
+    postings = offline.Postings(0)
+    postings.zadd("t|lil", {"d|a": 1.0, "d|b": 3.0})
+    postings.ztrim("t|lil", 2)
+    postings.spill()
+    assert not postings.trims
+    postings.zadd("t|lil", {"d|c": 2.0, "d|d": 0.5})
+    postings.ztrim("t|lil", 2)
+    postings.zadd("w|lilas", {"d|a": 1.0, "d|b": 3.0, "d|c": 2.0})
+    postings.spill()
+    merged = list(offline.merge_runs(sorted(offline_dir.iterdir())))
+    assert merged == [
+        ("t|lil", "zset", {"d|b": 3.0, "d|c": 2.0}),
+        ("w|lilas", "zset", {"d|a": 1.0, "d|b": 3.0, "d|c": 2.0}),
+    ]
+
+
+def test_commands_are_chunked(monkeypatch):
+    monkeypatch.setattr(offline, "COMMAND_SIZE", 2)
+    commands = list(offline.commands("w|rue", "zset", {"d|a": 1.0, "d|b": 0.5, "d|c": 2.0}))
+    assert commands == [
+        offline.resp("ZADD", "w|rue", 1.0, "d|a", 0.5, "d|b"),
+        offline.resp("ZADD", "w|rue", 2.0, "d|c"),
+    ]
+    assert offline.resp("SADD", "f|type|city", "d|a") == (
+        b"*3\r\n$4\r\nSADD\r\n$11\r\nf|type|city\r\n$3\r\nd|a\r\n"
+    )
+
+
+def test_postings_hdel_is_sent_before_writes():
+    DB.hset("_hashes|abcd", mapping={"a": "1", "b": "2"})
+    postings = offline.Postings(0, client=DB.instance)
+    postings.hset("_hashes|abcd", mapping={"c": "3", "b": "4"})
+    postings.hdel("_hashes|abcd", "a", "b")
+    postings.hdel("_hashes|abcd", "c")
+    postings.hset("_hashes|abcd", "c", "5")
+    postings.execute()
+    assert DB.hgetall("_hashes|abcd") == {b"c": b"5"}
+    assert not postings.deletes
+
+
+def test_postings_forward_other_commands_to_a_pipeline():
+    DB.sadd("f|type|city", "d|a", "d|b")
+    postings = offline.Postings(0, client=DB.instance)
+    postings.srem("f|type|city", "d|a")
+    postings.expire("f|type|city", 100)
+    postings.sadd("f|type|street", "d|c")
+    assert DB.sismember("f|type|city", "d|a")  # Nothing sent before execute.
+    postings.execute()
+    assert DB.smembers("f|type|city") == {b"d|b"}
+    assert DB.ttl("f|type|city") > 0
+    assert DB.smembers("f|type|street") == {b"d|c"}
+    assert postings.pipe is None
+
+
+def test_offline_postings_do_not_forward_commands():
+    postings = offline.Postings(0)
+    with pytest.raises(AttributeError):
+        postings.srem("f|type|city", "d|a")
+
+
+def test_batch_command_with_resp(config, tmp_path):
+    class Args:
+        filepath = [str(tmp_path / "docs.json")]
+        resp = str(tmp_path / "dump.resp")
+
+    with open(Args.filepath[0], "w") as f:
+        f.write("\n".join(json.dumps(doc) for doc in DOCS))
+    config.BATCH_WORKERS = 2
+    config.INDEX_EDGE_NGRAMS = True  # Changed by the command, to be restored.
+    run(Args())
+    assert not snapshot()
+    assert config.OFFLINE_INDEX_DIR is None
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["docs.json", "dump.resp"]
+    with open(Args.resp, "rb") as f:
+        stream = f.read()
+    assert b"w|lilas" in stream
+    assert b"f|type|city" in stream
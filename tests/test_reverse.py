@@ -16,6 +16,21 @@ def test_reverse_return_housenumber(factory):
     assert not results[0].raw
 
 
+def test_reverse_return_split_housenumber(factory, config):
+    config.SPLIT_HOUSENUMBERS = True
+    factory(
+        housenumbers={
+            "24": {"lat": 48.234545, "lon": 5.235445, "key": "value"},
+            "26": {"lat": 48.9, "lon": 5.9},  # Not in the neighbourhood.
+        }
+    )
+    results = reverse(lat=48.234545, lon=5.235445)
+    assert results[0].housenumber == "24"
+    assert results[0].type == "housenumber"
+    assert results[0].key == "value"
+    assert list(results[0].housenumbers) == ["24"]
+
+
 def test_reverse_can_be_limited(factory):
     factory(lat=48.234545, lon=5.235445)
     factory(lat=48.234546, lon=5.235446)
@@ -1,3 +1,4 @@
+from addok.db import DB
 from addok.helpers import scripts
 
 
@@ -49,6 +50,23 @@ def test_zinter(factory):
     ]
 
 
+def test_zinter_with_unions(factory):
+    street = factory(name="rue des lilas", type="street", postcode="75010")
+    city = factory(name="lilas", type="city", postcode="93260")
+    factory(name="lilas", type="locality", postcode="75010")
+    before = set(DB.keys())
+    keys = ["w|lilas", "f|type|street", "f|type|city"]
+    results = scripts.zinter(keys=keys, args=["tmp", 10, 1, 2])
+    assert sorted(results) == sorted(
+        "d|{}".format(doc["_id"]).encode() for doc in (street, city)
+    )
+    # Only unions.
+    keys += ["f|postcode|75010", "f|postcode|75011"]
+    results = scripts.zinter(keys=keys[1:], args=["tmp", 10, 0, 2, 2])
+    assert results == ["d|{}".format(street["_id"]).encode()]
+    assert set(DB.keys()) == before  # Nothing written.
+
+
 def test_order_by_frequency(factory):
     factory(name="rue de la monnaie", city="Vitry")
     factory(name="rue des lilas", city="Vitry")
@@ -67,3 +85,46 @@ def test_order_by_max_score(factory):
     factory(name="Vitry", importance=0.5)
     keys = ["w|monnaie", "w|lilas", "w|vitry", "w|rue"]
     assert scripts.order_by_max_score(keys=keys)[0] == b"w|vitry"
+
+
+def test_setstore_union(factory):
+    from addok.db import DB
+
+    factory(name="rue de Paris", type="street")
+    factory(name="Paris", type="city")
+    factory(name="Lyon", type="town")
+    keys = ["f|type|street|city", "f|type|street", "f|type|city"]
+    assert scripts.setstore(keys=keys, args=["union", 10, 0, 0]) == [2, 1]
+    assert DB.scard("f|type|street|city") == 2
+    assert 0 < DB.ttl("f|type|street|city") <= 10
+    # Reused when asked.
+    assert scripts.setstore(keys=keys, args=["union", 10, 0, 1]) == [2, 0]
+
+
+def test_setstore_union_should_persist_large_sets(factory):
+    from addok.db import DB
+
+    factory(name="rue de Paris", type="street")
+    factory(name="Paris", type="city")
+    keys = ["f|type|street|city", "f|type|street", "f|type|city"]
+    assert scripts.setstore(keys=keys, args=["union", 10, 1, 0]) == [2, 1]
+    assert DB.ttl("f|type|street|city") == -1
+
+
+def test_setstore_inter(factory):
+    from addok.db import DB
+
+    factory(name="rue de Paris", type="street", postcode="75010")
+    factory(name="rue de Lyon", type="street", postcode="69001")
+    keys = ["combined:test", "f|type|street", "f|postcode|75010"]
+    assert scripts.setstore(keys=keys, args=["inter", 10, 0, 1]) == [1, 1]
+    assert 0 < DB.ttl("combined:test") <= 10
+
+
+def test_setstore_should_not_keep_empty_key(factory):
+    from addok.db import DB
+
+    factory(name="rue de Paris", type="street")
+    keys = ["gx|u09tv", "g|u09tv", "g|u09tw"]
+    assert scripts.setstore(keys=keys, args=["union", 10, 0, 0]) == [0, 1]
+    assert not DB.exists("gx|u09tv")
@@ -1,4 +1,11 @@
-from addok.core import Result, search
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from addok.core import Result, Search, search, search_many
+from addok.db import DB
 from addok.helpers import collectors
 
 
@@ -56,23 +63,84 @@ def test_should_give_priority_to_best_match3(street, factory):
     assert results[0].id == other["id"]
 
 
-def test_should_be_fuzzy_of_1_by_default(city, config):
+@pytest.mark.parametrize("deletes", [False, True])
+def test_should_be_fuzzy_of_1_by_default(city, config, deletes):
     config.FUZZY_KEY_MAP = None
+    config.FUZZY_DELETES_INDEX = deletes
     city.update(name="Andrésy")
     assert search("antresy")
     assert not search("antresu")
 
 
-def test_fuzzy_should_work_with_inversion(city):
+@pytest.mark.parametrize("deletes", [False, True])
+def test_fuzzy_should_work_with_inversion(city, config, deletes):
+    config.FUZZY_DELETES_INDEX = deletes
     city.update(name="Andrésy")
     assert search("andreys")
 
 
-def test_fuzzy_should_match_with_removal(city):
+@pytest.mark.parametrize("deletes", [False, True])
+def test_fuzzy_should_match_with_removal(city, config, deletes):
+    config.FUZZY_DELETES_INDEX = deletes
     city.update(name="Andrésy")
     assert search("andressy")
 
 
+def test_fuzzy_should_check_lone_token_neighbors_at_once(city, monkeypatch):
+    city.update(name="Andrésy")
+    sent = []
+    execute_command = DB.instance.execute_command
+
+    def spy(*args, **kwargs):
+        sent.append(args[0])
+        return execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(DB.instance, "execute_command", spy)
+    assert search("andreys")
+    assert "ZCARD" not in sent
+
+
+def test_concurrent_fuzzy_searches_should_not_mix(factory, monkeypatch):
+    for name in ("rue des lilas", "rue des roses", "rue des tulipes"):
+        factory(name=name, city="Paris")
+    queries = {"lilos paris": "w|lilas", "rosas paris": "w|roses"}
+    added = []
+    add_to_bucket = Search.add_to_bucket
+
+    def spy(self, keys, *args, **kwargs):
+        added.append((self.query, set(keys)))
+        return add_to_bucket(self, keys, *args, **kwargs)
+
+    monkeypatch.setattr(Search, "add_to_bucket", spy)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        found = list(executor.map(search, list(queries) * 100))
+    assert all(found)
+    for query, keys in added:
+        # Fuzzy candidates of a query are never the ones of another one.
+        for other, token in queries.items():
+            assert other == query or token not in keys
+
+
+def test_fuzzy_with_deletes_index_should_use_pairs(factory, config):
+    config.FUZZY_DELETES_INDEX = True
+    factory(name="rue des lilas", city="Paris")
+    factory(name="rue des lilis", city="Lyon")
+    assert DB.smembers("x|lils") == {b"lilas", b"lilis"}
+    results = search("lilos paris")
+    assert [r.name for r in results] == ["rue des lilas"]
+
+
+def test_deletes_index_should_be_cleaned_when_token_is_deindexed(factory, config):
+    config.FUZZY_DELETES_INDEX = True
+    doc = factory(name="rue des lilas", city="Paris")
+    factory(name="place des lilas", city="Lyon")
+    doc.update(name="place des tilleuls", city="Lyon", _action="update")
+    assert DB.smembers("x|lils") == {b"lilas"}
+    indexed = {m for k in DB.keys("x|*") for m in DB.smembers(k)}
+    assert b"paris" not in indexed
+    assert all(DB.exists(b"w|" + token) for token in indexed)
+
+
 def test_should_give_priority_to_housenumber_if_match(housenumber):
     housenumber.update(name="rue des Berges")
     results = search("rue des berges")
@@ -82,6 +150,23 @@ def test_should_give_priority_to_housenumber_if_match(housenumber):
     assert results[0].type == "housenumber"
 
 
+def test_should_match_split_housenumbers(factory, config):
+    config.SPLIT_HOUSENUMBERS = True
+    factory(
+        name="rue des Berges",
+        housenumbers={
+            "11": {"lat": "48.3254", "lon": "2.256"},
+            "12": {"lat": "48.3255", "lon": "2.257"},
+        },
+    )
+    results = search("rue des berges")
+    assert not results[0].housenumber
+    results = search("11 rue des berges")
+    assert results[0].housenumber == "11"
+    assert results[0].type == "housenumber"
+    assert results[0].lat == "48.3254"
+
+
 def test_return_housenumber_if_number_included_in_bigger_one(factory):
     factory(name="rue 1814", housenumbers={"8": {"lat": "48.3254", "lon": "2.256"}})
     results = search("rue 1814")
@@ -289,6 +374,160 @@ def test_should_autocomplete_if_only_housenumbers_but_geohash(factory, config):
     assert results[0].name == "rue descartes"
 
 
+def wait_prefix_indexes():
+    from addok import autocomplete
+
+    for thread in list(autocomplete._PREFIX_LOADS.values()):
+        thread.join()
+
+
+def test_prefix_index_should_autocomplete_without_ngrams(factory, config):
+    from addok.autocomplete import warm_prefix_indexes
+
+    config.PREFIX_INDEX = True
+    config.COMMON_THRESHOLD = 3
+    config.BUCKET_MAX = 3
+    factory(name="rue de la montagne", city="Vitry")
+    factory(name="rue du mont", city="Vitry")
+    factory(name="rue des tilleuls", city="Montreuil")
+    assert not DB.keys("n|*")
+    warm_prefix_indexes()
+    assert len(search("rue mont", autocomplete=True)) == 3
+    results = search("tilleuls mont", autocomplete=True)
+    assert [r.name for r in results] == ["rue des tilleuls"]
+
+
+def test_prefix_index_should_use_ngrams_until_loaded(factory, config, monkeypatch):
+    from addok import autocomplete
+
+    factory(name="rue de la monnaie")  # Edge ngrams are indexed.
+    config.PREFIX_INDEX = True
+    loaded = threading.Event()
+    load = autocomplete.PrefixIndex.load
+
+    def slow_load(db):
+        loaded.wait(5)
+        return load(db)
+
+    monkeypatch.setattr(autocomplete.PrefixIndex, "load", slow_load)
+    assert search("rue de la monn", autocomplete=True)
+    assert autocomplete.prefix_index() is None
+    loaded.set()
+    wait_prefix_indexes()
+    assert autocomplete.prefix_index() is not None
+
+
+def test_prefix_index_should_be_reloaded_after_import(factory, config):
+    from addok.autocomplete import warm_prefix_indexes
+
+    config.PREFIX_INDEX = True
+    factory(name="rue de la monnaie", city="Vitry")
+    warm_prefix_indexes()
+    assert search("rue de la mon", autocomplete=True)
+    assert not search("avenue mag", autocomplete=True)
+    factory(name="avenue magenta", city="Paris")
+    search("avenue mag", autocomplete=True)  # Starts the reload.
+    wait_prefix_indexes()
+    assert search("avenue mag", autocomplete=True)
+
+
+def test_prefix_index_should_not_be_reloaded_by_searches(
+    factory, config, monkeypatch
+):
+    from addok import autocomplete
+
+    config.PREFIX_INDEX = True
+    factory(name="rue de la monnaie")
+    index = autocomplete.prefix_index(wait=True)
+    factory(name="avenue magenta")  # Bumps the import generation.
+    loaded = threading.Event()
+    loaders = []
+    load = autocomplete.PrefixIndex.load
+
+    def slow_load(db):
+        loaders.append(threading.current_thread())
+        loaded.wait(5)
+        return load(db)
+
+    monkeypatch.setattr(autocomplete.PrefixIndex, "load", slow_load)
+    # The search does not wait for the reload, and uses the previous index.
+    assert search("rue de la monn", autocomplete=True)
+    assert autocomplete.prefix_index() is index
+    loaded.set()
+    wait_prefix_indexes()
+    assert len(loaders) == 1
+    assert loaders[0] is not threading.current_thread()
+    assert autocomplete.prefix_index() is not index
+    assert search("avenue mag", autocomplete=True)
+
+
+def test_prefix_index_should_only_be_reloaded_at_end_of_import(config):
+    from addok.autocomplete import prefix_index
+    from addok.batch import process_documents
+    from addok.helpers.index import bump_import_generation
+
+    config.PREFIX_INDEX = True
+    index = prefix_index(wait=True)
+    # Chunks of an import being processed.
+    doc = {"_id": "a", "type": "street", "name": "rue de la monnaie"}
+    process_documents(json.dumps(dict(doc, lat="48.3254", lon="2.256")))
+    assert prefix_index() is index
+    wait_prefix_indexes()
+    assert prefix_index() is index
+    bump_import_generation()
+    prefix_index()
+    wait_prefix_indexes()
+    assert prefix_index() is not index
+    assert prefix_index().candidates("monn")
+
+
+def test_prefix_index_should_be_shared_by_replicas(config, monkeypatch):
+    import redis
+
+    from addok.autocomplete import prefix_index
+
+    replica = redis.Redis(**DB.instance.connection_pool.connection_kwargs)
+    monkeypatch.setattr(DB, "replicas", [replica])
+    index = prefix_index(wait=True)
+    with DB.reading() as client:
+        assert client is replica
+        assert prefix_index() is index
+
+
+def test_prefix_index_should_be_warmed_with_http_app(factory, config):
+    from addok import autocomplete
+
+    config.PREFIX_INDEX = True
+    factory(name="avenue magenta")
+    autocomplete.register_http_endpoint(None)
+    assert not autocomplete._PREFIX_LOADS
+    assert autocomplete.prefix_index().candidates("mag")
+
+
+def test_shell_autocomplete_with_prefix_index(factory, config, capsys):
+    from addok.autocomplete import do_AUTOCOMPLETE
+
+    config.PREFIX_INDEX = True
+    factory(name="avenue magenta")
+    do_AUTOCOMPLETE(None, "mag")
+    assert "magenta" in capsys.readouterr().out
+
+
+def test_one_word_autocomplete_should_use_top_documents(factory, config):
+    config.AUTOCOMPLETE_TOP_K = 2
+    factory(name="boulevard de la gare", importance=0.1)
+    best = factory(name="boulevard de la plage", importance=0.9)
+    second = factory(name="rue de la boulangerie", importance=0.5)
+    assert DB.zrevrange("t|bou", 0, -1) == [
+        "d|{}".format(best["_id"]).encode(),
+        "d|{}".format(second["_id"]).encode(),
+    ]
+    results = search("boul", autocomplete=True)
+    assert {r.id for r in results} == {best["id"], second["id"]}
+    best.update(name="plage", _action="update")
+    assert DB.zrevrange("t|bou", 0, -1) == ["d|{}".format(second["_id"]).encode()]
+
+
 def test_closer_result_should_be_first_for_same_score(factory):
     expected = factory(name="rue de paris", city="Cergy", lat=48.1, lon=2.2)
     factory(name="rue de paris", city="Perpète", lat=-48.1, lon=-2.2)
@@ -690,3 +929,63 @@ def test_extend_results_reducing_tokens_should_remove_two_tokens(factory, config
     # the search string, but it's not in the searched document.
     results = search("quai jules verne saint cyprie plage")
     assert results[0].name == "quai jules verne"
+
+
+def test_search_many_returns_results_in_queries_order(factory):
+    paris = factory(name="Paris", type="city")
+    lille = factory(name="rue de Lille", city="Douai")
+    results = search_many(["lille", "paris", "nowhere"])
+    assert len(results) == 3
+    assert results[0][0].id == lille["id"]
+    assert results[1][0].id == paris["id"]
+    assert results[2] == []
+
+
+def test_search_many_accepts_search_kwargs(factory):
+    factory(name="rue de Paris", type="street")
+    city = factory(name="Paris", type="city")
+    results = search_many(
+        [{"query": "paris", "type": "city"}, {"query": "paris", "limit": 1}]
+    )
+    assert [r.id for r in results[0]] == [city["id"]]
+    assert len(results[1]) == 1
+
+
+def test_search_many_gives_same_results_as_search(factory):
+    factory(name="rue des Lilas", city="Paris", housenumbers={"1": {"lat": "48.1", "lon": "2.1"}})
+    factory(name="rue des Lilas", city="Lyon")
+    queries = ["1 rue des lilas paris", "lilas lyon", "rue des lilas"]
+    expected = [[(r.id, r.score) for r in search(q)] for q in queries]
+    results = [[(r.id, r.score) for r in rs] for rs in search_many(queries)]
+    assert results == expected
+
+
+def test_search_tokens_resolves_existence_and_frequency(factory):
+    from addok.helpers.search import search_tokens, tokenize
+
+    factory(name="rue des lilas")
+    factory(name="rue des roses")
+    helper = Search()
+    helper.query = "rue lilas unknown"
+    tokenize(helper)
+    search_tokens(helper)
+    tokens = {str(t): t for t in helper.tokens}
+    assert tokens["rue"].db_key == "w|rue"
+    assert tokens["rue"].frequency == 2
+    assert tokens["lilas"].db_key == "w|lilas"
+    assert tokens["lilas"].frequency == 1
+    assert tokens["unknown"].db_key is None
+    assert tokens["unknown"].frequency == 0
+
+
+def test_search_tokens_works_with_helpers_without_frequencies(factory):
+    from addok.helpers.search import search_tokens, tokenize
+
+    class Helper:  # Plugin helper, not a `Search`.
+        query = "rue lilas"
+
+    factory(name="rue des lilas")
+    helper = Helper()
+    tokenize(helper)
+    search_tokens(helper)
+    assert [t.frequency for t in helper.tokens] == [1, 1]
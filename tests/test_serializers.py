@@ -0,0 +1,160 @@
+import json
+import pickle
+
+import pytest
+
+from addok.core import search
+from addok.db import DB
+from addok.ds import DS, _DB
+from addok.helpers import serializers
+from addok.helpers.serializers import (
+    ZSTD_DICTIONARY_KEY,
+    ZSTD_MAGIC,
+    MsgpackZstdSerializer,
+    ZlibSerializer,
+)
+
+pytest.importorskip("zstandard")
+pytest.importorskip("msgpack")
+
+
+def make_doc(i):
+    return {
+        "id": "street{}".format(i),
+        "type": "street",
+        "name": "Rue {} de la République".format(i),
+        "city": "Paris",
+        "postcode": "750{:02d}".format(i % 20),
+        "importance": i / 1000,
+        "lat": 48.8 + i / 1000,
+        "lon": 2.3 + i / 1000,
+        "housenumbers": {
+            str(n): {"lat": 48.8 + n / 10000, "lon": 2.3 + n / 10000}
+            for n in range(i % 30)
+        },
+    }
+
+
+@pytest.fixture
+def zstd(config, monkeypatch):
+    config.ZSTD_DICTIONARY_SAMPLES = 100
+    config.ZSTD_DICTIONARY_SIZE = 4096
+    monkeypatch.setattr(
+        MsgpackZstdSerializer, "dictionaries", serializers.ZstdDictionaries()
+    )
+    return MsgpackZstdSerializer
+
+
+def test_roundtrip_without_dictionary(zstd):
+    doc = make_doc(12)
+    blob = zstd.dumps(doc)
+    assert blob.startswith(ZSTD_MAGIC)
+    assert zstd.loads(blob) == doc
+    assert not DB.exists(ZSTD_DICTIONARY_KEY)
+
+
+def test_dictionary_is_trained_and_stored(zstd, monkeypatch):
+    for i in range(101):
+        zstd.dumps(make_doc(i))
+    dict_id = int(DB.get(ZSTD_DICTIONARY_KEY))
+    assert DB.exists("{}|{}".format(ZSTD_DICTIONARY_KEY, dict_id))
+    doc = make_doc(500)
+    blob = zstd.dumps(doc)
+    assert len(blob) < len(ZlibSerializer.dumps(doc))
+    # Another worker, loading the dictionary from Redis.
+    monkeypatch.setattr(
+        MsgpackZstdSerializer, "dictionaries", serializers.ZstdDictionaries()
+    )
+    assert zstd.loads(blob) == doc
+    # And reusing it for compression.
+    assert zstd.dumps(doc) == blob
+
+
+def test_can_read_zlib_documents(zstd):
+    doc = make_doc(3)
+    assert zstd.loads(ZlibSerializer.dumps(doc)) == doc
+
+
+def test_reencode(zstd, factory, config):
+    from addok.batch import reencode
+    from addok.core import search
+
+    class Args:
+        source = None
+
+    for i in range(5):
+        factory(name="rue des Lilas {}".format(i))
+    config.DOCUMENT_SERIALIZER = zstd
+    reencode(Args())
+    for key in _DB.keys("d|*"):
+        assert _DB.get(key).startswith(ZSTD_MAGIC)
+    assert len(search("rue des lilas")) == 5
+
+
+def test_reencode_should_train_dictionary(zstd, config):
+    from addok.batch import reencode
+
+    class Args:
+        source = None
+
+    DS.upsert(
+        *(("d|{}".format(i), ZlibSerializer.dumps(make_doc(i))) for i in range(300))
+    )
+    config.DOCUMENT_SERIALIZER = zstd
+    reencode(Args())
+    dict_id = int(DB.get(ZSTD_DICTIONARY_KEY))
+    blob = _DB.get("d|12")
+    assert serializers.zstandard.get_frame_parameters(blob).dict_id == dict_id
+    assert zstd.loads(blob) == make_doc(12)
+
+
+def test_lazy_document_decodes_payload_on_demand(zstd):
+    doc = make_doc(12)
+    loaded = zstd.loads(zstd.dumps(doc))
+    assert isinstance(loaded, serializers.LazyDocument)
+    assert loaded["name"] == doc["name"]
+    assert loaded.get("lat") == doc["lat"]
+    assert loaded._payload is not None
+    assert "housenumbers" in loaded
+    assert loaded._payload is None
+    assert loaded["housenumbers"] == doc["housenumbers"]
+
+
+@pytest.mark.parametrize(
+    "access",
+    [
+        lambda d: d["housenumbers"],
+        lambda d: d.get("housenumbers"),
+        lambda d: list(d),
+        lambda d: dict(d),
+        lambda d: json.loads(json.dumps(d)),
+        lambda d: ZlibSerializer.loads(ZlibSerializer.dumps(d)),
+        lambda d: pickle.loads(pickle.dumps(d)),
+        lambda d: d.copy(),
+        lambda d: list(d.items()),
+    ],
+)
+def test_lazy_document_is_a_complete_dict(zstd, access):
+    doc = make_doc(12)
+    loaded = zstd.loads(zstd.dumps(doc))
+    value = access(loaded)
+    assert loaded == doc
+    assert doc == loaded
+    assert value in (doc["housenumbers"], list(doc), doc, list(doc.items()))
+
+
+def test_search_only_decodes_payload_when_needed(zstd, factory, config):
+    config.DOCUMENT_SERIALIZER = zstd
+    factory(
+        name="rue des Lilas",
+        city="Paris",
+        housenumbers={"12": {"lat": 48.1, "lon": 2.1}},
+        citycode="75056",
+    )
+    result = search("rue des lilas paris")[0]
+    assert result._doc._payload is not None
+    assert result.citycode == "75056"
+    assert result._doc._payload is None
+    result = search("12 rue des lilas paris")[0]
+    assert result.housenumber == "12"
+    assert result.lat == 48.1
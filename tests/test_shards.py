@@ -0,0 +1,143 @@
+import json
+
+import pytest
+import redis
+
+from addok.core import reverse, search, search_many
+from addok.db import DB
+from addok.helpers import keys
+from addok.helpers.index import document_shard
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    kwargs = DB.connection_pool.connection_kwargs
+    # Shards on other databases of the same server.
+    clients = [
+        redis.Redis(host=kwargs.get("host"), port=kwargs.get("port"), db=db)
+        for db in (12, 13)
+    ]
+    monkeypatch.setattr(DB, "shards", clients)
+    monkeypatch.setattr(DB, "_executor", None)
+    yield clients
+    for client in clients:
+        client.flushdb()
+
+
+def owner(doc, shards):
+    return shards.index(document_shard(doc))
+
+
+def test_documents_are_spread_over_shards(shards, factory):
+    docs = [factory(name="rue des Lilas", city="Paris") for _ in range(20)]
+    owners = [owner(doc, shards) for doc in docs]
+    assert set(owners) == {0, 1}
+    for doc, index in zip(docs, owners):
+        key = keys.document_key(doc["_id"]).encode()
+        assert shards[index].zscore("w|lilas", key)
+        assert not shards[1 - index].zscore("w|lilas", key)
+
+
+def test_search_should_merge_shards_results(shards, factory):
+    docs = [
+        factory(name="rue des Lilas", city="Paris", importance=i / 10)
+        for i in range(6)
+    ]
+    assert {owner(doc, shards) for doc in docs} == {0, 1}
+    results = search("rue des lilas paris", limit=4)
+    assert [r.id for r in results] == [doc["id"] for doc in docs[::-1][:4]]
+
+
+def test_search_many_should_merge_shards_results(shards, factory):
+    docs = [factory(name="rue des Lilas", importance=i / 10) for i in range(6)]
+    factory(name="avenue des Roses")
+    results = search_many([{"query": "rue des lilas", "limit": 3}, "roses"])
+    assert [r.id for r in results[0]] == [doc["id"] for doc in docs[::-1][:3]]
+    assert [r.name for r in results[1]] == ["avenue des Roses"]
+
+
+def test_reverse_should_merge_shards_results(shards, factory):
+    near = factory(name="rue des Lilas", lat=48.234545, lon=5.235445)
+    for i in range(5):
+        factory(name="rue des Roses", lat=48.234 - i / 1000, lon=5.235445)
+    results = reverse(lat=48.234545, lon=5.235445, limit=3)
+    assert len(results) == 3
+    assert results[0].id == near["id"]
+
+
+def test_delete_should_deindex_from_owner_shard(shards, factory):
+    from addok.batch import process_documents
+
+    docs = [factory(name="rue des Lilas") for _ in range(6)]
+    for doc in docs:
+        process_documents(json.dumps({"_action": "delete", "_id": doc["_id"]}))
+    for shard in shards:
+        assert not shard.exists("w|lilas")
+    assert search("rue des lilas") == []
+
+
+PARIS = {"lat": 48.85, "lon": 2.35}
+MARSEILLE = {"lat": 43.29, "lon": 5.37}
+
+
+@pytest.fixture
+def geo_shards(shards, monkeypatch):
+    monkeypatch.setattr(DB, "shards_geohashes", [("u09",), ("spe",)])
+    return shards
+
+
+def test_documents_are_routed_by_geohash(geo_shards, factory):
+    paris = factory(name="rue des Lilas", **PARIS)
+    marseille = factory(name="rue des Lilas", **MARSEILLE)
+    assert owner(paris, geo_shards) == 0
+    assert owner(marseille, geo_shards) == 1
+
+
+def test_search_with_center_only_uses_covering_shards(geo_shards, factory):
+    paris = factory(name="rue des Lilas", **PARIS)
+    marseille = factory(name="rue des Lilas", **MARSEILLE)
+    results = search("rue des lilas", **PARIS)
+    assert [r.id for r in results] == [paris["id"]]
+    results = search("rue des lilas", **MARSEILLE)
+    assert [r.id for r in results] == [marseille["id"]]
+    # Without center, all shards are used.
+    assert len(search("rue des lilas")) == 2
+
+
+def test_search_with_center_falls_back_to_other_shards(geo_shards, factory):
+    factory(name="rue des Lilas", **PARIS)
+    prado = factory(name="avenue du Prado", **MARSEILLE)
+    results = search("avenue du prado", **PARIS)
+    assert [r.id for r in results] == [prado["id"]]
+    results = search_many([dict(query="avenue du prado", **PARIS)])
+    assert [r.id for r in results[0]] == [prado["id"]]
+
+
+def test_search_many_with_centers(geo_shards, factory):
+    paris = factory(name="rue des Lilas", **PARIS)
+    marseille = factory(name="rue des Lilas", **MARSEILLE)
+    results = search_many(
+        [
+            dict(query="rue des lilas", **PARIS),
+            dict(query="rue des lilas", **MARSEILLE),
+            "rue des lilas",
+        ]
+    )
+    assert [r.id for r in results[0]] == [paris["id"]]
+    assert [r.id for r in results[1]] == [marseille["id"]]
+    assert len(results[2]) == 2
+
+
+def test_reverse_uses_covering_shard(geo_shards, factory):
+    factory(name="rue des Lilas", **PARIS)
+    marseille = factory(name="rue des Lilas", **MARSEILLE)
+    results = reverse(limit=2, **MARSEILLE)
+    assert [r.id for r in results] == [marseille["id"]]
+
+
+def test_moved_document_is_deindexed_from_previous_shard(geo_shards, factory):
+    doc = factory(name="rue des Lilas", **PARIS)
+    doc.update(_action="update", **MARSEILLE)
+    key = keys.document_key(doc["_id"]).encode()
+    assert not geo_shards[0].zscore("w|lilas", key)
+    assert geo_shards[1].zscore("w|lilas", key)
@@ -1,7 +1,18 @@
+import importlib
+import sys
+
 import pytest
 
-from addok.helpers import import_by_path, load_csv_file
-from addok.helpers.text import tokenize
+from addok.helpers import (
+    fastjson,
+    file_ranges,
+    import_by_path,
+    load_csv_file,
+    load_file,
+    load_msgpack_file,
+    msgpack_file_ranges,
+)
+from addok.helpers.text import Token, tokenize
 
 
 @pytest.mark.parametrize(
@@ -24,3 +35,70 @@ def test_import_csv_file():
             "somethingelse": "complete",
         },
     ]
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, 7, 12, 100])
+def test_load_file_ranges(tmp_path, size):
+    path = tmp_path / "docs.json"
+    lines = ['{"name": "foo"}\n', "\n", '{"name": "bär"}\n', '{"name": "baz"}']
+    path.write_text("".join(lines))
+    loaded = [
+        line
+        for _, start, end in file_ranges(path, size)
+        for line in load_file(path, start, end)
+    ]
+    assert loaded == lines
+    assert list(load_file(path)) == lines
+
+
+@pytest.mark.parametrize("size", [1, 10, 30, 100])
+def test_load_csv_file_ranges(size):
+    loaded = [
+        row
+        for _, start, end in file_ranges("tests/test.csv", size)
+        for row in load_csv_file("tests/test.csv", start, end)
+    ]
+    assert loaded == list(load_csv_file("tests/test.csv"))
+    assert len(loaded) == 2
+
+
+@pytest.mark.parametrize("size", [1, 10, 100])
+def test_load_msgpack_file_ranges(tmp_path, size):
+    msgpack = pytest.importorskip("msgpack")
+    docs = [{"name": "foo"}, {"name": "bär", "importance": 0.5}, {"name": "baz"}]
+    path = tmp_path / "docs.msgpack"
+    path.write_bytes(b"".join(msgpack.packb(doc) for doc in docs))
+    loaded = [
+        doc
+        for _, start, end in msgpack_file_ranges(path, size)
+        for doc in load_msgpack_file(path, start, end)
+    ]
+    assert loaded == docs
+    assert list(load_msgpack_file(path)) == docs
+
+
+@pytest.fixture(params=["orjson", "json"])
+def jsonlib(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setitem(sys.modules, "orjson", None)  # Not installed.
+    else:
+        pytest.importorskip("orjson")
+    yield importlib.reload(fastjson)
+    monkeypatch.undo()
+    importlib.reload(fastjson)
+
+
+def test_fastjson_roundtrip(jsonlib):
+    data = {"name": "Rue des Lilas", "city": "Andrésy", "lat": 48.3, "tags": [1, 2]}
+    assert jsonlib.loads(jsonlib.dumps(data)) == data
+    assert jsonlib.loads(jsonlib.dumpb(data)) == data
+    assert jsonlib.dumps({"a": 1}) == '{"a":1}'
+
+
+def test_fastjson_serializes_subclasses(jsonlib):
+    class Document(dict):
+        def items(self):
+            return [("name", "loaded")]
+
+    assert jsonlib.loads(jsonlib.dumps(Document(other=1))) == {"name": "loaded"}
+    assert jsonlib.dumps([Token("rue")]) == '["rue"]'